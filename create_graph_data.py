@@ -15,11 +15,13 @@ import re
 from utils import utils, image_proc
 
 from NeuralNRT._C import compute_mesh_from_depth_and_flow as compute_mesh_from_depth_and_flow_c
+from NeuralNRT._C import compute_mesh_adjacency as compute_mesh_adjacency_c
 from NeuralNRT._C import erode_mesh as erode_mesh_c
 from NeuralNRT._C import sample_nodes as sample_nodes_c
-from NeuralNRT._C import compute_edges_geodesic as compute_edges_geodesic_c
-from NeuralNRT._C import node_and_edge_clean_up as node_and_edge_clean_up_c
-from NeuralNRT._C import compute_pixel_anchors_geodesic as compute_pixel_anchors_geodesic_c
+from NeuralNRT._C import compute_vertex_coverage as compute_vertex_coverage_c
+from NeuralNRT._C import sample_nodes_adaptive as sample_nodes_adaptive_c
+from NeuralNRT._C import compute_edges_geodesic_sparse as compute_edges_geodesic_sparse_c
+from NeuralNRT._C import compute_pixel_anchors_geodesic_sparse as compute_pixel_anchors_geodesic_sparse_c
 from NeuralNRT._C import compute_clusters as compute_clusters_c
 from NeuralNRT._C import update_pixel_anchors as update_pixel_anchors_c
 
@@ -43,8 +45,16 @@ if __name__ == "__main__":
     ENFORCE_TOTAL_NUM_NEIGHBORS = False
     SAMPLE_RANDOM_SHUFFLE = False
 
+    # Curvature adaptive node sampling: denser nodes in curved regions, sparser in flat ones
+    ADAPTIVE_NODE_SAMPLING = False
+    MIN_NODE_COVERAGE = 0.025 # in meters
+    MAX_NODE_COVERAGE = 0.1   # in meters
+    NODE_COVERAGE_CURVATURE_RATIO = 0.5 # node coverage as a fraction of the radius of curvature
+    NORMAL_SMOOTHING_ITERATIONS = 10
+
     # Pixel anchors
     NEIGHBORHOOD_DEPTH = 2
+    NUM_VERTEX_NODES = 4 # nearest valid geodesic nodes kept per vertex (the pixel anchors)
 
     MIN_CLUSTER_SIZE = 3
     MIN_NUM_NEIGHBORS = 2 
@@ -118,6 +128,11 @@ if __name__ == "__main__":
 
     assert num_vertices > 0 and num_faces > 0
 
+    # Vertex adjacency of the mesh, computed once and reused by the geodesic computations.
+    neighbor_offsets = np.zeros((0), dtype=np.int32)
+    neighbors = np.zeros((0), dtype=np.int32)
+    compute_mesh_adjacency_c(faces, num_vertices, neighbor_offsets, neighbors)
+
     # Erode mesh, to not sample unstable nodes on the mesh boundary.
     non_eroded_vertices = erode_mesh_c(
         vertices, faces, EROSION_NUM_ITERATIONS, EROSION_MIN_NEIGHBORS
@@ -145,14 +160,32 @@ if __name__ == "__main__":
     # Sample graph nodes.
     node_coords = np.zeros((0), dtype=np.float32)
     node_indices = np.zeros((0), dtype=np.int32)
-
-    num_nodes = sample_nodes_c(
-        vertices, valid_vertices,
-        node_coords, node_indices, 
-        NODE_COVERAGE, 
-        USE_ONLY_VALID_VERTICES,
-        SAMPLE_RANDOM_SHUFFLE
-    )
+    node_coverages = np.zeros((0), dtype=np.float32) # Empty: every node uses NODE_COVERAGE
+
+    if ADAPTIVE_NODE_SAMPLING:
+        vertex_coverages = compute_vertex_coverage_c(
+            vertices, faces, 
+            MIN_NODE_COVERAGE, MAX_NODE_COVERAGE, 
+            NODE_COVERAGE_CURVATURE_RATIO, 
+            NORMAL_SMOOTHING_ITERATIONS,
+            neighbor_offsets, neighbors
+        )
+
+        num_nodes = sample_nodes_adaptive_c(
+            vertices, valid_vertices, vertex_coverages,
+            node_coords, node_indices, node_coverages,
+            USE_ONLY_VALID_VERTICES,
+            SAMPLE_RANDOM_SHUFFLE
+        )
+        node_coverages = node_coverages[:num_nodes]
+    else:
+        num_nodes = sample_nodes_c(
+            vertices, valid_vertices,
+            node_coords, node_indices, 
+            NODE_COVERAGE, 
+            USE_ONLY_VALID_VERTICES,
+            SAMPLE_RANDOM_SHUFFLE
+        )
 
     node_coords = node_coords[:num_nodes, :]
     node_indices = node_indices[:num_nodes, :]
@@ -175,27 +208,30 @@ if __name__ == "__main__":
     graph_edges              = -np.ones((num_nodes, NUM_NEIGHBORS), dtype=np.int32)
     graph_edges_weights      =  np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
     graph_edges_distances    =  np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
-    node_to_vertex_distances = -np.ones((num_nodes, num_vertices), dtype=np.float32)
+    vertex_node_ids          = -np.ones((num_vertices, NUM_VERTEX_NODES), dtype=np.int32)
+    vertex_node_distances    = -np.ones((num_vertices, NUM_VERTEX_NODES), dtype=np.float32)
 
     visible_vertices = np.ones_like(valid_vertices)
 
-    compute_edges_geodesic_c(
+    # Nodes with not enough neighbors are marked in valid_nodes_mask and are not kept as nearest nodes of the vertices
+    valid_nodes_mask = np.ones((num_nodes, 1), dtype=bool)
+
+    compute_edges_geodesic_sparse_c(
         vertices, visible_vertices, faces, node_indices, 
         NUM_NEIGHBORS, NODE_COVERAGE, 
         graph_edges, graph_edges_weights, graph_edges_distances,
-        node_to_vertex_distances,
+        vertex_node_ids, vertex_node_distances,
         USE_ONLY_VALID_VERTICES,
-        ENFORCE_TOTAL_NUM_NEIGHBORS
+        ENFORCE_TOTAL_NUM_NEIGHBORS,
+        neighbor_offsets, neighbors,
+        node_coverages=node_coverages,
+        valid_nodes_mask=valid_nodes_mask if REMOVE_NODES_WITH_NOT_ENOUGH_NEIGHBORS else np.zeros((0, 1), dtype=bool)
     )
 
     # Remove nodes 
-    valid_nodes_mask = np.ones((num_nodes, 1), dtype=bool)
     node_id_black_list = []
 
     if REMOVE_NODES_WITH_NOT_ENOUGH_NEIGHBORS:
-        # Mark nodes with not enough neighbors
-        node_and_edge_clean_up_c(graph_edges, valid_nodes_mask)
-
         # Get the list of invalid nodes
         node_id_black_list = np.where(valid_nodes_mask == False)[0].tolist()
     else:
@@ -209,11 +245,12 @@ if __name__ == "__main__":
     pixel_anchors = np.zeros((0), dtype=np.int32)
     pixel_weights = np.zeros((0), dtype=np.float32)
 
-    compute_pixel_anchors_geodesic_c(
-        node_to_vertex_distances, valid_nodes_mask, 
+    compute_pixel_anchors_geodesic_sparse_c(
+        vertex_node_ids, vertex_node_distances, valid_nodes_mask, 
         vertices, vertex_pixels, 
         pixel_anchors, pixel_weights,
-        width, height, NODE_COVERAGE
+        width, height, NODE_COVERAGE,
+        node_coverages
     )
    
     print("Valid pixels:", np.sum(np.all(pixel_anchors != -1, axis=2)))
@@ -232,6 +269,8 @@ if __name__ == "__main__":
     graph_edges           = graph_edges[valid_nodes_mask.squeeze()] 
     graph_edges_weights   = graph_edges_weights[valid_nodes_mask.squeeze()] 
     graph_edges_distances = graph_edges_distances[valid_nodes_mask.squeeze()] 
+    if ADAPTIVE_NODE_SAMPLING:
+        node_coverages    = node_coverages[valid_nodes_mask.squeeze()]
 
     #########################################################################
     # Graph checks.
@@ -334,13 +373,19 @@ if __name__ == "__main__":
     dst_pixel_weights_dir = os.path.join(seq_dir, "pixel_weights")
     if not os.path.exists(dst_pixel_weights_dir): os.makedirs(dst_pixel_weights_dir)
 
-    output_graph_nodes_path           = os.path.join(dst_graph_nodes_dir, pair_name           + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_graph_edges_path           = os.path.join(dst_graph_edges_dir, pair_name           + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_graph_edges_weights_path   = os.path.join(dst_graph_edges_weights_dir, pair_name   + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_node_deformations_path     = os.path.join(dst_node_deformations_dir, pair_name     + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_graph_clusters_path        = os.path.join(dst_graph_clusters_dir, pair_name        + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_pixel_anchors_path         = os.path.join(dst_pixel_anchors_dir, pair_name         + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
-    output_pixel_weights_path         = os.path.join(dst_pixel_weights_dir, pair_name         + "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE))
+    # Adaptive graphs are stamped with the range of node coverages, the coverage of every node is saved with the graph
+    if ADAPTIVE_NODE_SAMPLING:
+        graph_stamp = "_{}_{:.3f}-{:.3f}.bin".format("adaptive", MIN_NODE_COVERAGE, MAX_NODE_COVERAGE)
+    else:
+        graph_stamp = "_{}_{:.2f}.bin".format("geodesic", NODE_COVERAGE)
+
+    output_graph_nodes_path           = os.path.join(dst_graph_nodes_dir, pair_name           + graph_stamp)
+    output_graph_edges_path           = os.path.join(dst_graph_edges_dir, pair_name           + graph_stamp)
+    output_graph_edges_weights_path   = os.path.join(dst_graph_edges_weights_dir, pair_name   + graph_stamp)
+    output_node_deformations_path     = os.path.join(dst_node_deformations_dir, pair_name     + graph_stamp)
+    output_graph_clusters_path        = os.path.join(dst_graph_clusters_dir, pair_name        + graph_stamp)
+    output_pixel_anchors_path         = os.path.join(dst_pixel_anchors_dir, pair_name         + graph_stamp)
+    output_pixel_weights_path         = os.path.join(dst_pixel_weights_dir, pair_name         + graph_stamp)
     
     utils.save_graph_nodes(output_graph_nodes_path, node_coords)
     utils.save_graph_edges(output_graph_edges_path, graph_edges)
@@ -350,6 +395,14 @@ if __name__ == "__main__":
     utils.save_int_image(output_pixel_anchors_path, pixel_anchors)
     utils.save_float_image(output_pixel_weights_path, pixel_weights)
 
+    if ADAPTIVE_NODE_SAMPLING:
+        dst_node_coverages_dir = os.path.join(seq_dir, "graph_node_coverages")
+        if not os.path.exists(dst_node_coverages_dir): os.makedirs(dst_node_coverages_dir)
+
+        output_node_coverages_path = os.path.join(dst_node_coverages_dir, pair_name + graph_stamp)
+        utils.save_graph_node_coverages(output_node_coverages_path, node_coverages)
+        assert np.array_equal(node_coverages, utils.load_graph_node_coverages(output_node_coverages_path))
+
     assert np.array_equal(node_coords, utils.load_graph_nodes(output_graph_nodes_path))
     assert np.array_equal(graph_edges, utils.load_graph_edges(output_graph_edges_path))
     assert np.array_equal(graph_edges_weights, utils.load_graph_edges_weights(output_graph_edges_weights_path))
@@ -1,4 +1,5 @@
 #include "cpu/graph_proc.h"
+#include "cpu/spatial_index.h"
 
 #include <set>
 #include <vector>
@@ -6,70 +7,116 @@
 #include <algorithm>
 #include <random> 
 #include <iostream>
+#include <atomic>
+#include <memory>
 
 #include <Eigen/Dense>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 using std::vector;
 
 namespace graph_proc {
 
+    /**
+     * Builds CSR neighbor lists from (element, neighbor) pairs: the neighbors of element i are
+     * neighbors[offsets[i]:offsets[i + 1]], sorted and unique.
+     */
+    void build_csr_adjacency(const vector<std::pair<int, int>>& pairs, int nElements, vector<int>& offsets, vector<int>& neighbors) {
+        // Bucket the pairs by element.
+        offsets.assign(nElements + 1, 0);
+        for (const auto& pair : pairs) offsets[pair.first + 1]++;
+        for (int i = 0; i < nElements; i++) offsets[i + 1] += offsets[i];
+
+        neighbors.resize(pairs.size());
+        vector<int> fill(offsets.begin(), offsets.end() - 1);
+        for (const auto& pair : pairs) neighbors[fill[pair.first]++] = pair.second;
+
+        // Sort and deduplicate every bucket, then compact.
+        int nUnique = 0;
+        for (int i = 0; i < nElements; i++) {
+            auto first = neighbors.begin() + offsets[i];
+            auto last = neighbors.begin() + offsets[i + 1];
+            std::sort(first, last);
+            last = std::unique(first, last);
+
+            offsets[i] = nUnique;
+            nUnique = std::copy(first, last, neighbors.begin() + nUnique) - neighbors.begin();
+        }
+        offsets[nElements] = nUnique;
+        neighbors.resize(nUnique);
+    }
+
     py::array_t<bool> erode_mesh(const py::array_t<float>& vertexPositions, const py::array_t<int>& faceIndices, int nIterations, int minNeighbors) {
         int nVertices = vertexPositions.shape(0);
         int nFaces = faceIndices.shape(0);
+        auto faces = faceIndices.unchecked<2>();
 
         // Init output 
         py::array_t<bool> nonErodedVertices = py::array_t<bool>({ nVertices, 1 });
-        std::vector<bool> nonErodedVerticesVec(nVertices, false);
-        
-        // Init list of eroded face indices with original list
-        std::vector<Eigen::Vector3i> erodedFaceIndicesVec;
-        erodedFaceIndicesVec.reserve(nFaces);
-        for (int FaceIdx = 0; FaceIdx < nFaces; ++FaceIdx) {
-            Eigen::Vector3i face(*faceIndices.data(FaceIdx, 0), *faceIndices.data(FaceIdx, 1), *faceIndices.data(FaceIdx, 2));
-            erodedFaceIndicesVec.push_back(face);
-        }
-
-        // Erode mesh for a total of nIterations
-        for (int i = 0; i < nIterations; i++) {
-            nFaces = erodedFaceIndicesVec.size();
-
-            // We compute the number of neighboring vertices for each vertex.
-            vector<int> numNeighbors(nVertices, 0);
-            for (int i = 0; i < nFaces; i++) {
-                const auto& face = erodedFaceIndicesVec[i];
-                numNeighbors[face[0]] += 1;
-                numNeighbors[face[1]] += 1;
-                numNeighbors[face[2]] += 1;
-            }
-
-            std::vector<Eigen::Vector3i> tmp;
-            tmp.reserve(nFaces);
-
-            for (int i = 0; i < nFaces; i++) {
-                const auto& face = erodedFaceIndicesVec[i];
-                if (numNeighbors[face[0]] >= minNeighbors && numNeighbors[face[1]] >= minNeighbors && numNeighbors[face[2]] >= minNeighbors) {
-                    tmp.push_back(face);
-                }
+
+        // Faces of every vertex.
+        vector<std::pair<int, int>> vertexFacePairs;
+        vertexFacePairs.reserve(3 * nFaces);
+        for (int faceIdx = 0; faceIdx < nFaces; faceIdx++) {
+            for (int j = 0; j < 3; j++) {
+                vertexFacePairs.emplace_back(faces(faceIdx, j), faceIdx);
             }
+        }
+        vector<int> faceOffsets, vertexFaces;
+        build_csr_adjacency(vertexFacePairs, nVertices, faceOffsets, vertexFaces);
+        vector<std::pair<int, int>>().swap(vertexFacePairs);
 
-            // We kill the faces with border vertices.
-            erodedFaceIndicesVec.clear();
-            erodedFaceIndicesVec = std::move(tmp);
+        // We compute the number of neighboring faces for each vertex.
+        vector<int> numNeighbors(nVertices, 0);
+        for (int faceIdx = 0; faceIdx < nFaces; faceIdx++) {
+            for (int j = 0; j < 3; j++) {
+                numNeighbors[faces(faceIdx, j)] += 1;
+            }
         }
 
-        // Mark non isolated vertices as not eroded.
-        nFaces = erodedFaceIndicesVec.size();
+        // Erode mesh for a total of nIterations. Only faces of vertices that lost a face in the previous
+        // iteration can be eroded, so only those are checked.
+        vector<char> faceEroded(nFaces, 0);
+        vector<int> faceCheckedIteration(nFaces, -1);
+        vector<int> candidateFaces(nFaces), erodedFaces;
+        std::iota(candidateFaces.begin(), candidateFaces.end(), 0);
+
+        for (int i = 0; i < nIterations && !candidateFaces.empty(); i++) {
+            erodedFaces.clear();
+            for (int faceIdx : candidateFaces) {
+                if (numNeighbors[faces(faceIdx, 0)] < minNeighbors || numNeighbors[faces(faceIdx, 1)] < minNeighbors || numNeighbors[faces(faceIdx, 2)] < minNeighbors) {
+                    erodedFaces.push_back(faceIdx);
+                }
+            }
 
-        for (int i = 0; i < nFaces; i++) {
-            const auto& face = erodedFaceIndicesVec[i];
-            nonErodedVerticesVec[face[0]] = true;
-            nonErodedVerticesVec[face[1]] = true;
-            nonErodedVerticesVec[face[2]] = true;
+            // We kill the faces with border vertices.
+            candidateFaces.clear();
+            for (int faceIdx : erodedFaces) {
+                faceEroded[faceIdx] = 1;
+                for (int j = 0; j < 3; j++) {
+                    numNeighbors[faces(faceIdx, j)] -= 1;
+                }
+            }
+            for (int faceIdx : erodedFaces) {
+                for (int j = 0; j < 3; j++) {
+                    int vertexIdx = faces(faceIdx, j);
+                    for (int k = faceOffsets[vertexIdx]; k < faceOffsets[vertexIdx + 1]; k++) {
+                        int neighborFaceIdx = vertexFaces[k];
+                        if (!faceEroded[neighborFaceIdx] && faceCheckedIteration[neighborFaceIdx] != i) {
+                            faceCheckedIteration[neighborFaceIdx] = i;
+                            candidateFaces.push_back(neighborFaceIdx);
+                        }
+                    }
+                }
+            }
         }
 
-        // Store into python array
+        // Mark non isolated vertices as not eroded.
         for (int i = 0; i < nVertices; i++) {
-            *nonErodedVertices.mutable_data(i, 0) = nonErodedVerticesVec[i];
+            *nonErodedVertices.mutable_data(i, 0) = numNeighbors[i] > 0;
         }
 
         return nonErodedVertices;
@@ -104,7 +151,11 @@ namespace graph_proc {
             std::shuffle(std::begin(shuffledVertices), std::end(shuffledVertices), re);
         }
 
-        std::vector<Eigen::Vector3f> nodePositionsVec;
+        // Nodes are hashed into cells of the node coverage, so only nodes in the 27 cells around a vertex
+        // can be within the coverage (the cells are slightly enlarged against rounding at cell borders).
+        PointGrid nodeGrid(nodeCoverage * 1.001f);
+
+        int nNodes = 0;
         for (int vertexIdx : shuffledVertices) {
         // for (int vertexIdx = 0; vertexIdx < nVertices; ++vertexIdx) {
             Eigen::Vector3f point(*vertexPositions.data(vertexIdx, 0), *vertexPositions.data(vertexIdx, 1), *vertexPositions.data(vertexIdx, 2));
@@ -113,17 +164,11 @@ namespace graph_proc {
                 continue;
             }
 
-            bool bIsNode = true;
-            for (int nodeIdx = 0; nodeIdx < nodePositionsVec.size(); ++nodeIdx) {
-                if ((point - nodePositionsVec[nodeIdx]).squaredNorm() <= nodeCoverage2) {
-                    bIsNode = false;
-                    break;
-                }
-            }
+            bool bIsNode = !nodeGrid.containsPointWithin(point, nodeCoverage2);
 
             if (bIsNode) {
-                nodePositionsVec.push_back(point);
-                int newNodeIdx = nodePositionsVec.size() - 1;
+                int newNodeIdx = nNodes++;
+                nodeGrid.insert(point, newNodeIdx);
                 *nodePositions.mutable_data(newNodeIdx, 0) = point.x();
                 *nodePositions.mutable_data(newNodeIdx, 1) = point.y();
                 *nodePositions.mutable_data(newNodeIdx, 2) = point.z();
@@ -131,7 +176,7 @@ namespace graph_proc {
             }
         }
 
-        return nodePositionsVec.size();
+        return nNodes;
     }
 
     /**
@@ -151,39 +196,241 @@ namespace graph_proc {
         return std::exp(- (dist * dist) / (2.f * nodeCoverage * nodeCoverage));
     }
 
-    void compute_edges_geodesic(
+    void compute_vertex_adjacency(const py::array_t<int>& faceIndices, int nVertices, vector<int>& neighborOffsets, vector<int>& neighbors) {
+        int nFaces = faceIndices.shape(0);
+        auto faces = faceIndices.unchecked<2>();
+
+        // Collect directed vertex pairs of all faces.
+        vector<std::pair<int, int>> vertexPairs;
+        vertexPairs.reserve(6 * nFaces);
+        for (int faceIdx = 0; faceIdx < nFaces; faceIdx++) {
+            for (int j = 0; j < 3; j++) {
+                int v_idx = faces(faceIdx, j);
+
+                for (int k = 0; k < 3; k++) {
+                    int n_idx = faces(faceIdx, k);
+
+                    if (v_idx == n_idx) continue;
+                    vertexPairs.emplace_back(v_idx, n_idx);
+                }
+            }
+        }
+
+        // Sorted and unique neighbors of every vertex (same order as iterating a std::set).
+        build_csr_adjacency(vertexPairs, nVertices, neighborOffsets, neighbors);
+    }
+
+    void compute_mesh_adjacency(const py::array_t<int>& faceIndices, int nVertices, py::array_t<int>& neighborOffsets, py::array_t<int>& neighbors) {
+        vector<int> neighborOffsetsVec, neighborsVec;
+        compute_vertex_adjacency(faceIndices, nVertices, neighborOffsetsVec, neighborsVec);
+
+        neighborOffsets.resize({ int(neighborOffsetsVec.size()) }, false);
+        neighbors.resize({ int(neighborsVec.size()) }, false);
+        std::copy(neighborOffsetsVec.begin(), neighborOffsetsVec.end(), neighborOffsets.mutable_data());
+        std::copy(neighborsVec.begin(), neighborsVec.end(), neighbors.mutable_data());
+    }
+
+    /**
+     * Vertex adjacency of a mesh, either given by compute_mesh_adjacency or computed from the faces.
+     */
+    struct VertexAdjacency {
+        const int* offsets;
+        const int* neighbors;
+        vector<int> offsetsVec, neighborsVec;
+
+        VertexAdjacency(const py::array_t<int>& faceIndices, int nVertices, const py::array_t<int>& neighborOffsets, const py::array_t<int>& neighborIndices) {
+            if (neighborOffsets.size() == 0) {
+                compute_vertex_adjacency(faceIndices, nVertices, offsetsVec, neighborsVec);
+                offsets = offsetsVec.data();
+                neighbors = neighborsVec.data();
+            }
+            else {
+                if (neighborOffsets.size() != nVertices + 1) {
+                    throw std::invalid_argument("Mesh adjacency doesn't match the number of vertices");
+                }
+                offsets = neighborOffsets.data();
+                neighbors = neighborIndices.data();
+            }
+        }
+    };
+
+    py::array_t<float> compute_vertex_coverage(
+        const py::array_t<float>& vertexPositions,
+        const py::array_t<int>& faceIndices,
+        const float minCoverage, const float maxCoverage,
+        const float curvatureRadiusRatio,
+        const int nSmoothingIterations,
+        const py::array_t<int>& neighborOffsets,
+        const py::array_t<int>& neighbors
+    ) {
+        int nVertices = vertexPositions.shape(0);
+        int nFaces = faceIndices.shape(0);
+
+        VertexAdjacency adjacency(faceIndices, nVertices, neighborOffsets, neighbors);
+
+        auto positions = vertexPositions.unchecked<2>();
+        auto faces = faceIndices.unchecked<2>();
+        auto position = [&](int vertexIdx) {
+            return Eigen::Vector3f(positions(vertexIdx, 0), positions(vertexIdx, 1), positions(vertexIdx, 2));
+        };
+
+        // Area weighted vertex normals.
+        vector<Eigen::Vector3f> normals(nVertices, Eigen::Vector3f::Zero());
+        for (int faceIdx = 0; faceIdx < nFaces; faceIdx++) {
+            int v0 = faces(faceIdx, 0), v1 = faces(faceIdx, 1), v2 = faces(faceIdx, 2);
+            Eigen::Vector3f faceNormal = (position(v1) - position(v0)).cross(position(v2) - position(v0));
+            normals[v0] += faceNormal;
+            normals[v1] += faceNormal;
+            normals[v2] += faceNormal;
+        }
+        for (auto& normal : normals) {
+            float norm = normal.norm();
+            if (norm > 0) normal /= norm;
+        }
+
+        // Depth noise makes the normals noisy, average them with the neighbors a few times.
+        vector<Eigen::Vector3f> smoothedNormals(nVertices);
+        for (int i = 0; i < nSmoothingIterations; i++) {
+            #pragma omp parallel for schedule(static, 1024)
+            for (int vertexIdx = 0; vertexIdx < nVertices; vertexIdx++) {
+                Eigen::Vector3f normalSum = normals[vertexIdx];
+                for (int n = adjacency.offsets[vertexIdx]; n < adjacency.offsets[vertexIdx + 1]; n++) {
+                    normalSum += normals[adjacency.neighbors[n]];
+                }
+                float norm = normalSum.norm();
+                smoothedNormals[vertexIdx] = norm > 0 ? Eigen::Vector3f(normalSum / norm) : normalSum;
+            }
+            normals.swap(smoothedNormals);
+        }
+
+        // Mean normal curvature along the edges of every vertex, |(n_i - n_j).(p_i - p_j)| / |p_i - p_j|^2.
+        vector<float> curvatures(nVertices, 0.f);
+
+        #pragma omp parallel for schedule(static, 1024)
+        for (int vertexIdx = 0; vertexIdx < nVertices; vertexIdx++) {
+            Eigen::Vector3f vertexPos = position(vertexIdx);
+            float curvatureSum = 0.f;
+            int nEdges = 0;
+
+            for (int n = adjacency.offsets[vertexIdx]; n < adjacency.offsets[vertexIdx + 1]; n++) {
+                int neighborIdx = adjacency.neighbors[n];
+                Eigen::Vector3f edge = vertexPos - position(neighborIdx);
+                float edgeLength2 = edge.squaredNorm();
+                if (edgeLength2 <= 0.f) continue;
+
+                curvatureSum += std::abs((normals[vertexIdx] - normals[neighborIdx]).dot(edge)) / edgeLength2;
+                nEdges++;
+            }
+
+            curvatures[vertexIdx] = nEdges > 0 ? curvatureSum / nEdges : 0.f;
+        }
+
+        // The coverage is a fraction of the radius of curvature, within the coverage bounds.
+        py::array_t<float> vertexCoverages = py::array_t<float>({ nVertices });
+        auto coverages = vertexCoverages.mutable_unchecked<1>();
+        for (int vertexIdx = 0; vertexIdx < nVertices; vertexIdx++) {
+            float coverage = curvatures[vertexIdx] > 0.f ? curvatureRadiusRatio / curvatures[vertexIdx] : maxCoverage;
+            coverages(vertexIdx) = std::min(std::max(coverage, minCoverage), maxCoverage);
+        }
+
+        return vertexCoverages;
+    }
+
+    int sample_nodes_adaptive(
+        const py::array_t<float>& vertexPositions, const py::array_t<bool>& nonErodedVertices,
+        const py::array_t<float>& vertexCoverages,
+        py::array_t<float>& nodePositions, py::array_t<int>& nodeIndices, py::array_t<float>& nodeCoverages,
+        const bool useOnlyNonErodedIndices,
+        const bool randomShuffle
+    ) {
+        int nVertices = vertexPositions.shape(0);
+
+        if (vertexCoverages.size() != nVertices) {
+            throw std::invalid_argument("vertexCoverages doesn't match the number of vertices");
+        }
+
+        const float* coverages = vertexCoverages.data();
+        float maxCoverage = 0.f;
+        for (int vertexIdx = 0; vertexIdx < nVertices; vertexIdx++) {
+            if (!(coverages[vertexIdx] > 0.f)) {
+                throw std::invalid_argument("vertexCoverages must be positive");
+            }
+            maxCoverage = std::max(maxCoverage, coverages[vertexIdx]);
+        }
+
+        nodePositions.resize({ nVertices, 3 }, false);
+        nodeIndices.resize({ nVertices, 1 }, false);
+        nodeCoverages.resize({ nVertices }, false);
+
+        // create list of shuffled indices
+        std::vector<int> shuffledVertices(nVertices);
+        std::iota(std::begin(shuffledVertices), std::end(shuffledVertices), 0);
+
+        if (randomShuffle) {
+            std::default_random_engine re{std::random_device{}()};
+            std::shuffle(std::begin(shuffledVertices), std::end(shuffledVertices), re);
+        }
+
+        // A vertex is covered by a node closer than the mean of their coverages. It is never more than
+        // the largest coverage, so only the nodes in the 27 grid cells around the vertex are checked.
+        PointGrid nodeGrid(maxCoverage * 1.001f);
+
+        int nNodes = 0;
+        for (int vertexIdx : shuffledVertices) {
+            if (useOnlyNonErodedIndices && !(*nonErodedVertices.data(vertexIdx))) {
+                continue;
+            }
+
+            Eigen::Vector3f point(*vertexPositions.data(vertexIdx, 0), *vertexPositions.data(vertexIdx, 1), *vertexPositions.data(vertexIdx, 2));
+            float coverage = coverages[vertexIdx];
+
+            bool bIsNode = !nodeGrid.containsPointIf(point, [&](const Eigen::Vector3f& nodePos, int nodeIdx) {
+                float minDist = 0.5f * (coverage + *nodeCoverages.data(nodeIdx));
+                return (point - nodePos).squaredNorm() <= minDist * minDist;
+            });
+
+            if (bIsNode) {
+                int newNodeIdx = nNodes++;
+                nodeGrid.insert(point, newNodeIdx);
+                *nodePositions.mutable_data(newNodeIdx, 0) = point.x();
+                *nodePositions.mutable_data(newNodeIdx, 1) = point.y();
+                *nodePositions.mutable_data(newNodeIdx, 2) = point.z();
+                *nodeIndices.mutable_data(newNodeIdx, 0) = vertexIdx;
+                *nodeCoverages.mutable_data(newNodeIdx) = coverage;
+            }
+        }
+
+        return nNodes;
+    }
+
+    /**
+     * Geodesic search from every node, shared by the dense and the sparse version of compute_edges_geodesic.
+     * visitVertex(nodeId, vertexIdx, dist) is called (from the thread running the search) for every vertex
+     * settled by the search of a node. If nodesToUpdate is given, only the nodes marked in it are searched
+     * from, and the edges of the other nodes are left as they are. If nodeCoverages is given, it replaces
+     * nodeCoverage per node (search radius and edge weights).
+     */
+    template <typename VisitVertex>
+    void compute_edges_geodesic_impl(
 		const py::array_t<float>& vertexPositions,
 		const py::array_t<bool>& validVertices, 
-		const py::array_t<int>& faceIndices, 
+		const VertexAdjacency& adjacency, 
 		const py::array_t<int>& nodeIndices, 
 		const int nMaxNeighbors, const float nodeCoverage,
         py::array_t<int>& graphEdges,
         py::array_t<float>& graphEdgesWeights,
         py::array_t<float>& graphEdgesDistances,
-        py::array_t<float>& nodeToVertexDistances,
         const bool allow_only_valid_vertices,
-        const bool enforce_total_num_neighbors
+        const bool enforce_total_num_neighbors,
+        const bool* nodesToUpdate,
+        const float* nodeCoverages,
+        VisitVertex&& visitVertex
 	) {
 		int nVertices = vertexPositions.shape(0);
-		int nFaces = faceIndices.shape(0);
         int nNodes = nodeIndices.shape(0);
 
-        float maxInfluence = 2.f * nodeCoverage;
-
-        // Preprocess vertex neighbors.
-		vector<std::set<int>> vertexNeighbors(nVertices);
-        for (int faceIdx = 0; faceIdx < nFaces; faceIdx++) {
-            for (int j = 0; j < 3; j++) {
-                int v_idx = *faceIndices.data(faceIdx, j);
-                
-                for (int k = 0; k < 3; k++) {
-                    int n_idx = *faceIndices.data(faceIdx, k);
-                    
-                    if (v_idx == n_idx) continue;
-                    vertexNeighbors[v_idx].insert(n_idx);
-                }
-            }
-        }
+        const int* neighborOffsets = adjacency.offsets;
+        const int* neighbors = adjacency.neighbors;
 
 		// Compute inverse vertex -> node relationship.
 		vector<int> mapVertexToNode(nVertices, -1);
@@ -195,188 +442,337 @@ namespace graph_proc {
 			}
 		}
 
-        // #pragma omp parallel for
-		for (int nodeId = 0; nodeId < nNodes; nodeId++) {
-			// vertex queue
-            std::priority_queue<
-				std::pair<int, float>,
-				vector<std::pair<int, float>>,
-				CustomCompare
-			> nextVerticesWithIds;
-
-			std::set<int> visitedVertices;
-
-			// Add node vertex as the first vertex to be visited.
-			int nodeVertexIdx = *nodeIndices.data(nodeId);
-			if (nodeVertexIdx < 0) continue;
-			nextVerticesWithIds.push(std::make_pair(nodeVertexIdx, 0.f));
-			
-			// Traverse all neighbors in the monotonically increasing order.
+        auto positions = vertexPositions.unchecked<2>();
+        auto valid = validVertices.unchecked();
+        auto edges = graphEdges.mutable_unchecked<2>();
+        auto edgesWeights = graphEdgesWeights.mutable_unchecked<2>();
+        auto edgesDistances = graphEdgesDistances.mutable_unchecked<2>();
+
+        #pragma omp parallel
+        {
+            // Per thread workspace. A vertex is visited in the current search if its stamp equals the
+            // search epoch (nodeId + 1), so the array never needs to be cleared.
+            vector<int> visitedEpoch(nVertices, 0);
+
+            // Vertex queue, a binary heap (as std::priority_queue) that keeps its memory between searches.
+            vector<std::pair<int, float>> nextVerticesWithIds;
+            CustomCompare compare;
+
             vector<int>   neighborNodeIds;
             vector<float> neighborNodeWeights;
             vector<float> neighborNodeDistances;
-			while (!nextVerticesWithIds.empty()) {
-				auto nextVertex = nextVerticesWithIds.top();
-				nextVerticesWithIds.pop();
 
-				int nextVertexIdx = nextVertex.first;
-				float nextVertexDist = nextVertex.second;
+            #pragma omp for schedule(dynamic, 4)
+            for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+                if (nodesToUpdate != nullptr && !nodesToUpdate[nodeId]) continue;
 
-				// We skip the vertex, if it was already visited before.
-				if (visitedVertices.find(nextVertexIdx) != visitedVertices.end()) continue;
+                // Add node vertex as the first vertex to be visited.
+                int nodeVertexIdx = *nodeIndices.data(nodeId);
+                if (nodeVertexIdx < 0) continue;
 
-                if (allow_only_valid_vertices && !*validVertices.data(nextVertexIdx)) {
-                    std::cout << "compute_edges_geodesic:: ufff... we shouldn't be checking out this vertex" << std::endl;
-                    exit(0);
-                }
+                const int epoch = nodeId + 1;
 
-				// We check if the vertex is a node.
-				int nextNodeId = mapVertexToNode[nextVertexIdx];
-				if (nextNodeId >= 0 && nextNodeId != nodeId) {
-                    neighborNodeIds.push_back(nextNodeId);
-                    neighborNodeWeights.push_back(compute_anchor_weight(nextVertexDist, nodeCoverage));
-                    neighborNodeDistances.push_back(nextVertexDist);
-                    if (neighborNodeIds.size() >= nMaxNeighbors) break;
-				}
+                const float coverage = nodeCoverages != nullptr ? nodeCoverages[nodeId] : nodeCoverage;
+                const float maxInfluence = 2.f * coverage;
 
-				// Note down the node-vertex distance.
-				*nodeToVertexDistances.mutable_data(nodeId, nextVertexIdx) = nextVertexDist;
+                nextVerticesWithIds.clear();
+                nextVerticesWithIds.push_back(std::make_pair(nodeVertexIdx, 0.f));
 
-				// We visit the vertex, and check all his neighbors.
-				// We add only valid vertices under a certain distance
-				visitedVertices.insert(nextVertexIdx);
-				Eigen::Vector3f nextVertexPos(*vertexPositions.data(nextVertexIdx, 0), *vertexPositions.data(nextVertexIdx, 1), *vertexPositions.data(nextVertexIdx, 2));
+                // Traverse all neighbors in the monotonically increasing order.
+                neighborNodeIds.clear();
+                neighborNodeWeights.clear();
+                neighborNodeDistances.clear();
+                while (!nextVerticesWithIds.empty()) {
+                    std::pop_heap(nextVerticesWithIds.begin(), nextVerticesWithIds.end(), compare);
+                    auto nextVertex = nextVerticesWithIds.back();
+                    nextVerticesWithIds.pop_back();
 
-				const auto& nextNeighbors = vertexNeighbors[nextVertexIdx];
-				for (int neighborIdx : nextNeighbors) {
+                    int nextVertexIdx = nextVertex.first;
+                    float nextVertexDist = nextVertex.second;
 
-                    bool is_valid_vertex = *validVertices.data(neighborIdx); 
-                    if (allow_only_valid_vertices && !is_valid_vertex) {
-                        continue;
+                    // We skip the vertex, if it was already visited before.
+                    if (visitedEpoch[nextVertexIdx] == epoch) continue;
+
+                    if (allow_only_valid_vertices && !valid(nextVertexIdx)) {
+                        std::cout << "compute_edges_geodesic:: ufff... we shouldn't be checking out this vertex" << std::endl;
+                        exit(0);
                     }
 
-					Eigen::Vector3f neighborVertexPos(*vertexPositions.data(neighborIdx, 0), *vertexPositions.data(neighborIdx, 1), *vertexPositions.data(neighborIdx, 2));
-					float dist = nextVertexDist + (nextVertexPos - neighborVertexPos).norm();
-                    
-                    if (enforce_total_num_neighbors) {
-						nextVerticesWithIds.push(std::make_pair(neighborIdx, dist));
+                    // We check if the vertex is a node.
+                    int nextNodeId = mapVertexToNode[nextVertexIdx];
+                    if (nextNodeId >= 0 && nextNodeId != nodeId) {
+                        neighborNodeIds.push_back(nextNodeId);
+                        neighborNodeWeights.push_back(compute_anchor_weight(nextVertexDist, coverage));
+                        neighborNodeDistances.push_back(nextVertexDist);
+                        if (neighborNodeIds.size() >= nMaxNeighbors) break;
                     }
-					else {
-                        // std::cout << dist << " " << maxInfluence << std::endl;
-                        if (dist <= maxInfluence) {
-						    nextVerticesWithIds.push(std::make_pair(neighborIdx, dist));
-					    }
-                    } 
-				}
-			}
 
-            // Store the nearest neighbors.
-            int nNeighbors = neighborNodeIds.size();
+                    // Note down the node-vertex distance.
+                    visitVertex(nodeId, nextVertexIdx, nextVertexDist);
 
-            float weightSum = 0.f;
-            for (int i = 0; i < nNeighbors; i++) {
-                *graphEdges.mutable_data(nodeId, i) = neighborNodeIds[i];
-                weightSum += neighborNodeWeights[i];
-            }
+                    // We visit the vertex, and check all his neighbors.
+                    // We add only valid vertices under a certain distance (the search radius
+                    // of the node, unless the total number of neighbors is enforced).
+                    visitedEpoch[nextVertexIdx] = epoch;
+                    Eigen::Vector3f nextVertexPos(positions(nextVertexIdx, 0), positions(nextVertexIdx, 1), positions(nextVertexIdx, 2));
+
+                    for (int n = neighborOffsets[nextVertexIdx]; n < neighborOffsets[nextVertexIdx + 1]; n++) {
+                        int neighborIdx = neighbors[n];
+
+                        // Already settled with a shorter distance.
+                        if (visitedEpoch[neighborIdx] == epoch) continue;
+
+                        bool is_valid_vertex = valid(neighborIdx); 
+                        if (allow_only_valid_vertices && !is_valid_vertex) {
+                            continue;
+                        }
 
-            // Normalize weights
-            if (weightSum > 0) {
+                        Eigen::Vector3f neighborVertexPos(positions(neighborIdx, 0), positions(neighborIdx, 1), positions(neighborIdx, 2));
+                        float dist = nextVertexDist + (nextVertexPos - neighborVertexPos).norm();
+
+                        if (enforce_total_num_neighbors || dist <= maxInfluence) {
+                            nextVerticesWithIds.push_back(std::make_pair(neighborIdx, dist));
+                            std::push_heap(nextVerticesWithIds.begin(), nextVerticesWithIds.end(), compare);
+                        }
+                    }
+                }
+
+                // Store the nearest neighbors.
+                int nNeighbors = neighborNodeIds.size();
+
+                float weightSum = 0.f;
                 for (int i = 0; i < nNeighbors; i++) {
-                    *graphEdgesWeights.mutable_data(nodeId, i) = neighborNodeWeights[i] / weightSum;
+                    edges(nodeId, i) = neighborNodeIds[i];
+                    weightSum += neighborNodeWeights[i];
                 }
-            }
-            else if (nNeighbors > 0) {
+
+                // Normalize weights
+                if (weightSum > 0) {
+                    for (int i = 0; i < nNeighbors; i++) {
+                        edgesWeights(nodeId, i) = neighborNodeWeights[i] / weightSum;
+                    }
+                }
+                else if (nNeighbors > 0) {
+                    for (int i = 0; i < nNeighbors; i++) {
+                        edgesWeights(nodeId, i) = neighborNodeWeights[i] / nNeighbors;
+                    }
+                }
+
+                // Store edge distance.
                 for (int i = 0; i < nNeighbors; i++) {
-                    *graphEdgesWeights.mutable_data(nodeId, i) = neighborNodeWeights[i] / nNeighbors;
+                    edgesDistances(nodeId, i) = neighborNodeDistances[i];
                 }
             }
+        }
+    }
 
-            // Store edge distance.
-            for (int i = 0; i < nNeighbors; i++) {
-                *graphEdgesDistances.mutable_data(nodeId, i) = neighborNodeDistances[i];
-            }
-		}
+    void compute_edges_geodesic(
+		const py::array_t<float>& vertexPositions,
+		const py::array_t<bool>& validVertices, 
+		const py::array_t<int>& faceIndices, 
+		const py::array_t<int>& nodeIndices, 
+		const int nMaxNeighbors, const float nodeCoverage,
+        py::array_t<int>& graphEdges,
+        py::array_t<float>& graphEdgesWeights,
+        py::array_t<float>& graphEdgesDistances,
+        py::array_t<float>& nodeToVertexDistances,
+        const bool allow_only_valid_vertices,
+        const bool enforce_total_num_neighbors,
+        const py::array_t<int>& neighborOffsets,
+        const py::array_t<int>& neighbors
+	) {
+        VertexAdjacency adjacency(faceIndices, vertexPositions.shape(0), neighborOffsets, neighbors);
+
+        // Every search writes only the row of its node.
+        auto distances = nodeToVertexDistances.mutable_unchecked<2>();
+
+        compute_edges_geodesic_impl(
+            vertexPositions, validVertices, adjacency, nodeIndices, nMaxNeighbors, nodeCoverage,
+            graphEdges, graphEdgesWeights, graphEdgesDistances, allow_only_valid_vertices, enforce_total_num_neighbors, nullptr, nullptr,
+            [&](int nodeId, int vertexIdx, float dist) { distances(nodeId, vertexIdx) = dist; }
+        );
     }
 
-    py::array_t<int> compute_edges_euclidean(const py::array_t<float>& nodePositions, int nMaxNeighbors) {
-        int nNodes = nodePositions.shape(0);
+    /**
+     * Inserts a node into the nearest nodes of a vertex, sorted by (distance, node id), keeping at most capacity
+     * nodes. Unused entries are -1.
+     */
+    inline void insert_nearest_vertex_node(const int node_id, const float dist, int* node_ids, float* node_distances, const int capacity) {
+        int num_nearest = 0;
+        while (num_nearest < capacity && node_ids[num_nearest] >= 0) num_nearest++;
+
+        auto closer = [&](int i) { return node_distances[i] < dist || (node_distances[i] == dist && node_ids[i] < node_id); };
+        if (num_nearest == capacity && closer(capacity - 1)) return;
+
+        int pos = num_nearest < capacity ? num_nearest : capacity - 1;
+        while (pos > 0 && !closer(pos - 1)) {
+            node_ids[pos] = node_ids[pos - 1];
+            node_distances[pos] = node_distances[pos - 1];
+            pos--;
+        }
+        node_ids[pos] = node_id;
+        node_distances[pos] = dist;
+    }
 
-        py::array_t<int> graphEdges = py::array_t<int>({ nNodes, nMaxNeighbors });
+    void compute_edges_geodesic_sparse(
+		const py::array_t<float>& vertexPositions,
+		const py::array_t<bool>& validVertices, 
+		const py::array_t<int>& faceIndices, 
+		const py::array_t<int>& nodeIndices, 
+		const int nMaxNeighbors, const float nodeCoverage,
+        py::array_t<int>& graphEdges,
+        py::array_t<float>& graphEdgesWeights,
+        py::array_t<float>& graphEdgesDistances,
+        py::array_t<int>& vertexNodeIds,
+        py::array_t<float>& vertexNodeDistances,
+        const bool allow_only_valid_vertices,
+        const bool enforce_total_num_neighbors,
+        const py::array_t<int>& neighborOffsets,
+        const py::array_t<int>& neighbors,
+        const py::array_t<bool>& nodesToUpdate,
+        const py::array_t<float>& nodeCoverages,
+        py::array_t<bool>& validNodesMask
+	) {
+        int nVertices = vertexPositions.shape(0);
+        int nNodes = nodeIndices.shape(0);
+        int nVertexNodes = vertexNodeIds.shape(1);
 
-        // Find nearest Euclidean neighbors for each node.
+        VertexAdjacency adjacency(faceIndices, nVertices, neighborOffsets, neighbors);
+
+        if (nodesToUpdate.size() != 0 && nodesToUpdate.size() != nNodes) {
+            throw std::invalid_argument("nodesToUpdate doesn't match the number of nodes");
+        }
+        if (nodeCoverages.size() != 0 && nodeCoverages.size() != nNodes) {
+            throw std::invalid_argument("nodeCoverages doesn't match the number of nodes");
+        }
+        if (validNodesMask.size() != 0 && validNodesMask.size() != nNodes) {
+            throw std::invalid_argument("validNodesMask doesn't match the number of nodes");
+        }
+        const float* coverages = nodeCoverages.size() != 0 ? nodeCoverages.data() : nullptr;
+
+        // Nodes searched from.
+        std::unique_ptr<bool[]> searchNodes(new bool[nNodes]);
         for (int nodeId = 0; nodeId < nNodes; nodeId++) {
-            Eigen::Vector3f nodePos(*nodePositions.data(nodeId, 0), *nodePositions.data(nodeId, 1), *nodePositions.data(nodeId, 2));
+            searchNodes[nodeId] = nodesToUpdate.size() == 0 || *nodesToUpdate.data(nodeId);
+        }
 
-            // Keep only the k nearest Euclidean neighbors.
-            std::list<std::pair<int, float>> nearestNodesWithSquaredDistances;
+        auto noVisit = [](int nodeId, int vertexIdx, float dist) {};
 
-            for (int neighborId = 0; neighborId < nNodes; neighborId++) {
-                if (neighborId == nodeId) continue;
+        if (validNodesMask.size() != 0) {
+            // Nodes without enough neighbors are only known once the edges of all nodes are computed,
+            // so the vertex lists are collected by a second search from the valid nodes only. Otherwise
+            // invalid nodes would take the places of valid nodes in the (truncated) vertex lists.
+            compute_edges_geodesic_impl(
+                vertexPositions, validVertices, adjacency, nodeIndices, nMaxNeighbors, nodeCoverage,
+                graphEdges, graphEdgesWeights, graphEdgesDistances, allow_only_valid_vertices, enforce_total_num_neighbors,
+                searchNodes.get(), coverages, noVisit
+            );
 
-                Eigen::Vector3f neighborPos(*nodePositions.data(neighborId, 0), *nodePositions.data(neighborId, 1), *nodePositions.data(neighborId, 2));
+            node_and_edge_clean_up(graphEdges, validNodesMask);
 
-                float distance2 = (nodePos - neighborPos).squaredNorm();
-                bool bInserted = false;
-                for (auto it = nearestNodesWithSquaredDistances.begin(); it != nearestNodesWithSquaredDistances.end(); ++it) {
-                    // We insert the element at the first position where its distance is smaller than the other
-                    // element's distance, which enables us to always keep a sorted list of at most k nearest
-                    // neighbors.
-                    if (distance2 <= it->second) {
-                        it = nearestNodesWithSquaredDistances.insert(it, std::make_pair(neighborId, distance2));
-                        bInserted = true;
-                        break;
-                    }
-                }
+            for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+                searchNodes[nodeId] = searchNodes[nodeId] && *validNodesMask.data(nodeId, 0);
+            }
+        }
 
-                if (!bInserted && nearestNodesWithSquaredDistances.size() < nMaxNeighbors) {
-                    nearestNodesWithSquaredDistances.emplace_back(std::make_pair(neighborId, distance2));
-                }
+        auto nodeIds = vertexNodeIds.mutable_unchecked<2>();
+        auto nodeDistances = vertexNodeDistances.mutable_unchecked<2>();
+        for (int vertexIdx = 0; vertexIdx < nVertices; vertexIdx++) {
+            for (int i = 0; i < nVertexNodes; i++) {
+                nodeIds(vertexIdx, i) = -1;
+                nodeDistances(vertexIdx, i) = -1.f;
+            }
+        }
 
-                // We keep only the list of k nearest elements.
-                if (bInserted && nearestNodesWithSquaredDistances.size() > nMaxNeighbors) {
-                    nearestNodesWithSquaredDistances.pop_back();
-                }
+        if (nVertexNodes == 0) {
+            if (validNodesMask.size() == 0) {
+                compute_edges_geodesic_impl(
+                    vertexPositions, validVertices, adjacency, nodeIndices, nMaxNeighbors, nodeCoverage,
+                    graphEdges, graphEdgesWeights, graphEdgesDistances, allow_only_valid_vertices, enforce_total_num_neighbors,
+                    searchNodes.get(), coverages, noVisit
+                );
             }
-            
-            // Store nearest neighbor ids.
-            int idx = 0;
-            for (auto it = nearestNodesWithSquaredDistances.begin(); it != nearestNodesWithSquaredDistances.end(); ++it) {
-                int neighborId = it->first;
-                *graphEdges.mutable_data(nodeId, idx) = neighborId;
-                idx++;
+            return;
+        }
+
+        // Every visit is inserted directly into the nearest nodes of its vertex, so the memory doesn't grow
+        // with the number of visits. Vertices are protected by striped spin locks.
+        const int nLocks = 4096;
+        std::unique_ptr<std::atomic_flag[]> locks(new std::atomic_flag[nLocks]);
+        for (int i = 0; i < nLocks; i++) locks[i].clear();
+
+        compute_edges_geodesic_impl(
+            vertexPositions, validVertices, adjacency, nodeIndices, nMaxNeighbors, nodeCoverage,
+            graphEdges, graphEdgesWeights, graphEdgesDistances, allow_only_valid_vertices, enforce_total_num_neighbors,
+            searchNodes.get(), coverages,
+            [&](int nodeId, int vertexIdx, float dist) {
+                std::atomic_flag& lock = locks[vertexIdx % nLocks];
+                while (lock.test_and_set(std::memory_order_acquire));
+                insert_nearest_vertex_node(nodeId, dist, nodeIds.mutable_data(vertexIdx, 0), nodeDistances.mutable_data(vertexIdx, 0), nVertexNodes);
+                lock.clear(std::memory_order_release);
             }
+        );
+    }
+
+    py::array_t<int> compute_edges_euclidean(const py::array_t<float>& nodePositions, int nMaxNeighbors) {
+        int nNodes = nodePositions.shape(0);
+
+        py::array_t<int> graphEdges = py::array_t<int>({ nNodes, nMaxNeighbors });
+        auto edges = graphEdges.mutable_unchecked<2>();
+
+        std::vector<Eigen::Vector3f> nodePositionsVec(nNodes);
+        for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+            nodePositionsVec[nodeId] = Eigen::Vector3f(*nodePositions.data(nodeId, 0), *nodePositions.data(nodeId, 1), *nodePositions.data(nodeId, 2));
+        }
+        KdTree nodeTree(nodePositionsVec);
+
+        // Find nearest Euclidean neighbors for each node.
+        #pragma omp parallel
+        {
+            std::vector<std::pair<float, int>> nearestNodesWithSquaredDistances;
+
+            #pragma omp for
+            for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+                // Keep only the k nearest Euclidean neighbors, sorted by distance.
+                nodeTree.knn(nodePositionsVec[nodeId], nMaxNeighbors, nearestNodesWithSquaredDistances, nodeId);
+
+                // Store nearest neighbor ids.
+                int nNeighbors = nearestNodesWithSquaredDistances.size();
+                for (int idx = 0; idx < nNeighbors; idx++) {
+                    edges(nodeId, idx) = nearestNodesWithSquaredDistances[idx].second;
+                }
 
-            for (idx = nearestNodesWithSquaredDistances.size(); idx < nMaxNeighbors; idx++) {
-                *graphEdges.mutable_data(nodeId, idx) = -1;
+                for (int idx = nNeighbors; idx < nMaxNeighbors; idx++) {
+                    edges(nodeId, idx) = -1;
+                }
             }
         }
 
         return graphEdges;
     }
 
-    inline int traverse_neighbors(const std::vector<std::set<int>>& node_neighbors, std::vector<int>& cluster_ids, int cluster_id, int node_id) {
+    inline int traverse_neighbors(const vector<int>& neighbor_offsets, const vector<int>& node_neighbors, std::vector<int>& cluster_ids, int cluster_id, int node_id) {
         if (cluster_ids[node_id] != -1) return 0;
         
-        std::set<int> active_node_indices;
+        std::vector<int> active_node_indices;
 
         // Initialize with current node.
-        int cluster_size = 0;
-        active_node_indices.insert(node_id);
+        int cluster_size = 1;
+        cluster_ids[node_id] = cluster_id;
+        active_node_indices.push_back(node_id);
 
         // Process until we have no active nodes anymore.
         while (!active_node_indices.empty()) {	
-            int active_node_id = *active_node_indices.begin();
-            active_node_indices.erase(active_node_indices.begin());
-
-            if (cluster_ids[active_node_id] == -1) {
-                cluster_ids[active_node_id] = cluster_id;
-                ++cluster_size;
-            }
+            int active_node_id = active_node_indices.back();
+            active_node_indices.pop_back();
 
             // Look if we need to process any of the neighbors
-            for (const auto& n_idx : node_neighbors[active_node_id]) {
+            for (int i = neighbor_offsets[active_node_id]; i < neighbor_offsets[active_node_id + 1]; i++) {
+                int n_idx = node_neighbors[i];
                 if (cluster_ids[n_idx] == -1) {	// If it doesn't have a cluster yet
-                    active_node_indices.insert(n_idx);
+                    cluster_ids[n_idx] = cluster_id;
+                    ++cluster_size;
+                    active_node_indices.push_back(n_idx);
                 }
             }
         }
@@ -443,8 +839,9 @@ namespace graph_proc {
         int num_nodes = graph_edges.shape(0);
         int max_num_neighbors = graph_edges.shape(1);
 
-        // convert graph_edges to a vector of sets
-        std::vector<std::set<int>> node_neighbors(num_nodes);
+        // convert graph_edges to undirected CSR neighbor lists
+        std::vector<std::pair<int, int>> node_pairs;
+        node_pairs.reserve(2 * num_nodes * max_num_neighbors);
 
         for (int node_id = 0; node_id < num_nodes; ++node_id) {
             for (int neighbor_idx = 0; neighbor_idx < max_num_neighbors; ++neighbor_idx) {
@@ -455,17 +852,20 @@ namespace graph_proc {
                     break;
                 }
 
-                node_neighbors[node_id].insert(neighbor_id);
-                node_neighbors[neighbor_id].insert(node_id);
+                node_pairs.emplace_back(node_id, neighbor_id);
+                node_pairs.emplace_back(neighbor_id, node_id);
             }
         }
 
+        std::vector<int> neighbor_offsets, node_neighbors;
+        build_csr_adjacency(node_pairs, num_nodes, neighbor_offsets, node_neighbors);
+
         std::vector<int> cluster_ids(num_nodes, -1);
         std::vector<int> clusters_size;
 
         int cluster_id = 0;
         for (int node_id = 0; node_id < num_nodes; ++node_id) {
-            int cluster_size = traverse_neighbors(node_neighbors, cluster_ids, cluster_id, node_id);
+            int cluster_size = traverse_neighbors(neighbor_offsets, node_neighbors, cluster_ids, cluster_id, node_id);
             if (cluster_size > 0) {
                 cluster_id++;
                 clusters_size.push_back(cluster_size);
@@ -479,53 +879,69 @@ namespace graph_proc {
         return clusters_size;
     }   
 
-    inline void compute_nearest_geodesic_nodes(
-        const py::array_t<float>&  node_to_vertex_distance, 
-        const py::array_t<int>& valid_nodes_mask,
-        const int vertex_id, 
-        std::vector<int>& nearest_geodesic_node_ids, 
-        std::vector<float>& dist_to_nearest_geodesic_nodes
+    /**
+     * Inserts a node into the nearest geodesic nodes of a vertex, sorted by distance, keeping at most GRAPH_K.
+     * Nodes are inserted in increasing id, so a node at the same distance as a kept node is dropped
+     * (the node with the lower id is kept).
+     */
+    inline void insert_nearest_geodesic_node(
+        const int node_id, const float dist,
+        int* nearest_geodesic_node_ids, float* dist_to_nearest_geodesic_nodes, int& num_nearest
     ) {
-        int num_nodes = node_to_vertex_distance.shape(0);
-
-        std::map<int, float> node_map;
-
-        for (int n = 0; n < num_nodes; ++n) {
-
-            // discard node if it was marked as invalid (due to not having enough neighbors)
-            if (*valid_nodes_mask.data(n, 0) == false) {
-                continue;
-            }
+        if (num_nearest == GRAPH_K && dist >= dist_to_nearest_geodesic_nodes[GRAPH_K - 1]) return;
 
-            float dist = *node_to_vertex_distance.data(n, vertex_id);
+        int pos = 0;
+        while (pos < num_nearest && dist_to_nearest_geodesic_nodes[pos] < dist) pos++;
+        if (pos < num_nearest && dist_to_nearest_geodesic_nodes[pos] == dist) return;
 
-            if (dist >= 0) {
-                node_map.emplace(n, dist);
-            }
+        if (num_nearest < GRAPH_K) num_nearest++;
+        for (int i = num_nearest - 1; i > pos; i--) {
+            nearest_geodesic_node_ids[i] = nearest_geodesic_node_ids[i - 1];
+            dist_to_nearest_geodesic_nodes[i] = dist_to_nearest_geodesic_nodes[i - 1];
         }
+        nearest_geodesic_node_ids[pos] = node_id;
+        dist_to_nearest_geodesic_nodes[pos] = dist;
+    }
+
+    /**
+     * Computes the skinning weights of the nearest geodesic nodes and stores them as anchors of a pixel.
+     */
+    inline void store_geodesic_pixel_anchors(
+        const int* nearest_geodesic_node_ids, 
+        const float* dist_to_nearest_geodesic_nodes,
+        const int num_anchors,
+        const float node_coverage,
+        const float* node_coverages,
+        int* pixel_anchors, float* pixel_weights
+    ) {
+        float skinning_weights[GRAPH_K];
 
-        // Sort the map by distance
-        // Declaring the type of Predicate that accepts 2 pairs and return a bool
-        typedef std::function<bool(std::pair<int, float>, std::pair<int, float>)> Comparator;
- 
-        // Defining a lambda function to compare two pairs. It will compare two pairs using second field
-        Comparator comp_functor =
-            [](std::pair<int, float> node1 ,std::pair<int, float> node2) {
-                return node1.second < node2.second;
-            };
+        // Compute skinning weights.
+        float weight_sum{ 0.f };
+        for (int i = 0; i < num_anchors; ++i) {
+            float geodesic_dist_to_node = dist_to_nearest_geodesic_nodes[i];
 
-        // Declaring a set that will store the pairs using above comparision logic
-        std::set<std::pair<int, float>, Comparator> node_set(
-            node_map.begin(), node_map.end(), comp_functor
-        );
+            float coverage = node_coverages != nullptr ? node_coverages[nearest_geodesic_node_ids[i]] : node_coverage;
+            float weight = compute_anchor_weight(geodesic_dist_to_node, coverage);
+            weight_sum += weight;
 
-        for (auto n : node_set) {
-            nearest_geodesic_node_ids.push_back(n.first);
-            dist_to_nearest_geodesic_nodes.push_back(n.second);
+            skinning_weights[i] = weight;
+        }
 
-            if (nearest_geodesic_node_ids.size() == GRAPH_K) {
-                break;
-            }
+        // Normalize the skinning weights.
+        if (weight_sum > 0) {
+            for (int i = 0; i < num_anchors; i++)
+                skinning_weights[i] /= weight_sum;
+        }
+        else if (num_anchors > 0) {
+            for (int i = 0; i < num_anchors; i++)
+                skinning_weights[i] = 1.f / num_anchors;
+        }
+        
+        // Store the results.
+        for (int i = 0; i < num_anchors; i++) {
+            pixel_anchors[i] = nearest_geodesic_node_ids[i];
+            pixel_weights[i] = skinning_weights[i];
         }
     }
 
@@ -544,65 +960,129 @@ namespace graph_proc {
         pixel_anchors.resize({ height, width, GRAPH_K }, false);
         pixel_weights.resize({ height, width, GRAPH_K }, false);
 
-        for (int y = 0; y < height; y++) {
-            for (int x = 0; x < width; x++) {
-                for (int k = 0; k < GRAPH_K; k++) {
-                    *pixel_anchors.mutable_data(y, x, k) = -1;
-                    *pixel_weights.mutable_data(y, x, k) = 0.f;
+        std::fill(pixel_anchors.mutable_data(), pixel_anchors.mutable_data() + pixel_anchors.size(), -1);
+        std::fill(pixel_weights.mutable_data(), pixel_weights.mutable_data() + pixel_weights.size(), 0.f);
+
+        int num_vertices = vertices.shape(0);
+        int num_nodes = node_to_vertex_distance.shape(0);
+
+        auto distances = node_to_vertex_distance.unchecked<2>();
+        auto valid_nodes = valid_nodes_mask.unchecked<2>();
+        auto pixels = vertex_pixels.unchecked<2>();
+
+        // Vertices are processed in blocks. Every block reads its contiguous part of each node row,
+        // instead of a strided column of node_to_vertex_distance per vertex.
+        const int block_size = 512;
+        int num_blocks = (num_vertices + block_size - 1) / block_size;
+
+        #pragma omp parallel
+        {
+            std::vector<int> nearest_geodesic_node_ids(block_size * GRAPH_K);
+            std::vector<float> dist_to_nearest_geodesic_nodes(block_size * GRAPH_K);
+            std::vector<int> num_nearest(block_size);
+
+            #pragma omp for schedule(dynamic)
+            for (int block_id = 0; block_id < num_blocks; block_id++) {
+                int block_start = block_id * block_size;
+                int num_block_vertices = std::min(block_size, num_vertices - block_start);
+
+                std::fill(num_nearest.begin(), num_nearest.end(), 0);
+
+                // Find closest geodesic nodes
+                for (int n = 0; n < num_nodes; ++n) {
+                    // discard node if it was marked as invalid (due to not having enough neighbors)
+                    if (valid_nodes(n, 0) == false) {
+                        continue;
+                    }
+
+                    const float* node_distances = distances.data(n, block_start);
+                    for (int i = 0; i < num_block_vertices; i++) {
+                        if (node_distances[i] >= 0) {
+                            insert_nearest_geodesic_node(
+                                n, node_distances[i],
+                                &nearest_geodesic_node_ids[i * GRAPH_K], &dist_to_nearest_geodesic_nodes[i * GRAPH_K], num_nearest[i]
+                            );
+                        }
+                    }
+                }
+
+                for (int i = 0; i < num_block_vertices; i++) {
+                    // Get corresponding pixel location
+                    int u = pixels(block_start + i, 0);
+                    int v = pixels(block_start + i, 1);
+
+                    store_geodesic_pixel_anchors(
+                        &nearest_geodesic_node_ids[i * GRAPH_K], &dist_to_nearest_geodesic_nodes[i * GRAPH_K], num_nearest[i], node_coverage, nullptr,
+                        pixel_anchors.mutable_data(v, u, 0), pixel_weights.mutable_data(v, u, 0)
+                    );
                 }
             }
         }
+    }
 
-        int num_vertices = vertices.shape(0);
+    void compute_pixel_anchors_geodesic_sparse(
+        const py::array_t<int> &vertex_node_ids, 
+        const py::array_t<float> &vertex_node_distances, 
+        const py::array_t<int> &valid_nodes_mask, 
+        const py::array_t<float> &vertices,
+        const py::array_t<int> &vertex_pixels, 
+        py::array_t<int>& pixel_anchors, 
+        py::array_t<float>& pixel_weights,
+        const int width, const int height,
+        const float node_coverage,
+        const py::array_t<float>& node_coverages
+    ) {
+        if (node_coverages.size() != 0 && node_coverages.size() != valid_nodes_mask.shape(0)) {
+            throw std::invalid_argument("node_coverages doesn't match the number of nodes");
+        }
+        const float* coverages = node_coverages.size() != 0 ? node_coverages.data() : nullptr;
 
-        for (int vertex_id = 0; vertex_id < num_vertices; vertex_id++) {
-            // Get corresponding pixel location
-            int u = *vertex_pixels.data(vertex_id, 0);
-            int v = *vertex_pixels.data(vertex_id, 1);
-
-            // Initialize some variables
-            std::vector<int> nearest_geodesic_node_ids;
-            std::vector<float> dist_to_nearest_geodesic_nodes;
-            std::vector<float> skinning_weights;
-
-            nearest_geodesic_node_ids.reserve(GRAPH_K);
-            dist_to_nearest_geodesic_nodes.reserve(GRAPH_K);
-            skinning_weights.reserve(GRAPH_K);
-
-            // Find closest geodesic nodes
-            compute_nearest_geodesic_nodes(
-                node_to_vertex_distance, valid_nodes_mask, vertex_id,
-                nearest_geodesic_node_ids, dist_to_nearest_geodesic_nodes
-            );
+        // Allocate graph node ids and corresponding skinning weights.
+        // Initialize with invalid anchors.
+        pixel_anchors.resize({ height, width, GRAPH_K }, false);
+        pixel_weights.resize({ height, width, GRAPH_K }, false);
 
-            int num_anchors = nearest_geodesic_node_ids.size();
+        std::fill(pixel_anchors.mutable_data(), pixel_anchors.mutable_data() + pixel_anchors.size(), -1);
+        std::fill(pixel_weights.mutable_data(), pixel_weights.mutable_data() + pixel_weights.size(), 0.f);
 
-            // Compute skinning weights.
-            float weight_sum{ 0.f };
-            for (int i = 0; i < num_anchors; ++i) {
-                float geodesic_dist_to_node = dist_to_nearest_geodesic_nodes[i];
+        int num_vertices = vertices.shape(0);
+        int num_vertex_nodes = vertex_node_ids.shape(1);
 
-                float weight = compute_anchor_weight(geodesic_dist_to_node, node_coverage);
-                weight_sum += weight;
+        auto node_ids = vertex_node_ids.unchecked<2>();
+        auto node_distances = vertex_node_distances.unchecked<2>();
+        auto valid_nodes = valid_nodes_mask.unchecked<2>();
+        auto pixels = vertex_pixels.unchecked<2>();
 
-                skinning_weights.push_back(weight);
+        // Every vertex writes only its own pixel.
+        #pragma omp parallel for schedule(static, 1024)
+        for (int vertex_id = 0; vertex_id < num_vertices; vertex_id++) {
+            // Get corresponding pixel location
+            int u = pixels(vertex_id, 0);
+            int v = pixels(vertex_id, 1);
+
+            int nearest_geodesic_node_ids[GRAPH_K];
+            float dist_to_nearest_geodesic_nodes[GRAPH_K];
+            int num_nearest = 0;
+
+            // The nodes of the vertex are sorted by distance. As in compute_pixel_anchors_geodesic, 
+            // invalid nodes are skipped and only the first node at a given distance is used.
+            for (int i = 0; i < num_vertex_nodes && num_nearest < GRAPH_K; i++) {
+                int node_id = node_ids(vertex_id, i);
+                float dist = node_distances(vertex_id, i);
+
+                if (node_id < 0 || dist < 0) break;
+                if (valid_nodes(node_id, 0) == false) continue;
+                if (num_nearest > 0 && dist == dist_to_nearest_geodesic_nodes[num_nearest - 1]) continue;
+
+                nearest_geodesic_node_ids[num_nearest] = node_id;
+                dist_to_nearest_geodesic_nodes[num_nearest] = dist;
+                num_nearest++;
             }
 
-            // Normalize the skinning weights.
-            if (weight_sum > 0) {
-                for (int i = 0; i < num_anchors; i++)
-                    skinning_weights[i] /= weight_sum;
-            }
-            else if (num_anchors > 0) {
-                for (int i = 0; i < num_anchors; i++)
-                    skinning_weights[i] = 1.f / num_anchors;
-            }
-            
-            // Store the results.
-            for (int i = 0; i < num_anchors; i++) {
-                *pixel_anchors.mutable_data(v, u, i) = nearest_geodesic_node_ids[i];
-                *pixel_weights.mutable_data(v, u, i) = skinning_weights[i];
-            }
+            store_geodesic_pixel_anchors(
+                nearest_geodesic_node_ids, dist_to_nearest_geodesic_nodes, num_nearest, node_coverage, coverages,
+                pixel_anchors.mutable_data(v, u, 0), pixel_weights.mutable_data(v, u, 0)
+            );
         }
     }
 
@@ -632,64 +1112,45 @@ namespace graph_proc {
             }
         }
 
+        std::vector<Eigen::Vector3f> nodePositions(nNodes);
+        for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+            nodePositions[nodeId] = Eigen::Vector3f(*graphNodes.data(nodeId, 0), *graphNodes.data(nodeId, 1), *graphNodes.data(nodeId, 2));
+        }
+        KdTree nodeTree(nodePositions);
+
+        auto points = pointImage.unchecked<3>();
+
         // Compute anchors for every pixel.
         #pragma omp parallel for
         for (int y = 0; y < height; y++) {
+            std::vector<std::pair<float, int>> nearestNodesWithSquaredDistances;
+            nearestNodesWithSquaredDistances.reserve(GRAPH_K);
+
             for (int x = 0; x < width; x++) {
                 // Query 3d pixel position.
-                Eigen::Vector3f pixelPos(*pointImage.data(0, y, x), *pointImage.data(1, y, x), *pointImage.data(2, y, x));
+                Eigen::Vector3f pixelPos(points(0, y, x), points(1, y, x), points(2, y, x));
                 if (pixelPos.z() <= 0) continue;
                 
-                // Keep only the k nearest Euclidean neighbors.
-                std::list<std::pair<int, float>> nearestNodesWithSquaredDistances;
-
-                for (int nodeId = 0; nodeId < nNodes; nodeId++) {
-                    Eigen::Vector3f nodePos(*graphNodes.data(nodeId, 0), *graphNodes.data(nodeId, 1), *graphNodes.data(nodeId, 2));
-
-                    float distance2 = (pixelPos - nodePos).squaredNorm();
-                    bool bInserted = false;
-                    for (auto it = nearestNodesWithSquaredDistances.begin(); it != nearestNodesWithSquaredDistances.end(); ++it) {
-                        // We insert the element at the first position where its distance is smaller than the other
-                        // element's distance, which enables us to always keep a sorted list of at most k nearest
-                        // neighbors.
-                        if (distance2 <= it->second) {
-                            it = nearestNodesWithSquaredDistances.insert(it, std::make_pair(nodeId, distance2));
-                            bInserted = true;
-                            break;
-                        }
-                    }
-
-                    if (!bInserted && nearestNodesWithSquaredDistances.size() < GRAPH_K) {
-                        nearestNodesWithSquaredDistances.emplace_back(std::make_pair(nodeId, distance2));
-                    }
-
-                    // We keep only the list of k nearest elements.
-                    if (bInserted && nearestNodesWithSquaredDistances.size() > GRAPH_K) {
-                        nearestNodesWithSquaredDistances.pop_back();
-                    }
-                }
+                // Keep only the k nearest Euclidean neighbors, sorted by distance.
+                nodeTree.knn(pixelPos, GRAPH_K, nearestNodesWithSquaredDistances);
 
                 // Compute skinning weights.
-                std::vector<int> nearestEuclideanNodeIds;
-                nearestEuclideanNodeIds.reserve(nearestNodesWithSquaredDistances.size());
-
-                std::vector<float> skinningWeights;
-                skinningWeights.reserve(nearestNodesWithSquaredDistances.size());
+                int nearestEuclideanNodeIds[GRAPH_K];
+                float skinningWeights[GRAPH_K];
+                int nAnchors = nearestNodesWithSquaredDistances.size();
 
                 float weightSum{ 0.f };
-                for (auto it = nearestNodesWithSquaredDistances.begin(); it != nearestNodesWithSquaredDistances.end(); ++it) {
-                    int nodeId = it->first;
+                for (int i = 0; i < nAnchors; i++) {
+                    int nodeId = nearestNodesWithSquaredDistances[i].second;
 
-                    Eigen::Vector3f nodePos(*graphNodes.data(nodeId, 0), *graphNodes.data(nodeId, 1), *graphNodes.data(nodeId, 2));
-                    float weight = compute_anchor_weight(pixelPos, nodePos, nodeCoverage);
+                    float weight = compute_anchor_weight(pixelPos, nodePositions[nodeId], nodeCoverage);
                     weightSum += weight;
 
-                    nearestEuclideanNodeIds.push_back(nodeId);
-                    skinningWeights.push_back(weight);
+                    nearestEuclideanNodeIds[i] = nodeId;
+                    skinningWeights[i] = weight;
                 }
 
                 // Normalize the skinning weights.
-                int nAnchors = nearestEuclideanNodeIds.size();
 
                 if (weightSum > 0) {
                     for (int i = 0; i < nAnchors; i++)	skinningWeights[i] /= weightSum;
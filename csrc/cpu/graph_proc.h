@@ -26,10 +26,50 @@ namespace graph_proc {
         const bool randomShuffle
     );
 
+	/**
+	 * Estimates a node coverage for every vertex from the local surface curvature: a fraction
+	 * (curvatureRadiusRatio) of the radius of curvature, clamped to [minCoverage, maxCoverage].
+	 * The vertex normals are averaged over the vertex neighbors nSmoothingIterations times
+	 * before estimating the curvature, against depth noise.
+	 */
+	py::array_t<float> compute_vertex_coverage(
+		const py::array_t<float>& vertexPositions,
+		const py::array_t<int>& faceIndices,
+		const float minCoverage, const float maxCoverage,
+		const float curvatureRadiusRatio,
+		const int nSmoothingIterations,
+		const py::array_t<int>& neighborOffsets,
+		const py::array_t<int>& neighbors
+	);
+
+	/**
+	 * Same as sample_nodes, with a node coverage per vertex (e.g. from compute_vertex_coverage).
+	 * A vertex is covered by a node closer than the mean of their coverages. The coverage of
+	 * every node is returned in nodeCoverages, to be used for its edges and anchors.
+	 */
+	int sample_nodes_adaptive(
+		const py::array_t<float>& vertexPositions, const py::array_t<bool>& nonErodedVertices,
+		const py::array_t<float>& vertexCoverages,
+		py::array_t<float>& nodePositions, py::array_t<int>& nodeIndices, py::array_t<float>& nodeCoverages,
+		const bool useOnlyValidIndices,
+		const bool randomShuffle
+	);
+
+
+	/**
+	 * Computes the vertex adjacency of a mesh in CSR format: the neighbors of vertex i are
+	 * neighbors[neighborOffsets[i]:neighborOffsets[i + 1]], sorted and unique.
+	 * It can be computed once per mesh and passed to the functions that traverse the mesh.
+	 */
+	void compute_mesh_adjacency(
+		const py::array_t<int>& faceIndices, int nVertices,
+		py::array_t<int>& neighborOffsets, py::array_t<int>& neighbors
+	);
 
 	/**
 	 * Computes the graph edges between nodes, connecting nearest nodes using geodesic
-	 * distances.
+	 * distances. The mesh adjacency is computed from the faces, unless given by
+	 * neighborOffsets/neighbors (from compute_mesh_adjacency).
 	 */
 	void compute_edges_geodesic(
 		const py::array_t<float>& vertexPositions,
@@ -42,7 +82,42 @@ namespace graph_proc {
         py::array_t<float>& graphEdgesDistances,
         py::array_t<float>& nodeToVertexDistances,
         const bool allow_only_valid_vertices,
-        const bool enforce_total_num_neighbors
+        const bool enforce_total_num_neighbors,
+        const py::array_t<int>& neighborOffsets,
+        const py::array_t<int>& neighbors
+	);
+
+	/**
+	 * Same as compute_edges_geodesic, but instead of the dense (nNodes, nVertices) node-to-vertex
+	 * distances it returns the nearest nodes of every vertex, sorted by geodesic distance.
+	 * The number of nodes kept per vertex is given by the second dimension of vertexNodeIds
+	 * (unused entries are -1).
+	 * If nodesToUpdate is given, only the edges of the marked nodes are recomputed (all nodes
+	 * can still be their neighbors), the other rows of graphEdges are left unchanged
+	 * and only the marked nodes are added to the vertex lists.
+	 * If nodeCoverages is given (from sample_nodes_adaptive), every node uses its own coverage
+	 * instead of nodeCoverage.
+	 * If validNodesMask is given, nodes without enough neighbors are marked in it (as node_and_edge_clean_up)
+	 * and left out of the vertex lists, so every vertex keeps its nearest valid nodes.
+	 */
+	void compute_edges_geodesic_sparse(
+		const py::array_t<float>& vertexPositions,
+		const py::array_t<bool>& validVertices, 
+		const py::array_t<int>& faceIndices, 
+		const py::array_t<int>& nodeIndices, 
+		const int nMaxNeighbors, const float nodeCoverage,
+        py::array_t<int>& graphEdges,
+        py::array_t<float>& graphEdgesWeights,
+        py::array_t<float>& graphEdgesDistances,
+        py::array_t<int>& vertexNodeIds,
+        py::array_t<float>& vertexNodeDistances,
+        const bool allow_only_valid_vertices,
+        const bool enforce_total_num_neighbors,
+        const py::array_t<int>& neighborOffsets,
+        const py::array_t<int>& neighbors,
+        const py::array_t<bool>& nodesToUpdate,
+        const py::array_t<float>& nodeCoverages,
+        py::array_t<bool>& validNodesMask
 	);
 
 	/**
@@ -81,6 +156,24 @@ namespace graph_proc {
         const float node_coverage
     );
 
+    /**
+	 * Same as compute_pixel_anchors_geodesic, using the nearest nodes of every vertex from
+	 * compute_edges_geodesic_sparse. If node_coverages is given, the skinning weight of
+	 * every anchor uses the coverage of its node.
+	 */ 
+	void compute_pixel_anchors_geodesic_sparse(
+        const py::array_t<int> &vertex_node_ids, 
+        const py::array_t<float> &vertex_node_distances, 
+        const py::array_t<int> &valid_nodes_mask, 
+        const py::array_t<float> &vertices,
+        const py::array_t<int> &vertex_pixels, 
+        py::array_t<int>& pixel_anchors, 
+        py::array_t<float>& pixel_weights,
+        const int width, const int height,
+        const float node_coverage,
+        const py::array_t<float>& node_coverages
+    );
+
 	/**
 	 * For each input pixel it computes 4 nearest anchors, using Euclidean distances. 
 	 * It also compute skinning weights for every pixel. 
@@ -0,0 +1,184 @@
+#include "cpu/solver_proc.h"
+
+#include <vector>
+
+#include <Eigen/Dense>
+
+using std::vector;
+
+namespace solver_proc {
+
+    template <typename scalar_t>
+    void compute_data_normal_equations_kernel(
+        const scalar_t* rotations, const scalar_t* translations, const scalar_t* graphNodes,
+        const scalar_t* sourcePoints, const scalar_t* targetMatches, const scalar_t* xyPixelsWarped,
+        const scalar_t* correspondenceWeights, const int64_t* sourceAnchors, const scalar_t* sourceWeights,
+        int nNodes, int nMatches,
+        scalar_t fx, scalar_t fy, scalar_t cx, scalar_t cy,
+        scalar_t lambdaDataFlow, scalar_t lambdaDataDepth,
+        scalar_t* resData, scalar_t* JtJ, scalar_t* Jtr
+    ) {
+        using Vec3 = Eigen::Matrix<scalar_t, 3, 1>;
+        using Mat3 = Eigen::Matrix<scalar_t, 3, 3, Eigen::RowMajor>;
+        using MatJ = Eigen::Matrix<scalar_t, 3, 6 * GRAPH_K, Eigen::RowMajor>;
+
+        const scalar_t eps = 1e-7; // Same as the python solver
+        const int nUnknowns = 6 * nNodes;
+
+        // Jacobian rows of every correspondence, columns are [rotation, translation] of every anchor.
+        vector<MatJ, Eigen::aligned_allocator<MatJ>> localJacobians(nMatches);
+
+        #pragma omp parallel for
+        for (int matchId = 0; matchId < nMatches; matchId++) {
+            Vec3 sourcePoint = Eigen::Map<const Vec3>(sourcePoints + 3 * matchId);
+            scalar_t correspondenceWeight = correspondenceWeights[matchId];
+
+            // Deform the source point and keep the rotated points of every anchor for the jacobian.
+            Vec3 rotatedPoints[GRAPH_K];
+            Vec3 deformedPoint = Vec3::Zero();
+            for (int k = 0; k < GRAPH_K; k++) {
+                int64_t nodeId = sourceAnchors[GRAPH_K * matchId + k];
+                Vec3 nodePos = Eigen::Map<const Vec3>(graphNodes + 3 * nodeId);
+                Eigen::Map<const Mat3> R(rotations + 9 * nodeId);
+                Vec3 t = Eigen::Map<const Vec3>(translations + 3 * nodeId);
+
+                rotatedPoints[k] = R * (sourcePoint - nodePos);
+                deformedPoint += sourceWeights[GRAPH_K * matchId + k] * (rotatedPoints[k] + nodePos + t);
+            }
+
+            scalar_t zInverse = scalar_t(1) / (deformedPoint.z() + eps);
+            scalar_t fxDivZ = fx * zInverse;
+            scalar_t fyDivZ = fy * zInverse;
+            scalar_t fxMulXDivZ = fx * deformedPoint.x() * zInverse;
+            scalar_t fyMulYDivZ = fy * deformedPoint.y() * zInverse;
+            scalar_t minusFxMulXDivZ2 = -fxMulXDivZ * zInverse;
+            scalar_t minusFyMulYDivZ2 = -fyMulYDivZ * zInverse;
+
+            // Residuals: flow x, flow y, depth.
+            resData[3 * matchId + 0] = lambdaDataFlow * correspondenceWeight * (fxMulXDivZ + cx - xyPixelsWarped[2 * matchId + 0]);
+            resData[3 * matchId + 1] = lambdaDataFlow * correspondenceWeight * (fyMulYDivZ + cy - xyPixelsWarped[2 * matchId + 1]);
+            resData[3 * matchId + 2] = lambdaDataDepth * correspondenceWeight * (deformedPoint.z() - targetMatches[3 * matchId + 2]);
+
+            MatJ& J = localJacobians[matchId];
+            J.setZero();
+            for (int k = 0; k < GRAPH_K; k++) {
+                scalar_t weight = sourceWeights[GRAPH_K * matchId + k] * correspondenceWeight;
+
+                // Derivative of the deformed point w.r.t. the rotation parameters: -[w * R(p - n)]x
+                Vec3 p = weight * rotatedPoints[k];
+                Mat3 skew;
+                skew <<        0,  p.z(), -p.y(),
+                          -p.z(),      0,  p.x(),
+                           p.y(), -p.x(),      0;
+
+                // Rotation, kept consistent with the python jacobian (lambda_data_flow scales the x/y part).
+                for (int c = 0; c < 3; c++) {
+                    J(0, 6 * k + c) = lambdaDataFlow * fxDivZ * skew(0, c) + minusFxMulXDivZ2 * skew(2, c);
+                    J(1, 6 * k + c) = lambdaDataFlow * fyDivZ * skew(1, c) + minusFyMulYDivZ2 * skew(2, c);
+                    J(2, 6 * k + c) = lambdaDataDepth * skew(2, c);
+                }
+
+                // Translation.
+                J(0, 6 * k + 3) = lambdaDataFlow * weight * fxDivZ;
+                J(0, 6 * k + 5) = lambdaDataFlow * weight * minusFxMulXDivZ2;
+                J(1, 6 * k + 4) = lambdaDataFlow * weight * fyDivZ;
+                J(1, 6 * k + 5) = lambdaDataFlow * weight * minusFyMulYDivZ2;
+                J(2, 6 * k + 5) = lambdaDataDepth * weight;
+            }
+        }
+
+        // List the (correspondence, anchor slot) pairs of every node, in correspondence order.
+        vector<int> nodeOffsets(nNodes + 1, 0);
+        for (int i = 0; i < GRAPH_K * nMatches; i++) {
+            nodeOffsets[sourceAnchors[i] + 1]++;
+        }
+        for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+            nodeOffsets[nodeId + 1] += nodeOffsets[nodeId];
+        }
+        vector<int> nodeEntries(GRAPH_K * nMatches);
+        vector<int> nodeFill(nodeOffsets.begin(), nodeOffsets.end() - 1);
+        for (int i = 0; i < GRAPH_K * nMatches; i++) {
+            nodeEntries[nodeFill[sourceAnchors[i]]++] = i;
+        }
+
+        // Every node accumulates its own rows of J^TJ and J^Tr, so no two threads write the same entry.
+        #pragma omp parallel for schedule(dynamic, 8)
+        for (int nodeId = 0; nodeId < nNodes; nodeId++) {
+            // Rows of the node in the system: rotation, then translation.
+            int rows[6] = { 3 * nodeId, 3 * nodeId + 1, 3 * nodeId + 2, 3 * nNodes + 3 * nodeId, 3 * nNodes + 3 * nodeId + 1, 3 * nNodes + 3 * nodeId + 2 };
+
+            for (int e = nodeOffsets[nodeId]; e < nodeOffsets[nodeId + 1]; e++) {
+                int matchId = nodeEntries[e] / GRAPH_K;
+                int k = nodeEntries[e] % GRAPH_K;
+
+                const MatJ& J = localJacobians[matchId];
+                Eigen::Matrix<scalar_t, 6, 3> JkT = J.template block<3, 6>(0, 6 * k).transpose();
+
+                Eigen::Matrix<scalar_t, 6, 1> JtrK = JkT * Eigen::Map<const Vec3>(resData + 3 * matchId);
+                for (int i = 0; i < 6; i++) {
+                    Jtr[rows[i]] += JtrK(i);
+                }
+
+                for (int l = 0; l < GRAPH_K; l++) {
+                    int64_t otherNodeId = sourceAnchors[GRAPH_K * matchId + l];
+                    Eigen::Matrix<scalar_t, 6, 6> block = JkT * J.template block<3, 6>(0, 6 * l);
+
+                    for (int i = 0; i < 6; i++) {
+                        scalar_t* rowPtr = JtJ + int64_t(rows[i]) * nUnknowns;
+                        for (int c = 0; c < 3; c++) {
+                            rowPtr[3 * otherNodeId + c] += block(i, c);
+                            rowPtr[3 * nNodes + 3 * otherNodeId + c] += block(i, 3 + c);
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    std::vector<torch::Tensor> compute_data_normal_equations(
+        const torch::Tensor& rotations, const torch::Tensor& translations, const torch::Tensor& graphNodes,
+        const torch::Tensor& sourcePoints, const torch::Tensor& targetMatches, const torch::Tensor& xyPixelsWarped,
+        const torch::Tensor& correspondenceWeights, const torch::Tensor& sourceAnchors, const torch::Tensor& sourceWeights,
+        double fx, double fy, double cx, double cy,
+        double lambdaDataFlow, double lambdaDataDepth
+    ) {
+        TORCH_CHECK(rotations.device().is_cpu(), "compute_data_normal_equations only supports CPU tensors");
+        TORCH_CHECK(sourceAnchors.size(1) == GRAPH_K, "Expected ", GRAPH_K, " anchors per correspondence");
+
+        int nNodes = rotations.size(0);
+        int nMatches = sourcePoints.size(0);
+        auto scalarType = rotations.scalar_type();
+
+        auto R = rotations.contiguous();
+        auto t = translations.to(scalarType).contiguous();
+        auto nodes = graphNodes.to(scalarType).contiguous();
+        auto source = sourcePoints.to(scalarType).contiguous();
+        auto target = targetMatches.to(scalarType).contiguous();
+        auto xy = xyPixelsWarped.to(scalarType).contiguous();
+        auto correspondenceW = correspondenceWeights.to(scalarType).contiguous();
+        auto anchors = sourceAnchors.to(torch::kLong).contiguous();
+        auto anchorW = sourceWeights.to(scalarType).contiguous();
+
+        TORCH_CHECK(nMatches == 0 || (anchors.min().item<int64_t>() >= 0 && anchors.max().item<int64_t>() < nNodes), "Invalid source anchors");
+
+        auto options = torch::TensorOptions().dtype(scalarType);
+        torch::Tensor resData = torch::zeros({ 3 * nMatches, 1 }, options);
+        torch::Tensor JtJ = torch::zeros({ 6 * nNodes, 6 * nNodes }, options);
+        torch::Tensor Jtr = torch::zeros({ 6 * nNodes, 1 }, options);
+
+        AT_DISPATCH_FLOATING_TYPES(scalarType, "compute_data_normal_equations", ([&] {
+            compute_data_normal_equations_kernel<scalar_t>(
+                R.data_ptr<scalar_t>(), t.data_ptr<scalar_t>(), nodes.data_ptr<scalar_t>(),
+                source.data_ptr<scalar_t>(), target.data_ptr<scalar_t>(), xy.data_ptr<scalar_t>(),
+                correspondenceW.data_ptr<scalar_t>(), anchors.data_ptr<int64_t>(), anchorW.data_ptr<scalar_t>(),
+                nNodes, nMatches,
+                scalar_t(fx), scalar_t(fy), scalar_t(cx), scalar_t(cy),
+                scalar_t(lambdaDataFlow), scalar_t(lambdaDataDepth),
+                resData.data_ptr<scalar_t>(), JtJ.data_ptr<scalar_t>(), Jtr.data_ptr<scalar_t>()
+            );
+        }));
+
+        return { resData, JtJ, Jtr };
+    }
+
+} // namespace solver_proc
@@ -0,0 +1,29 @@
+#pragma once
+
+#include <torch/extension.h>
+#include <pybind11/stl.h>
+#include <pybind11/pybind11.h>
+
+#ifndef GRAPH_K
+#define GRAPH_K 4
+#endif
+
+namespace solver_proc {
+
+    /**
+	 * Computes the data term of the Gauss-Newton solver in one pass over the correspondences.
+	 * Every correspondence is deformed by its GRAPH_K anchors, giving 3 residuals (flow x, flow y, depth),
+	 * and its jacobian rows are accumulated into the normal equations J^TJ and J^Tr directly,
+	 * without building the dense (num_matches*3, num_nodes*6) jacobian.
+	 * Unknowns are ordered as in the python solver: all node rotations, then all node translations.
+	 * Returns [res_data (num_matches*3, 1), JtJ (num_nodes*6, num_nodes*6), Jtr (num_nodes*6, 1)].
+	 */
+	std::vector<torch::Tensor> compute_data_normal_equations(
+		const torch::Tensor& rotations, const torch::Tensor& translations, const torch::Tensor& graphNodes,
+		const torch::Tensor& sourcePoints, const torch::Tensor& targetMatches, const torch::Tensor& xyPixelsWarped,
+		const torch::Tensor& correspondenceWeights, const torch::Tensor& sourceAnchors, const torch::Tensor& sourceWeights,
+		double fx, double fy, double cx, double cy,
+		double lambdaDataFlow, double lambdaDataDepth
+	);
+
+} // namespace solver_proc
@@ -0,0 +1,180 @@
+#pragma once
+
+#include <cmath>
+#include <cstdint>
+#include <vector>
+#include <numeric>
+#include <algorithm>
+#include <unordered_map>
+
+#include <Eigen/Dense>
+
+namespace graph_proc {
+
+    /**
+     * Uniform grid of cubic cells hashing 3D points, used to find all points within a radius
+     * not larger than the cell size by looking only at the 27 cells around a query position.
+     */
+    class PointGrid {
+    public:
+        explicit PointGrid(float cellSize) : m_cellSize(cellSize) {}
+
+        Eigen::Vector3i cellOf(const Eigen::Vector3f& point) const {
+            return Eigen::Vector3i(
+                int(std::floor(point.x() / m_cellSize)),
+                int(std::floor(point.y() / m_cellSize)),
+                int(std::floor(point.z() / m_cellSize))
+            );
+        }
+
+        void insert(const Eigen::Vector3f& point, int pointIdx) {
+            m_cells[cellKey(cellOf(point))].emplace_back(point, pointIdx);
+        }
+
+        /**
+         * Returns true if any inserted point is within sqrt(radius2) of the query point.
+         * radius2 must not be larger than the squared cell size.
+         */
+        bool containsPointWithin(const Eigen::Vector3f& point, float radius2) const {
+            return containsPointIf(point, [&](const Eigen::Vector3f& gridPoint, int) {
+                return (point - gridPoint).squaredNorm() <= radius2;
+            });
+        }
+
+        /**
+         * Returns true if predicate(position, pointIdx) holds for any inserted point in the 27 cells around
+         * the query point, i.e. for any point it can accept within the cell size.
+         */
+        template <typename Predicate>
+        bool containsPointIf(const Eigen::Vector3f& point, Predicate&& predicate) const {
+            Eigen::Vector3i cell = cellOf(point);
+
+            for (int dx = -1; dx <= 1; dx++) {
+                for (int dy = -1; dy <= 1; dy++) {
+                    for (int dz = -1; dz <= 1; dz++) {
+                        auto it = m_cells.find(cellKey(cell + Eigen::Vector3i(dx, dy, dz)));
+                        if (it == m_cells.end()) continue;
+
+                        for (const auto& entry : it->second) {
+                            if (predicate(entry.first, entry.second)) return true;
+                        }
+                    }
+                }
+            }
+
+            return false;
+        }
+
+    private:
+        // 21 bits per axis, cells that collide only add candidates that are then rejected by distance.
+        static int64_t cellKey(const Eigen::Vector3i& cell) {
+            return ((int64_t(cell.x()) & 0x1FFFFF) << 42) | ((int64_t(cell.y()) & 0x1FFFFF) << 21) | (int64_t(cell.z()) & 0x1FFFFF);
+        }
+
+        float m_cellSize;
+        std::unordered_map<int64_t, std::vector<std::pair<Eigen::Vector3f, int>>> m_cells;
+    };
+
+    /**
+     * Static kd-tree over 3D points for exact k nearest neighbor queries.
+     * Neighbors are returned as (squared distance, point index) pairs sorted by increasing distance,
+     * points at equal distance being ordered by decreasing index (as the sorted insertion it replaces).
+     */
+    class KdTree {
+    public:
+        explicit KdTree(const std::vector<Eigen::Vector3f>& points, int leafSize = 8) : m_points(points), m_leafSize(leafSize) {
+            m_indices.resize(m_points.size());
+            std::iota(m_indices.begin(), m_indices.end(), 0);
+            if (!m_points.empty()) build(0, m_points.size());
+        }
+
+        void knn(const Eigen::Vector3f& query, int k, std::vector<std::pair<float, int>>& neighbors, int excludedIdx = -1) const {
+            neighbors.clear();
+            if (k <= 0 || m_nodes.empty()) return;
+
+            search(0, query, k, excludedIdx, neighbors);
+            std::sort_heap(neighbors.begin(), neighbors.end(), isCloser);
+        }
+
+    private:
+        struct TreeNode {
+            int begin, end;         // range of m_indices
+            int axis;               // -1 for leaves
+            float split;
+            int left, right;
+        };
+
+        // Strict ordering of candidates, closer first.
+        static bool isCloser(const std::pair<float, int>& a, const std::pair<float, int>& b) {
+            return a.first < b.first || (a.first == b.first && a.second > b.second);
+        }
+
+        int build(int begin, int end) {
+            int nodeIdx = m_nodes.size();
+            m_nodes.push_back({ begin, end, -1, 0.f, -1, -1 });
+            if (end - begin <= m_leafSize) return nodeIdx;
+
+            // Split at the median of the axis with the largest extent.
+            Eigen::Vector3f minPos = m_points[m_indices[begin]], maxPos = minPos;
+            for (int i = begin + 1; i < end; i++) {
+                minPos = minPos.cwiseMin(m_points[m_indices[i]]);
+                maxPos = maxPos.cwiseMax(m_points[m_indices[i]]);
+            }
+            int axis;
+            (maxPos - minPos).maxCoeff(&axis);
+
+            int mid = begin + (end - begin) / 2;
+            std::nth_element(m_indices.begin() + begin, m_indices.begin() + mid, m_indices.begin() + end, [&](int a, int b) {
+                return m_points[a][axis] < m_points[b][axis];
+            });
+
+            m_nodes[nodeIdx].axis = axis;
+            m_nodes[nodeIdx].split = m_points[m_indices[mid]][axis];
+            int left = build(begin, mid);
+            int right = build(mid, end);
+            m_nodes[nodeIdx].left = left;
+            m_nodes[nodeIdx].right = right;
+            return nodeIdx;
+        }
+
+        void search(int nodeIdx, const Eigen::Vector3f& query, int k, int excludedIdx, std::vector<std::pair<float, int>>& heap) const {
+            const TreeNode& node = m_nodes[nodeIdx];
+
+            if (node.axis < 0) {
+                for (int i = node.begin; i < node.end; i++) {
+                    int pointIdx = m_indices[i];
+                    if (pointIdx == excludedIdx) continue;
+
+                    std::pair<float, int> candidate((query - m_points[pointIdx]).squaredNorm(), pointIdx);
+                    if (int(heap.size()) < k) {
+                        heap.push_back(candidate);
+                        std::push_heap(heap.begin(), heap.end(), isCloser);
+                    }
+                    else if (isCloser(candidate, heap.front())) {
+                        std::pop_heap(heap.begin(), heap.end(), isCloser);
+                        heap.back() = candidate;
+                        std::push_heap(heap.begin(), heap.end(), isCloser);
+                    }
+                }
+                return;
+            }
+
+            float diff = query[node.axis] - node.split;
+            int nearChild = diff < 0 ? node.left : node.right;
+            int farChild = diff < 0 ? node.right : node.left;
+
+            search(nearChild, query, k, excludedIdx, heap);
+
+            // Points at the same distance as the current k-th neighbor can still replace it, only prune farther ones.
+            if (int(heap.size()) < k || diff * diff <= heap.front().first) {
+                search(farChild, query, k, excludedIdx, heap);
+            }
+        }
+
+        std::vector<Eigen::Vector3f> m_points;
+        std::vector<int> m_indices;
+        std::vector<TreeNode> m_nodes;
+        int m_leafSize;
+    };
+
+} // namespace graph_proc
\ No newline at end of file
@@ -2,6 +2,7 @@
 
 #include "cpu/image_proc.h"
 #include "cpu/graph_proc.h"
+#include "cpu/solver_proc.h"
 
 // Definitions of all methods in the module.
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
@@ -29,12 +30,45 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
 
   m.def("erode_mesh", &graph_proc::erode_mesh, "Erode mesh");
   m.def("sample_nodes", &graph_proc::sample_nodes, "Samples graph nodes that cover given vertices");
-  m.def("compute_edges_geodesic", &graph_proc::compute_edges_geodesic, "Computes geodesic edges between given graph nodes");
+  m.def("compute_vertex_coverage", &graph_proc::compute_vertex_coverage, "Computes a curvature adaptive node coverage for every vertex",
+    py::arg("vertex_positions"), py::arg("face_indices"),
+    py::arg("min_coverage"), py::arg("max_coverage"),
+    py::arg("curvature_radius_ratio"), py::arg("n_smoothing_iterations"),
+    py::arg("neighbor_offsets") = py::array_t<int>(), py::arg("neighbors") = py::array_t<int>());
+  m.def("sample_nodes_adaptive", &graph_proc::sample_nodes_adaptive, "Samples graph nodes that cover given vertices, with a node coverage per vertex",
+    py::arg("vertex_positions"), py::arg("non_eroded_vertices"), py::arg("vertex_coverages"),
+    py::arg("node_positions"), py::arg("node_indices"), py::arg("node_coverages"),
+    py::arg("use_only_valid_indices"), py::arg("random_shuffle"));
+  m.def("compute_mesh_adjacency", &graph_proc::compute_mesh_adjacency, "Computes the vertex adjacency of a mesh in CSR format");
+  m.def("compute_edges_geodesic", &graph_proc::compute_edges_geodesic, "Computes geodesic edges between given graph nodes",
+    py::arg("vertex_positions"), py::arg("valid_vertices"), py::arg("face_indices"), py::arg("node_indices"),
+    py::arg("n_max_neighbors"), py::arg("node_coverage"),
+    py::arg("graph_edges"), py::arg("graph_edges_weights"), py::arg("graph_edges_distances"),
+    py::arg("node_to_vertex_distances"),
+    py::arg("allow_only_valid_vertices"), py::arg("enforce_total_num_neighbors"),
+    py::arg("neighbor_offsets") = py::array_t<int>(), py::arg("neighbors") = py::array_t<int>());
+  m.def("compute_edges_geodesic_sparse", &graph_proc::compute_edges_geodesic_sparse, "Computes geodesic edges between given graph nodes, and the nearest nodes of every vertex",
+    py::arg("vertex_positions"), py::arg("valid_vertices"), py::arg("face_indices"), py::arg("node_indices"),
+    py::arg("n_max_neighbors"), py::arg("node_coverage"),
+    py::arg("graph_edges"), py::arg("graph_edges_weights"), py::arg("graph_edges_distances"),
+    py::arg("vertex_node_ids"), py::arg("vertex_node_distances"),
+    py::arg("allow_only_valid_vertices"), py::arg("enforce_total_num_neighbors"),
+    py::arg("neighbor_offsets") = py::array_t<int>(), py::arg("neighbors") = py::array_t<int>(),
+    py::arg("nodes_to_update") = py::array_t<bool>(), py::arg("node_coverages") = py::array_t<float>(),
+    py::arg("valid_nodes_mask") = py::array_t<bool>());
   m.def("compute_edges_euclidean", &graph_proc::compute_edges_euclidean, "Computes Euclidean edges between given graph nodes");
   m.def("node_and_edge_clean_up", &graph_proc::node_and_edge_clean_up, "Removes invalid nodes");
   m.def("compute_clusters", &graph_proc::compute_clusters, "Computes graph node clusters");
   m.def("compute_pixel_anchors_geodesic", &graph_proc::compute_pixel_anchors_geodesic, "Computes anchor ids and skinning weights for every pixel using graph connectivity");
+  m.def("compute_pixel_anchors_geodesic_sparse", &graph_proc::compute_pixel_anchors_geodesic_sparse, "Computes anchor ids and skinning weights for every pixel using the nearest geodesic nodes of every vertex",
+    py::arg("vertex_node_ids"), py::arg("vertex_node_distances"), py::arg("valid_nodes_mask"),
+    py::arg("vertices"), py::arg("vertex_pixels"),
+    py::arg("pixel_anchors"), py::arg("pixel_weights"),
+    py::arg("width"), py::arg("height"), py::arg("node_coverage"),
+    py::arg("node_coverages") = py::array_t<float>());
   m.def("compute_pixel_anchors_euclidean", &graph_proc::compute_pixel_anchors_euclidean, "Computes anchor ids and skinning weights for every pixel using Euclidean distances");
   m.def("update_pixel_anchors", &graph_proc::update_pixel_anchors, "Updates pixel anchor after node id change");
   m.def("construct_regular_graph", &graph_proc::construct_regular_graph, "Samples graph uniformly in pixel space, and computes pixel anchors");
+
+  m.def("compute_data_normal_equations", &solver_proc::compute_data_normal_equations, "Computes the data residuals and their normal equations (J^TJ, J^Tr) of the Gauss-Newton solver");
 }
\ No newline at end of file
@@ -19,11 +19,12 @@ from utils import utils, image_proc
 import utils.viz_utils as viz_utils
 from NeuralNRT._C import compute_mesh_from_depth_and_flow as compute_mesh_from_depth_and_flow_c
 from NeuralNRT._C import compute_mesh_from_depth as compute_mesh_from_depth_c
+from NeuralNRT._C import compute_mesh_adjacency as compute_mesh_adjacency_c
 from NeuralNRT._C import erode_mesh as erode_mesh_c
 from NeuralNRT._C import sample_nodes as sample_nodes_c
-from NeuralNRT._C import compute_edges_geodesic as compute_edges_geodesic_c
-from NeuralNRT._C import node_and_edge_clean_up as node_and_edge_clean_up_c
+from NeuralNRT._C import compute_edges_geodesic_sparse as compute_edges_geodesic_sparse_c
 from NeuralNRT._C import compute_pixel_anchors_geodesic as compute_pixel_anchors_geodesic_c
+from NeuralNRT._C import compute_pixel_anchors_geodesic_sparse as compute_pixel_anchors_geodesic_sparse_c
 from NeuralNRT._C import compute_clusters as compute_clusters_c
 from NeuralNRT._C import update_pixel_anchors as update_pixel_anchors_c
 
@@ -51,6 +52,7 @@ def create_graph_data_using_depth(depth_image_path, max_triangle_distance=0.05,
 
 	# Pixel anchors
 	NEIGHBORHOOD_DEPTH = 2
+	NUM_VERTEX_NODES = 4 # nearest valid geodesic nodes kept per vertex (the pixel anchors)
 
 	MIN_CLUSTER_SIZE = 3
 	MIN_NUM_NEIGHBORS = 2
@@ -129,6 +131,11 @@ def create_graph_data_using_depth(depth_image_path, max_triangle_distance=0.05,
 
 	assert num_vertices > 0 and num_faces > 0
 
+	# Vertex adjacency of the mesh, computed once and reused by the geodesic computations.
+	neighbor_offsets = np.zeros((0), dtype=np.int32)
+	neighbors = np.zeros((0), dtype=np.int32)
+	compute_mesh_adjacency_c(faces, num_vertices, neighbor_offsets, neighbors)
+
 	# Erode mesh, to not sample unstable nodes on the mesh boundary.
 	non_eroded_vertices = erode_mesh_c(
 		vertices, faces, EROSION_NUM_ITERATIONS, EROSION_MIN_NEIGHBORS
@@ -178,27 +185,29 @@ def create_graph_data_using_depth(depth_image_path, max_triangle_distance=0.05,
 	graph_edges = -np.ones((num_nodes, NUM_NEIGHBORS), dtype=np.int32)
 	graph_edges_weights = np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
 	graph_edges_distances = np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
-	node_to_vertex_distances = -np.ones((num_nodes, num_vertices), dtype=np.float32)
+	vertex_node_ids = -np.ones((num_vertices, NUM_VERTEX_NODES), dtype=np.int32)
+	vertex_node_distances = -np.ones((num_vertices, NUM_VERTEX_NODES), dtype=np.float32)
 
 	visible_vertices = np.ones_like(valid_vertices)
 
-	compute_edges_geodesic_c(
+	# Nodes with not enough neighbors are marked in valid_nodes_mask and are not kept as nearest nodes of the vertices
+	valid_nodes_mask = np.ones((num_nodes, 1), dtype=bool)
+
+	compute_edges_geodesic_sparse_c(
 		vertices, visible_vertices, faces, node_indices,
 		NUM_NEIGHBORS, NODE_COVERAGE,
 		graph_edges, graph_edges_weights, graph_edges_distances,
-		node_to_vertex_distances,
+		vertex_node_ids, vertex_node_distances,
 		USE_ONLY_VALID_VERTICES,
-		ENFORCE_TOTAL_NUM_NEIGHBORS
+		ENFORCE_TOTAL_NUM_NEIGHBORS,
+		neighbor_offsets, neighbors,
+		valid_nodes_mask=valid_nodes_mask if REMOVE_NODES_WITH_NOT_ENOUGH_NEIGHBORS else np.zeros((0, 1), dtype=bool)
 	)
 
 	# Remove nodes 
-	valid_nodes_mask = np.ones((num_nodes, 1), dtype=bool)
 	node_id_black_list = []
 
 	if REMOVE_NODES_WITH_NOT_ENOUGH_NEIGHBORS:
-		# Mark nodes with not enough neighbors
-		node_and_edge_clean_up_c(graph_edges, valid_nodes_mask)
-
 		# Get the list of invalid nodes
 		node_id_black_list = np.where(valid_nodes_mask == False)[0].tolist()
 	else:
@@ -213,8 +222,8 @@ def create_graph_data_using_depth(depth_image_path, max_triangle_distance=0.05,
 	pixel_anchors = np.zeros((0), dtype=np.int32)
 	pixel_weights = np.zeros((0), dtype=np.float32)
 
-	compute_pixel_anchors_geodesic_c(
-		node_to_vertex_distances, valid_nodes_mask,
+	compute_pixel_anchors_geodesic_sparse_c(
+		vertex_node_ids, vertex_node_distances, valid_nodes_mask,
 		vertices, vertex_pixels,
 		pixel_anchors, pixel_weights,
 		width, height, NODE_COVERAGE
@@ -468,6 +477,10 @@ def update_graph(new_verts, graph_data,min_neighbours=3,plot_update=False):
 	nn_weights /= np.sum(nn_weights, axis=1, keepdims=True)
 	graph_data["graph_edges_weights"] = np.concatenate([graph_data["graph_edges_weights"], nn_weights], axis=0)
 
+	# New nodes are sampled with node_coverage
+	if graph_data.get("node_coverages") is not None:
+		graph_data["node_coverages"] = np.concatenate([graph_data["node_coverages"], np.full(len(new_node_list), graph_data["node_coverage"], dtype=np.float32)])
+
 	graph_data["num_nodes"] = np.array(graph_data["graph_nodes"].shape[0], dtype=np.int64) 
 
 	graph_data["graph_clusters"] = -np.ones((graph_data["graph_edges"].shape[0], 1), dtype=np.int32)
@@ -548,6 +561,8 @@ def remove_nodes(graph_data,unwanted_nodes):
 	wanted_nodes = [  i for i in range(graph_data["num_nodes"]) if i not in unwanted_nodes ]	
 	graph_data["graph_nodes"] = graph_data["graph_nodes"][wanted_nodes]		
 	graph_data["graph_clusters"]			= graph_data["graph_clusters"][wanted_nodes]
+	if graph_data.get("node_coverages") is not None:
+		graph_data["node_coverages"]		= graph_data["node_coverages"][wanted_nodes]
 
 	unwanted_node_count = 0
 	for i in range(unwanted_nodes[0],graph_data["num_nodes"]):
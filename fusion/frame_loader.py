@@ -10,6 +10,7 @@ from scipy.io import loadmat
 from model import dataset
 import options as opt
 from utils import image_proc
+from utils.utils import load_graph_node_coverages
 
 # Modules for Fusion
 from create_graph_data_using_depth import create_graph_data_using_depth
@@ -57,13 +58,19 @@ class RGBDVideoLoader:
 				file_data = file[:-4].split('_')
 				if len(file_data) == 4: # Using our setting frame_<frame_index>_geodesic_<node_coverage>.bin
 					frame_index = int(file_data[1])
-					node_coverage = float(file_data[-1])
 				elif len(file_data) == 6: # Using name setting used by authors <random_str>_<Obj-Name>_<Source-Frame-Index>_<Target-Frame-Index>_geodesic_<Node-Coverage>.bin
 					frame_index = int(file_data[2])
-					node_coverage = float(file_data[-1])
 				else:
 					raise NotImplementedError(f"Unable to understand file:{file} to get graph data")
 
+				# Adaptive node sampling: <...>_adaptive_<Min-Node-Coverage>-<Max-Node-Coverage>.bin, every node has its own coverage 
+				if file_data[-2] == "adaptive":
+					node_coverage = float(file_data[-1].split('-')[1])
+					node_coverages_path = os.path.join(seq_dir, "graph_node_coverages", file)
+				else:	
+					node_coverage = float(file_data[-1])
+					node_coverages_path = None
+
 				self.graph_dicts[frame_index] = {}
 				self.graph_dicts[frame_index]["graph_nodes_path"]             = os.path.join(seq_dir, "graph_nodes",        file)
 				self.graph_dicts[frame_index]["graph_edges_path"]             = os.path.join(seq_dir, "graph_edges",        file)
@@ -72,6 +79,7 @@ class RGBDVideoLoader:
 				self.graph_dicts[frame_index]["pixel_anchors_path"]           = os.path.join(seq_dir, "pixel_anchors",      file)
 				self.graph_dicts[frame_index]["pixel_weights_path"]           = os.path.join(seq_dir, "pixel_weights",      file)
 				self.graph_dicts[frame_index]["node_coverage"] 		          = node_coverage
+				self.graph_dicts[frame_index]["graph_node_coverages_path"]    = node_coverages_path
 
 		self.savepath = os.path.join(self.seq_dir,"results")
 		if not os.path.isdir(self.savepath):
@@ -162,6 +170,11 @@ class RGBDVideoLoader:
 
 		num_nodes = np.array(graph_nodes.shape[0], dtype=np.int64)	
 
+		# Coverage of every node (adaptive node sampling), None if all nodes use node_coverage 
+		node_coverages = None
+		if graph_path_dict.get("graph_node_coverages_path") is not None:
+			node_coverages = load_graph_node_coverages(graph_path_dict["graph_node_coverages_path"])
+
 		graph_dict = {}
 		graph_dict["graph_nodes"]				= graph_nodes
 		graph_dict["graph_edges"]				= graph_edges
@@ -171,6 +184,7 @@ class RGBDVideoLoader:
 		graph_dict["pixel_anchors"]				= pixel_anchors
 		graph_dict["num_nodes"]					= num_nodes
 		graph_dict["node_coverage"]				= graph_path_dict["node_coverage"]
+		graph_dict["node_coverages"]			= node_coverages
 		graph_dict["graph_neighbours"]			= min(len(graph_nodes),4) 
 		return graph_dict
 
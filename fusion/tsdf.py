@@ -23,11 +23,11 @@ except Exception as err:
 
 # CPU module imports
 from pykdtree.kdtree import KDTree as KDTreeCPU
-from dq3d import quat
 
 # Modules
 sys.path.append("../")
 import options as opt
+from utils import dual_quaternion
 
 
 torch.cuda.init()  # any torch cuda initialization before pycuda calls, torch.randn(10).cuda() works too
@@ -619,14 +619,21 @@ class WarpField:
 
 		points = points.astype(np.float32)
 
-		quaternions = np.array([quat(rot).data for rot in rotations], dtype=np.float32)
+		quaternions = dual_quaternion.rotation_to_quaternion(rotations).astype(np.float32) # (w,x,y,z) as read by deform_world_points_dqs
 		
 		dist, world_anchors = self.kdtree.query(points, k=self.graph_neighbours)
+
+		# With adaptive node sampling every anchor uses its own node coverage
+		if self.graph_dict.get("node_coverages") is not None:
+			node_coverage = self.graph_dict["node_coverages"][world_anchors.astype(np.int64)]
+		else:
+			node_coverage = self.graph_dict["node_coverage"]
+
 		# Removes miss alignments but reduces new surface from being added
-		dist[dist > 2*self.graph_dict["node_coverage"]] = np.inf
+		dist[dist > 2*node_coverage] = np.inf
 
 
-		world_weights = np.exp(-dist**2 / (2.0 * (self.graph_dict["node_coverage"]**2)))  # Without normalization
+		world_weights = np.exp(-dist**2 / (2.0 * (node_coverage**2)))  # Without normalization
 		if self.graph_neighbours == 1:
 			world_anchors = world_anchors.reshape(-1, 1)
 			world_weights = world_weights.reshape(-1, 1)
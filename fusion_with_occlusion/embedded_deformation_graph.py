@@ -8,6 +8,7 @@ from timeit import default_timer as timer
 import re
 
 from queue import PriorityQueue # For finding geodesic distance 
+from pykdtree.kdtree import KDTree as KDTreeCPU
 
 
 
@@ -18,7 +19,7 @@ from utils import utils
 # Neural Tracking C compiled modules
 from NeuralNRT._C import erode_mesh as erode_mesh_c
 from NeuralNRT._C import sample_nodes as sample_nodes_c
-from NeuralNRT._C import compute_edges_geodesic as compute_edges_geodesic_c
+from NeuralNRT._C import compute_edges_geodesic_sparse as compute_edges_geodesic_sparse_c
 from NeuralNRT._C import node_and_edge_clean_up as node_and_edge_clean_up_c
 from NeuralNRT._C import compute_clusters as compute_clusters_c
 
@@ -33,6 +34,10 @@ class EDGraph:
         self.opt = tsdf.fopt
         self.load_graph_config()        
 
+        # Incremented whenever the nodes, edges or clusters change. 
+        # Lets consumers (e.g. device copies in run_model) know the graph changed without comparing the arrays
+        self.version = 0
+
         # create_graph_from_tsdf
         self.tsdf = tsdf
         self.vis = visualizer
@@ -63,6 +68,7 @@ class EDGraph:
                 'node_coverage'         : 0.05, # Sampling parameter which defines the number of nodes
                 'min_neighbours'        : 2,    # Find minimum nunber of neighbours that must be present for ech node     
                 'num_neighbours'        : 8,    # Maximum number of neighbours
+                'merge_node_ratio'      : 0.5,  # Nodes closer than merge_node_ratio*node_coverage are merged during graph pruning
                 'require_mask'          : True,
                 }
 
@@ -202,15 +208,17 @@ class EDGraph:
         graph_edges              = -np.ones((num_nodes, NUM_NEIGHBORS), dtype=np.int32)
         graph_edges_weights      =  np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
         graph_edges_distances    =  np.zeros((num_nodes, NUM_NEIGHBORS), dtype=np.float32)
-        node_to_vertex_distances = -np.ones((num_nodes, num_vertices), dtype=np.float32)
+        # Node-to-vertex distances are not used, keep none of them (avoids allocating num_nodes x num_vertices)
+        vertex_node_ids          = -np.ones((num_vertices, 0), dtype=np.int32)
+        vertex_node_distances    = -np.ones((num_vertices, 0), dtype=np.float32)
 
         visible_vertices = np.ones_like(valid_vertices)
 
-        compute_edges_geodesic_c(
+        compute_edges_geodesic_sparse_c(
             vertices, visible_vertices, faces, node_indices, 
             NUM_NEIGHBORS, NODE_COVERAGE, 
             graph_edges, graph_edges_weights, graph_edges_distances,
-            node_to_vertex_distances,
+            vertex_node_ids, vertex_node_distances,
             USE_ONLY_VALID_VERTICES,
             ENFORCE_TOTAL_NUM_NEIGHBORS
         )
@@ -221,6 +229,7 @@ class EDGraph:
         self.edges           = graph_edges 
         self.edges_weights   = graph_edges_weights 
         self.edges_distances = graph_edges_distances
+        self.edges_canonical_model = (vertices.astype(np.float32), faces.astype(np.int64)) # Model the edges were computed on, see find_nodes_near_changed_surface
         self.clusters = -np.ones((graph_edges.shape[0], 1), dtype=np.int32) # Will be calculated later 
 
         # self.node_to_vertex_distances = node_to_vertex_distances # Not required except for edge calculatation    
@@ -233,6 +242,12 @@ class EDGraph:
 
     
     def remove_nodes_with_not_enough_neighbours(self):    
+        """
+            Remove nodes with less than min_neighbours valid neighbours from the graph
+
+            @returns: 
+                valid_nodes_mask: (N) np.ndarray (bool): Nodes kept in the graph 
+        """
 
         # Cluster nodes in graph
         NEIGHBORHOOD_DEPTH = 2
@@ -262,12 +277,15 @@ class EDGraph:
         self.edges_weights   = reduced_graph_dict["graph_edges_weights"] 
         self.edges_distances = reduced_graph_dict["graph_edges_distances"]                  
         self.clusters  = reduced_graph_dict["graph_clusters"] 
-        self.num_nodes = np.array(num_nodes, dtype=np.int64)
+        self.num_nodes = np.array(self.nodes.shape[0], dtype=np.int64)
+        self.version += 1
         # self.node_to_vertex_distances = reduced_graph_dict["node_to_vertex_distances"] # Not required 
 
 
         # Done manually only at the start 
-        self.node_indices    = self.node_indices[reduced_graph_dict["valid_nodes_mask"]] # Which vertex correspondes to graph node
+        self.node_indices    = self.node_indices[reduced_graph_dict["valid_nodes_mask"].reshape(-1)] # Which vertex correspondes to graph node
+
+        return reduced_graph_dict["valid_nodes_mask"].reshape(-1)
 
 
     def compute_clusters(self):
@@ -275,6 +293,7 @@ class EDGraph:
             Based on graph traversal find connected components and put them in seperate clusters. 
         """    
         clusters_size_list = compute_clusters_c(self.edges, self.clusters)
+        self.version += 1
 
         for i, cluster_size in enumerate(clusters_size_list):
             if cluster_size <= 2:
@@ -308,56 +327,27 @@ class EDGraph:
 
         # Update node ids only if we actually removed nodes
         if len(node_id_black_list) > 0:
-            # 1. Mapping old indices to new indices
-            count = 0
-            node_id_mapping = {}
-            for i, is_node_valid in enumerate(valid_nodes_mask):
-                if not is_node_valid:
-                    node_id_mapping[i] = -1
-                else:
-                    node_id_mapping[i] = count
-                    count += 1
+            # 1. Mapping old indices to new indices, the extra last entry maps -1 (no neighbour) to itself
+            is_node_valid = np.append(valid_nodes_mask.reshape(-1).astype(bool), True)
+            node_id_mapping = -np.ones(is_node_valid.shape[0], dtype=graph_edges.dtype)
+            node_id_mapping[np.where(is_node_valid[:-1])[0]] = np.arange(num_nodes, dtype=graph_edges.dtype)
 
-            # 2. Update graph_edges using the id mapping
-            for node_id, graph_edge in enumerate(graph_edges):
-                # compute mask of valid neighbours
-                valid_neighboring_nodes = np.invert(np.isin(graph_edge, node_id_black_list))
+            # 2. Update graph_edges using the id mapping, moving the kept neighbours to the front of every row (in order)
+            valid_neighboring_nodes = is_node_valid[graph_edges]
+            neighbor_order = np.argsort(~valid_neighboring_nodes, axis=1, kind="stable")
+            count_valid_neighbours = valid_neighboring_nodes.sum(axis=1, keepdims=True)
+            is_slot_used = np.arange(graph_edges.shape[1])[None, :] < count_valid_neighbours
 
-                # make a copy of the current neighbours' ids
-                graph_edge_copy           = np.copy(graph_edge)
-                graph_edge_weights_copy   = np.copy(graph_edges_weights[node_id])
-                graph_edge_distances_copy = np.copy(graph_edges_distances[node_id])
+            graph_edges           = np.where(is_slot_used, np.take_along_axis(node_id_mapping[graph_edges], neighbor_order, axis=1), -1).astype(graph_edges.dtype)
+            graph_edges_weights   = np.where(is_slot_used, np.take_along_axis(graph_edges_weights, neighbor_order, axis=1), 0).astype(graph_edges_weights.dtype)
+            graph_edges_distances = np.where(is_slot_used, np.take_along_axis(graph_edges_distances, neighbor_order, axis=1), 0).astype(graph_edges_distances.dtype)
 
-                # set the neighbours' ids to -1
-                graph_edges[node_id]           = -np.ones_like(graph_edge_copy)
-                graph_edges_weights[node_id]   =  np.zeros_like(graph_edge_weights_copy)
-                graph_edges_distances[node_id] =  np.zeros_like(graph_edge_distances_copy)
+            # normalize edges' weights
+            sum_weights = np.sum(graph_edges_weights, axis=1)
+            has_weights = sum_weights > 0
+            graph_edges_weights[has_weights] /= (sum_weights[has_weights] + 1e-6)[:, None]
 
-                count_valid_neighbours = 0
-                for neighbor_idx, is_valid_neighbor in enumerate(valid_neighboring_nodes):
-                    if is_valid_neighbor:
-                        # current neighbor id
-                        current_neighbor_id = graph_edge_copy[neighbor_idx]    
-
-                        # get mapped neighbor id       
-                        if current_neighbor_id == -1: mapped_neighbor_id = -1
-                        else:                         mapped_neighbor_id = node_id_mapping[current_neighbor_id]    
-
-                        graph_edges[node_id, count_valid_neighbours]           = mapped_neighbor_id
-                        graph_edges_weights[node_id, count_valid_neighbours]   = graph_edge_weights_copy[neighbor_idx]
-                        graph_edges_distances[node_id, count_valid_neighbours] = graph_edge_distances_copy[neighbor_idx]
-
-                        count_valid_neighbours += 1
-
-                # normalize edges' weights
-                sum_weights = np.sum(graph_edges_weights[node_id])
-                if sum_weights > 0:
-                    graph_edges_weights[node_id] /= (sum_weights + 1e-6)
-
-                # TODO: FIX if sum_weights == 0 
-                # else:
-                #     print("Hmmmmm", graph_edges_weights[node_id])
-                #     raise Exception("Not good")
+            # TODO: FIX if sum_weights == 0 
 
 
 
@@ -390,96 +380,190 @@ class EDGraph:
         diff = np.linalg.norm(diff, axis=2)
         return diff
 
-    def update(self,canonical_model_vertices,canonical_model_faces,new_verts_indices,plot_update=False):
+    def find_nodes_near_changed_surface(self,canonical_model_vertices,canonical_model_faces):
         """
-            Given vertices which are have outside the coverage of the graph. 
-            Sample nodes and create edges betweem them and old graph
+            Nodes whose geodesic search (2*node_coverage) can reach a part of the canonical model which changed 
+            since the edges were last computed: added, removed or moved vertices and added or removed faces. 
+            The canonical model is extracted again at every update, new surface can create geodesic shortcuts between old nodes. 
+            Geodesic distances are at least the Euclidean ones, so the edges of the other nodes are unchanged. 
 
             @params: 
-                canonical_model_vertices: (Vx3) np.ndarray (float32): Vertices of the updated canonical model
+                canonical_model_vertices: (Vx3) np.ndarray (float32): Vertices of the canonical model
                 canonical_model_faces:    (Fx3) np.ndarray (int32)  : Faces of the model     
-                new_verts_indices: (Nx3) np.ndarry: New vertices indices from which nodes are sampled
 
             @returns: 
-                update: bool: Whether new nodes were added to graph     
+                nodes_near_changed_surface: (N) np.ndarray (bool): All nodes if the model of the current edges is unknown
         """
-
-        if len(new_verts_indices) == 0: 
-            return False
-
+        num_nodes = self.nodes.shape[0]
+        if not hasattr(self, "edges_canonical_model"): 
+            return np.ones(num_nodes, dtype=bool)
 
         node_coverage = self.graph_generation_parameters["node_coverage"]
+        old_vertices, old_faces = self.edges_canonical_model
+        vertices = canonical_model_vertices.astype(np.float32)
+        faces = canonical_model_faces.astype(np.int64)
+
+        # Match the vertices of both models by position, -1 if the vertex was added/removed/moved
+        match_tolerance = 1e-6
+        dist, new_to_old = KDTreeCPU(old_vertices).query(vertices, k=1)
+        new_to_old = np.where(dist.reshape(-1) <= match_tolerance, new_to_old.reshape(-1), -1).astype(np.int64)
+        dist, old_to_new = KDTreeCPU(vertices).query(old_vertices, k=1)
+        old_to_new = np.where(dist.reshape(-1) <= match_tolerance, old_to_new.reshape(-1), -1).astype(np.int64)
+
+        # Faces in only one of the models, compared using the old vertex ids 
+        num_old_vertices = old_vertices.shape[0]
+        def face_keys(faces):
+            faces = np.sort(faces, axis=1)
+            return (faces[:, 0]*num_old_vertices + faces[:, 1])*num_old_vertices + faces[:, 2]
+        mapped_faces = new_to_old[faces]
+        new_face_keys = np.where(np.all(mapped_faces >= 0, axis=1), face_keys(mapped_faces), -1)
+        old_face_keys = face_keys(old_faces)
+        added_faces = ~np.isin(new_face_keys, old_face_keys)
+        removed_faces = ~np.isin(old_face_keys, new_face_keys)
+
+        changed_points = np.concatenate([
+            vertices[new_to_old < 0], vertices[faces[added_faces]].reshape(-1, 3),
+            old_vertices[old_to_new < 0], old_vertices[old_faces[removed_faces]].reshape(-1, 3)], axis=0)
+        if changed_points.shape[0] == 0:
+            return np.zeros(num_nodes, dtype=bool)
+
+        # Geodesic search starts at the vertex of the node 
+        node_vertices = vertices[self.node_indices.reshape(-1)]
+        dist, _ = KDTreeCPU(changed_points).query(node_vertices, k=1)
+        return dist.reshape(-1) <= 2 * node_coverage
+
+    def update_edges(self,canonical_model_vertices,canonical_model_faces,nodes_to_update):
+        """
+            Recompute the geodesic edges of the marked nodes and the nodes near a changed part of the canonical model 
+            (see find_nodes_near_changed_surface), the edges of the other nodes are kept. 
+            All the nodes can be neighbours of the updated nodes.
 
-        # Sample nodes such that they are node_coverage apart from one another 
-        new_node_indices = []
-        for x in new_verts_indices:
-            if len(new_node_indices) == 0:
-                new_node_indices.append(x)
-                continue
-
-            # If node already covered
-            min_nodes_dist = np.min(np.linalg.norm(canonical_model_vertices[new_node_indices] - canonical_model_vertices[x], axis=1))
-            if min_nodes_dist < node_coverage: # Not sure if correct
-                continue
-            self.log.debug(f"Node:{len(new_node_indices)},Vertex index:{x},Min dists:{min_nodes_dist}")
-
-            new_node_indices.append(x)
-
-        self.log.debug(f"New Node vertex indexes:{new_node_indices,len(new_node_indices)}")
-        if len(new_node_indices) == 0: # No new nodes were added
-            return False
+            @params: 
+                canonical_model_vertices: (Vx3) np.ndarray (float32): Vertices of the canonical model
+                canonical_model_faces:    (Fx3) np.ndarray (int32)  : Faces of the model     
+                nodes_to_update: (N) np.ndarray (bool): Nodes whose edges are recomputed
+        """
 
-        self.nodes = np.concatenate([self.nodes, canonical_model_vertices[new_node_indices]], axis=0)
+        nodes_to_update = nodes_to_update | self.find_nodes_near_changed_surface(canonical_model_vertices, canonical_model_faces)
+        self.log.debug(f"Updating edges of {np.sum(nodes_to_update)}/{nodes_to_update.shape[0]} nodes")
 
-        # Update self.node_indices using the new canonical model and old graph nodes 
-        old_nodes_distance_matrix = self.calculate_distance_matrix(self.nodes,canonical_model_vertices)
-        self.log.debug("New Node distance")
-        self.node_indices = np.argmin(old_nodes_distance_matrix,axis=1)
-        self.log.debug(f"Node Indices:{len(self.node_indices)}")
-        self.log.debug(f"{self.node_indices}")                  
-        self.node_indices = self.node_indices[:,None] # Required in Nx1 format for getting reduced graph
-
-        # Compute new graph edges 
-        # (TODO very computationally expensive. 
-        # Takes O(F + V*N + V*N), 
-        #   calculating vertex neighbours, 
-        #   finding new node indices for the updated canonical model, 
-        #   using priority que for adding new graph edges)
-        num_nodes = self.nodes.shape[0]
         num_vertices = canonical_model_vertices.shape[0]
-        min_neighbours = self.graph_generation_parameters["min_neighbours"]
+        node_coverage = self.graph_generation_parameters["node_coverage"]
         num_neighbours = self.graph_generation_parameters["num_neighbours"]
         USE_ONLY_VALID_VERTICES = True
         ENFORCE_TOTAL_NUM_NEIGHBORS = False
-        
+
         #########################################################################
         # Compute graph edges.
         #########################################################################
-        # Compute edges between nodes.
-        graph_edges              = -np.ones((num_nodes, num_neighbours), dtype=np.int32)
-        graph_edges_weights      =  np.zeros((num_nodes, num_neighbours), dtype=np.float32)
-        graph_edges_distances    =  np.zeros((num_nodes, num_neighbours), dtype=np.float32)
-        node_to_vertex_distances = -np.ones((num_nodes, num_vertices), dtype=np.float32)
+        # Compute edges between nodes, starting from the current edges.
+        graph_edges              = self.edges.astype(np.int32)
+        graph_edges_weights      = self.edges_weights.astype(np.float32)
+        graph_edges_distances    = self.edges_distances.astype(np.float32)
+        graph_edges[nodes_to_update]           = -1
+        graph_edges_weights[nodes_to_update]   =  0
+        graph_edges_distances[nodes_to_update] =  0
+        # Node-to-vertex distances are not used, keep none of them (avoids allocating num_nodes x num_vertices)
+        vertex_node_ids          = -np.ones((num_vertices, 0), dtype=np.int32)
+        vertex_node_distances    = -np.ones((num_vertices, 0), dtype=np.float32)
 
         visible_vertices = np.ones_like(canonical_model_vertices)
+        neighbor_offsets = np.zeros((0), dtype=np.int32)
+        neighbors        = np.zeros((0), dtype=np.int32)
 
-        compute_edges_geodesic_c(
+        compute_edges_geodesic_sparse_c(
             canonical_model_vertices, visible_vertices, canonical_model_faces, self.node_indices, 
             num_neighbours, node_coverage, 
             graph_edges, graph_edges_weights, graph_edges_distances,
-            node_to_vertex_distances,
+            vertex_node_ids, vertex_node_distances,
             USE_ONLY_VALID_VERTICES,
-            ENFORCE_TOTAL_NUM_NEIGHBORS
+            ENFORCE_TOTAL_NUM_NEIGHBORS,
+            neighbor_offsets, neighbors, # Computed from the faces
+            nodes_to_update
         )
 
         # Save current results 
         self.edges           = graph_edges 
         self.edges_weights   = graph_edges_weights 
         self.edges_distances = graph_edges_distances
-        self.clusters = -np.ones((graph_edges.shape[0], 1), dtype=np.int32) # Will be calculated later 
+        self.edges_canonical_model = (canonical_model_vertices.astype(np.float32), canonical_model_faces.astype(np.int64))
+        self.version += 1
+
+    def update(self,canonical_model_vertices,canonical_model_faces,new_verts_indices,plot_update=False):
+        """
+            Given vertices which are have outside the coverage of the graph. 
+            Sample nodes and create edges betweem them and old graph
+
+            @params: 
+                canonical_model_vertices: (Vx3) np.ndarray (float32): Vertices of the updated canonical model
+                canonical_model_faces:    (Fx3) np.ndarray (int32)  : Faces of the model     
+                new_verts_indices: (Nx3) np.ndarry: New vertices indices from which nodes are sampled
+
+            @returns: 
+                update: bool: Whether new nodes were added to graph     
+                old_nodes_mask: (N) np.ndarray (bool): Nodes of the graph before the update which are kept,
+                    old nodes can be removed if they are left with not enough neighbours.
+                    The kept old nodes stay in front of the new nodes, in the same order.
+        """
+
+        old_num_nodes = self.nodes.shape[0]
+        if len(new_verts_indices) == 0: 
+            return False, np.ones(old_num_nodes, dtype=bool)
+
+
+        node_coverage = self.graph_generation_parameters["node_coverage"]
+
+        # Sample nodes such that they are node_coverage apart from one another, in the given order.
+        # (one pass over the candidates, sample_nodes only compares a vertex with the sampled nodes in its grid cells)
+        new_verts_indices = np.asarray(new_verts_indices).reshape(-1)
+        candidate_vertices = canonical_model_vertices[new_verts_indices].astype(np.float32)
+        sampled_node_coords = np.zeros((0), dtype=np.float32)
+        sampled_node_indices = np.zeros((0), dtype=np.int32)
+
+        num_new_nodes = sample_nodes_c(
+            candidate_vertices, np.ones((candidate_vertices.shape[0], 1), dtype=bool),
+            sampled_node_coords, sampled_node_indices,
+            node_coverage,
+            False, # Use all candidates
+            False  # Keep the order of the candidates
+        )
+        new_node_indices = new_verts_indices[sampled_node_indices[:num_new_nodes, 0]]
+
+        self.log.debug(f"New Node vertex indexes:{new_node_indices,len(new_node_indices)}")
+        if len(new_node_indices) == 0: # No new nodes were added
+            return False, np.ones(old_num_nodes, dtype=bool)
+
+        self.nodes = np.concatenate([self.nodes, canonical_model_vertices[new_node_indices]], axis=0)
+
+        # Update self.node_indices using the new canonical model and old graph nodes (nearest vertex of every node)
+        vertices_kdtree = KDTreeCPU(canonical_model_vertices.astype(np.float32))
+        _, self.node_indices = vertices_kdtree.query(self.nodes.astype(np.float32), k=1)
+        self.log.debug(f"Node Indices:{len(self.node_indices)}")
+        self.node_indices = self.node_indices.reshape(-1, 1).astype(np.int32) # Required in Nx1 format for getting reduced graph
+
+        # Compute new graph edges for the new nodes and the old nodes that can reach them.
+        # The geodesic search of a node stops at 2*node_coverage, and geodesic distances are at least the Euclidean ones. 
+        # Old nodes near surface which changed since the last update are recomputed too (see update_edges).
+        num_nodes = self.nodes.shape[0]
+        new_nodes_kdtree = KDTreeCPU(self.nodes[old_num_nodes:].astype(np.float32))
+        dist_to_new_nodes, _ = new_nodes_kdtree.query(self.nodes[:old_num_nodes].astype(np.float32), k=1)
+
+        nodes_to_update = np.ones(num_nodes, dtype=bool)
+        nodes_to_update[:old_num_nodes] = dist_to_new_nodes.reshape(-1) <= 2 * node_coverage
+        self.log.debug(f"New nodes:{num_new_nodes}")
+
+        # New nodes start without edges
+        num_neighbours = self.graph_generation_parameters["num_neighbours"]
+        self.edges           = np.concatenate([self.edges, -np.ones((num_new_nodes, num_neighbours), dtype=np.int32)], axis=0)
+        self.edges_weights   = np.concatenate([self.edges_weights, np.zeros((num_new_nodes, num_neighbours), dtype=np.float32)], axis=0)
+        self.edges_distances = np.concatenate([self.edges_distances, np.zeros((num_new_nodes, num_neighbours), dtype=np.float32)], axis=0)
+
+        self.update_edges(canonical_model_vertices, canonical_model_faces, nodes_to_update)
+
+        self.clusters = -np.ones((num_nodes, 1), dtype=np.int32) # Will be calculated later 
 
         # self.node_to_vertex_distances = node_to_vertex_distances # Not required except for edge calculatation    
-        self.remove_nodes_with_not_enough_neighbours()
+        valid_nodes_mask = self.remove_nodes_with_not_enough_neighbours()
 
         #########################################################################
         # Compute clusters.
@@ -489,7 +573,102 @@ class EDGraph:
         # I tried implementing the whole update thing. But the results are basically the same. 
         # Its better to use neural tracking setup. :) (This smile represents the time wasted on the whole thing)
 
-        return True
+        return True, valid_nodes_mask[:old_num_nodes]
+
+    def prune(self,canonical_model_vertices,canonical_model_faces,node_support):
+        """
+            Graph maintenance for long sequences. Nodes closer than merge_node_ratio*node_coverage are merged
+            into the node with the most support and nodes with no support are removed. 
+            Edges are recomputed only for the remaining nodes which lost a neighbour or are near a changed part of the model.
+
+            @params: 
+                canonical_model_vertices: (Vx3) np.ndarray (float32): Vertices of the canonical model
+                canonical_model_faces:    (Fx3) np.ndarray (int32)  : Faces of the model     
+                node_support: (N) np.ndarray (int): Number of points skinned to every node
+
+            @returns: 
+                valid_nodes_mask: (N) np.ndarray (bool): Nodes kept in the graph 
+                node_id_mapping:  (N) np.ndarray (int32): New id of every node, id of the node it was merged into, or -1 if removed 
+        """
+
+        num_nodes = self.nodes.shape[0]
+        node_coverage = self.graph_generation_parameters["node_coverage"]
+        merge_radius = self.graph_generation_parameters.get("merge_node_ratio", 0.5) * node_coverage
+
+        node_support = np.asarray(node_support).reshape(-1)
+        supported_nodes = np.where(node_support > 0)[0]
+        if len(supported_nodes) == 0: # Nothing skinned yet, keep the graph as it is
+            return np.ones(num_nodes, dtype=bool), np.arange(num_nodes, dtype=np.int32)
+
+        # Visit nodes by decreasing support, a node is kept only if no kept node is within the merge radius
+        merge_order = supported_nodes[np.argsort(-node_support[supported_nodes], kind="stable")]
+        kept_node_coords = np.zeros((0), dtype=np.float32)
+        kept_node_indices = np.zeros((0), dtype=np.int32)
+
+        num_kept_nodes = sample_nodes_c(
+            self.nodes[merge_order].astype(np.float32), np.ones((merge_order.shape[0], 1), dtype=bool),
+            kept_node_coords, kept_node_indices,
+            merge_radius,
+            False, # Use all supported nodes
+            False  # Keep the order of the nodes
+        )
+        kept_nodes = np.sort(merge_order[kept_node_indices[:num_kept_nodes, 0]])
+
+        if len(kept_nodes) == num_nodes: # Nothing to merge or remove
+            return np.ones(num_nodes, dtype=bool), np.arange(num_nodes, dtype=np.int32)
+
+        valid_nodes_mask = np.zeros(num_nodes, dtype=bool)
+        valid_nodes_mask[kept_nodes] = True
+
+        # Merged nodes map to the nearest kept node, which is within the merge radius
+        node_id_mapping = -np.ones(num_nodes, dtype=np.int32)
+        node_id_mapping[kept_nodes] = np.arange(len(kept_nodes), dtype=np.int32)
+        merged_nodes = supported_nodes[~valid_nodes_mask[supported_nodes]]
+        if len(merged_nodes) > 0:
+            kept_nodes_kdtree = KDTreeCPU(self.nodes[kept_nodes].astype(np.float32))
+            _, nearest_kept_node = kept_nodes_kdtree.query(self.nodes[merged_nodes].astype(np.float32), k=1)
+            node_id_mapping[merged_nodes] = nearest_kept_node.reshape(-1)
+
+        self.log.info(f"Pruning graph: merged nodes:{len(merged_nodes)} removed nodes:{num_nodes - len(supported_nodes)} remaining nodes:{len(kept_nodes)}")
+
+        # Kept nodes which had an edge to a merged or removed node
+        lost_neighbour = ~np.all(np.append(valid_nodes_mask, True)[self.edges], axis=1)
+
+        # Remove nodes from the graph
+        reduced_graph_dict = self.get_reduced_graph(valid_nodes_mask.reshape(-1, 1))
+
+        self.nodes           = reduced_graph_dict["valid_nodes_at_source"]
+        self.edges           = reduced_graph_dict["graph_edges"] 
+        self.edges_weights   = reduced_graph_dict["graph_edges_weights"] 
+        self.edges_distances = reduced_graph_dict["graph_edges_distances"]                  
+        self.num_nodes = np.array(self.nodes.shape[0], dtype=np.int64)
+
+        # Update self.node_indices using the canonical model (nearest vertex of every node)
+        vertices_kdtree = KDTreeCPU(canonical_model_vertices.astype(np.float32))
+        _, self.node_indices = vertices_kdtree.query(self.nodes.astype(np.float32), k=1)
+        self.node_indices = self.node_indices.reshape(-1, 1).astype(np.int32) # Required in Nx1 format for getting reduced graph
+
+        self.update_edges(canonical_model_vertices, canonical_model_faces, lost_neighbour[valid_nodes_mask])
+
+        # Nodes which lost their neighbours might not have enough neighbours left
+        self.clusters = -np.ones((self.nodes.shape[0], 1), dtype=np.int32)
+        kept_nodes_mask = self.remove_nodes_with_not_enough_neighbours()
+        if not np.all(kept_nodes_mask):
+            self.log.info(f"Pruning graph: removed nodes with not enough neighbours:{np.sum(~kept_nodes_mask)}")
+            valid_nodes_mask[kept_nodes[~kept_nodes_mask]] = False
+
+            # Nodes merged into a removed node are removed too
+            kept_node_id_mapping = -np.ones(len(kept_nodes), dtype=np.int32)
+            kept_node_id_mapping[kept_nodes_mask] = np.arange(np.sum(kept_nodes_mask), dtype=np.int32)
+            node_id_mapping = np.where(node_id_mapping >= 0, kept_node_id_mapping[node_id_mapping], -1).astype(np.int32)
+
+        #########################################################################
+        # Compute clusters.
+        #########################################################################
+        self.clusters = -np.ones((self.nodes.shape[0], 1), dtype=np.int32)
+        self.compute_clusters()
+
+        return valid_nodes_mask, node_id_mapping
 
     def save(self):
         #########################################################################
@@ -568,6 +747,8 @@ class EDGraph:
         self.edges          =          utils.load_graph_edges(self.graph_save_path[frame_index]["graph_edges_path"])
         self.edges_weights  =  utils.load_graph_edges_weights(self.graph_save_path[frame_index]["graph_edges_weights_path"])
         self.clusters       =       utils.load_graph_clusters(self.graph_save_path[frame_index]["graph_clusters_path"])
+        if hasattr(self, "edges_canonical_model"): del self.edges_canonical_model # Loaded edges were computed on another model
+        self.version += 1
 
     def get_graph_path(self,index):
         """
@@ -2,8 +2,15 @@
 # Run python fusion.py --datadir <path-to-RGBD-frames>
 
 import sys
+import time
+import queue
+import threading
+import importlib
 import argparse # To parse arguments 
 import logging # To log info 
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
 
 
 sys.path.append("../")  # Making it easier to load modules
@@ -23,12 +30,18 @@ class DynamicFusion:
 	def __init__(self,opt):
 		self.frameloader = RGBDVideoLoader(opt.datadir)
 		self.opt = opt 
-		
-		self.model = Deformnet_runner()	
-		
+
 		# For logging results
 		self.log = logging.getLogger(__name__)
 
+		# Default numba threading layer fails if parallel kernels are launched from 2 threads at the same time, 
+		# meshing runs concurrently with registration only if a threadsafe layer is installed 
+		self.mesh_concurrently = self.opt.pipeline and self.set_threadsafe_numba_layer()
+		if self.opt.pipeline and not self.mesh_concurrently:
+			self.log.warning("Numba threading layer tbb/omp not available. Meshing runs after registration, only loading is pipelined.")
+		
+		self.model = Deformnet_runner()	
+
 		# Define visualizer
 		self.vis = get_visualizer(opt)
 
@@ -67,7 +80,7 @@ class DynamicFusion:
 
 		assert hasattr(self,'graph'),  "Graph not defined. Run create_graph first." 
 
-		self.warpfield = WarpField(self.graph,self.tsdf,self.vis)
+		self.warpfield = WarpField(self.graph,self.tsdf,self.vis,skinning_method=self.opt.skinning,knn_method=self.opt.skinning_knn)
 
 
 		self.tsdf.warpfield = self.warpfield  # Add warpfield to tsdf
@@ -80,31 +93,35 @@ class DynamicFusion:
 	def register_new_frame(self): 
 
 		# Check next frame can be registered
-		if self.target_frame + self.opt.skip_rate > len(self.frameloader):
+		if self.target_frame + self.opt.skip_rate >= len(self.frameloader):
 			return False,"Registration Completed"
 
 		self.log.info(f"Registering {self.target_frame}th frame to {self.target_frame + self.opt.skip_rate}th frame")
 
 		success,msg = self.register_frame(self.target_frame,self.target_frame + self.opt.skip_rate)
+
+		self.vis.show(debug=False) # plot registration details 
 		
 		# Update frame number 
 		self.target_frame = self.target_frame + self.opt.skip_rate
 
 		return success,msg
 
-	def register_frame(self,source_frame,target_frame):
+	def register_frame(self,source_frame,target_frame,frame_data=None):
 		"""
 			Main step of the algorithm. Register new target frame 
 			Args: 
 				source_frame(int): which source frame id to integrate  
 				target_frame(int): which target frame id to integrate 
+				frame_data(tuple): (source_frame_data,target_frame_data) if already loaded, see load_frames 
 
 			Returns:
 				success(bool): Return whether sucess or failed in registering   
 		"""
 
-		source_frame_data = self.frameloader.get_source_data(source_frame)	
-		target_frame_data = self.frameloader.get_target_data(target_frame,source_frame_data["cropper"])	
+		if frame_data is None:
+			frame_data = self.load_frames(source_frame,target_frame)
+		source_frame_data,target_frame_data = frame_data
 		
 		# Obtain reduced graph based on visibility of graph nodes in source frame. Graph nodes are already deformed 
 		reduced_graph_dict = self.tsdf.get_reduced_graph() # Assuming previous frame was used as source 
@@ -134,10 +151,10 @@ class DynamicFusion:
 		# self.vis.plot_skinned_model()
 
 		# Add new nodes to warpfield and graph if any
-		# update = self.warpfield.update_graph() 
-		update = False
-		
-		self.vis.show(debug=False) # plot registration details 
+		if self.opt.update_graph:
+			update = self.warpfield.update_graph(prune=self.opt.prune_graph)
+		else:	
+			update = False
 
 		# Return whether sucess or failed in registering 
 		return True, f"Registered {source_frame}th frame to {target_frame}th frame. Added graph nodes:{update}"
@@ -147,6 +164,11 @@ class DynamicFusion:
 		if hasattr(self,'warpfield'):  self.warpfield.clear() # Clear image information, remove deformed model 
 		# if hasattr(self,'graph'): self.graph.clear()   # Remove estimated deformation from previous timesteps 	
 
+	def load_frames(self,source_frame,target_frame):
+		source_frame_data = self.frameloader.get_source_data(source_frame)	
+		target_frame_data = self.frameloader.get_target_data(target_frame,source_frame_data["cropper"])	
+		return source_frame_data,target_frame_data
+
 	def __call__(self):
 
 		# Initialize
@@ -155,6 +177,9 @@ class DynamicFusion:
 
 		# self.vis.init_plot()
 
+		if self.opt.pipeline:
+			return self.run_pipeline()
+
 		# Run fusion 
 		while True: 
 
@@ -167,6 +192,148 @@ class DynamicFusion:
 
 		self.vis.create_video("./results.mp4")
 
+	@staticmethod
+	def set_threadsafe_numba_layer():
+		"""
+			Use a numba threading layer which allows parallel kernels from multiple threads. 
+			Returns: 
+				success(bool): False if neither tbb nor omp is installed
+		"""
+		for layer,module in [("tbb","numba.np.ufunc.tbbpool"),("omp","numba.np.ufunc.omppool")]:
+			try:
+				importlib.import_module(module)
+			except (ImportError, OSError): # Layer not installed
+				continue
+			numba.config.THREADING_LAYER = layer
+			return True
+		return False
+
+	def run_pipeline(self):
+		"""
+			Run fusion as 3 concurrent stages connected by bounded queues: 
+				1. Loading + preprocessing of frame t+1  
+				2. Tracking + integration of frame t (reduced graph, skinning, DeformNet, ARAP, warpfield and TSDF update) 
+				3. Meshing of frame t-1 on a snapshot of the TSDF and warpfield 
+
+			Stage 2 for frame t needs the warpfield and TSDF of frame t-1, hence it stays sequential. 
+			Visualization (Open3D) is not thread safe, the meshed frames are shown by the main thread between registrations. 
+		"""
+		frame_queue = queue.Queue(maxsize=self.opt.pipeline_depth)
+		output_queue = queue.Queue(maxsize=self.opt.pipeline_depth)
+		render_queue = queue.Queue() # Bounded by output_queue, the main thread renders before registering the next frame
+		stop_loading = threading.Event()
+
+		frame_ids = list(range(self.target_frame + self.opt.skip_rate, len(self.frameloader), self.opt.skip_rate))
+
+		with ThreadPoolExecutor(max_workers=2) as executor: 
+			loader = executor.submit(self.load_stage,frame_ids,frame_queue,stop_loading)
+			output = executor.submit(self.output_stage,output_queue,render_queue) if self.mesh_concurrently else None
+
+			start_time = time.time()
+			try:
+				for target_frame in frame_ids:
+					source_frame = self.target_frame
+					frame_data = frame_queue.get()
+					if frame_data is None: 
+						loader.result() # Raise error of the loader
+						raise RuntimeError("Frame loading stopped before all frames were registered")
+
+					self.log.info(f"Registering {source_frame}th frame to {target_frame}th frame")
+					success,msg = self.register_frame(source_frame,target_frame,frame_data=frame_data)
+					self.log.info(msg)
+
+					# Meshing works on a copy, registration of the next frame updates the TSDF and warpfield inplace
+					if output is None:
+						self.vis.show(debug=False)
+					elif not self.put_to_stage(output_queue,self.tsdf.snapshot(),output.done):
+						output.result() # Raise error of the output stage
+						raise RuntimeError("Output stage stopped before all frames were registered")
+					else:
+						self.render_stage(render_queue)
+
+					self.target_frame = target_frame
+					self.clear_frame_data() # Reset information 
+			finally:
+				stop_loading.set()
+				if output is not None:
+					self.put_to_stage(output_queue,None,output.done) # Finish meshing the queued frames
+
+			if output is not None:
+				self.render_stage(render_queue,block=True)
+
+			loader.result() # Raise errors from the workers if any
+			if output is not None:
+				output.result()
+
+		total_time = time.time() - start_time
+		self.log.info(f"Registered {len(frame_ids)} frames in {total_time:.2f}s ({len(frame_ids)/max(total_time,1e-6):.2f} frames/s)")
+
+		self.vis.create_video("./results.mp4")
+
+	def load_stage(self,frame_ids,frame_queue,stop_loading):
+		source_frame = self.target_frame
+		try:
+			for target_frame in frame_ids:
+				frame_data = self.load_frames(source_frame,target_frame)
+				if not self.put_to_stage(frame_queue,frame_data,stop_loading.is_set):
+					return
+				source_frame = target_frame
+		finally:
+			self.put_to_stage(frame_queue,None,stop_loading.is_set) # Wake up registration if loading failed
+
+	def output_stage(self,output_queue,render_queue):
+		# Extract the models shown by the visualizer, no Open3D calls on this thread  
+		try:
+			while True: 
+				tsdf = output_queue.get()
+				if tsdf is None: 
+					return
+
+				tsdf.get_canonical_model()
+				if self.opt.deformed_model == "raycast":
+					tsdf.get_raycasted_model()
+				else:
+					tsdf.get_deformed_model()
+				render_queue.put(tsdf)
+		finally:
+			render_queue.put(None) # Wake up the main thread if meshing failed
+
+	def render_stage(self,render_queue,block=False):
+		"""
+			Show the frames meshed by the output stage, on the main thread. 
+			If block, wait until the output stage finished. 
+		"""
+		while True:
+			try:
+				tsdf = render_queue.get(block=block)
+			except queue.Empty:
+				return
+			if tsdf is None:
+				return
+
+			self.vis.tsdf = tsdf
+			self.vis.warpfield = tsdf.warpfield
+			self.vis.graph = tsdf.graph
+			self.vis.show(debug=False) # plot registration details 
+
+			self.vis.tsdf = self.tsdf
+			self.vis.warpfield = self.warpfield
+			self.vis.graph = self.graph
+
+	@staticmethod
+	def put_to_stage(stage_queue,item,is_stopped):
+		"""
+			Put item in a bounded queue without blocking forever if the other side of the queue stopped. 
+			Returns: 
+				success(bool): False if stopped before the item could be added 
+		"""
+		while not is_stopped(): 
+			try:
+				stage_queue.put(item,timeout=1)
+				return True
+			except queue.Full:
+				pass
+		return False
 
 
 if __name__ == "__main__":
@@ -177,11 +344,28 @@ if __name__ == "__main__":
 	# Arguments for tsdf
 	args.add_argument('--voxel_size', default=0.005, type=float, help='length of each voxel cube in TSDF')
 
+	# Arguments for warpfield
+	args.add_argument('--skinning', default='lbs', type=str, choices=['lbs','dqs'], help='Linear Blend Skinning:lbs or Dual Quaternion Skinning:dqs to deform the model')
+	args.add_argument('--skinning_knn', default='grid', type=str, choices=['grid','kdtree'], help='Find skinning anchors using a uniform grid of nodes (shared per cell) or a KDTree query per point')
+	args.add_argument('--update_graph', 	dest='update_graph', action="store_true",help='Add nodes to the graph for the newly fused surface after every frame')
+	args.add_argument('--no-update_graph', dest='update_graph', action="store_false",help='Keep the graph created at the source frame')
+	args.set_defaults(update_graph=False)
+	args.add_argument('--prune_graph', 	dest='prune_graph', action="store_true",help='After updating the graph, merge nodes too close to one another and remove nodes with no skinned voxel')
+	args.add_argument('--no-prune_graph', dest='prune_graph', action="store_false",help='Only add nodes while updating the graph')
+	args.set_defaults(prune_graph=True)
+	args.add_argument('--deformed_model', default='mesh', type=str, choices=['raycast','mesh'], help='Visualize the deformed model by raycasting the TSDF through the warpfield or by deforming the marching cubes mesh')
+
 	# For GPU
 	args.add_argument('--gpu', 	  dest='gpu', action="store_true",help='Try to use GPU for faster optimization')
 	args.add_argument('--no-gpu', dest='gpu', action="store_false",help='Uses CPU')
 	args.set_defaults(gpu=True)
 
+	# Run loading, tracking and meshing/visualization of consecutive frames concurrently 
+	args.add_argument('--pipeline', 	dest='pipeline', action="store_true",help='Overlap loading of the next frame and meshing of the previous frame with registration')
+	args.add_argument('--no-pipeline', dest='pipeline', action="store_false",help='Run all steps of a frame sequentially')
+	args.set_defaults(pipeline=False)
+	args.add_argument('--pipeline_depth', default=2, type=int, help='Maximum frames buffered between pipeline stages')
+
 	# Arguments for loading frames 
 	args.add_argument('--source_frame', default=0, type=int, help='frame index to create the deformable model')
 	args.add_argument('--skip_rate', default=1, type=int, help='frame rate while running code')
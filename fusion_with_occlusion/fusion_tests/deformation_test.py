@@ -167,3 +167,71 @@ def test2(use_gpu=True,debug=False):
 		else: 
 			vis.draw(pause=(i+1)/90)
 
+
+def test_raycast_sphere(use_gpu=False):
+	"""
+		Raycast a sphere TSDF through a rigidly translated graph. 
+		The depth of every pixel whose ray hits the surface should match the analytic ray-sphere intersection 
+		with the translated sphere (within a voxel). 
+	"""
+
+	opt.image_width = 64
+	opt.image_height = 48
+	max_depth = 1.5
+
+	fopt = Dict2Class({"voxel_size":0.02,"source_frame":0,"gpu":use_gpu,"visualizer":"matplotlib","datadir":"/tmp","skip_rate":3})
+	vis = get_visualizer(fopt)
+
+	cam_intr = [60, 60, 32, 24]
+	center = np.array([0.0, 0.0, 1.0])
+	radius = 0.3
+	translation = np.array([0.05, -0.03, -0.1])
+
+	# Nodes on the sphere (fibonacci lattice)
+	num_nodes = 300
+	phi = np.arccos(1 - 2*(np.arange(num_nodes) + 0.5)/num_nodes)
+	theta = np.pi*(1 + 5**0.5)*np.arange(num_nodes)
+	nodes = center + radius*np.stack([np.sin(phi)*np.cos(theta), np.sin(phi)*np.sin(theta), np.cos(phi)], axis=1)
+	graph = Dict2Class({
+		'nodes' : nodes.astype(np.float32),
+		'graph_generation_parameters' : {'node_coverage' : 0.1,'graph_neighbours': 4},
+	})
+
+	# Signed distance of the sphere, observed only inside the truncated region 
+	tsdf = TSDFVolume(max_depth,cam_intr, fopt,vis)
+	tsdf.frame_id = fopt.source_frame
+	sdf = np.linalg.norm(tsdf.world_pts - center, axis=1) - radius
+	tsdf_vol, color_vol, weight_vol = tsdf.get_volume()
+	tsdf_vol[:] = np.clip(sdf/tsdf._trunc_margin, -1, 1).reshape(tsdf._vol_dim)
+	weight_vol[:] = (np.abs(sdf) < tsdf._trunc_margin).reshape(tsdf._vol_dim)
+	if tsdf.gpu_mode:
+		from tsdf import cuda, pycuda_ctx
+		pycuda_ctx.push()
+		cuda.memcpy_htod(tsdf._tsdf_vol_gpu, tsdf_vol)
+		cuda.memcpy_htod(tsdf._weight_vol_gpu, weight_vol)
+		pycuda_ctx.pop()
+
+	warpfield = WarpField(graph,tsdf,vis)
+	warpfield.translations[:] = translation
+	tsdf.warpfield = warpfield
+
+	rendered_data = tsdf.raycast()
+
+	# Analytic first intersection of each pixel's ray (x,y,1)*z with the translated sphere
+	v, u = np.meshgrid(np.arange(opt.image_height), np.arange(opt.image_width), indexing='ij')
+	rays = np.stack([(u - cam_intr[2])/cam_intr[0], (v - cam_intr[3])/cam_intr[1], np.ones_like(u, dtype=np.float64)], axis=-1)
+	live_center = center + translation
+	a = np.sum(rays**2, axis=-1)
+	b = rays @ live_center
+	discriminant = b**2 - a*(np.sum(live_center**2) - radius**2)
+	hit = discriminant > 0
+	depth = np.where(hit, (b - np.sqrt(np.maximum(discriminant, 0)))/a, 0)
+
+	valid = rendered_data["valid"]
+	raycast_depth = rendered_data["im"][5]
+	depth_error = np.abs(raycast_depth[valid] - depth[valid])
+	print(f"Raycast sphere: valid pixels:{valid.sum()} analytic hits:{hit.sum()} max depth error:{depth_error.max():.4f}")
+
+	assert np.all(hit[valid]), "Rays that miss the sphere hit the raycasted surface"
+	assert valid.sum() >= 0.9*hit.sum(), f"Raycast missed the surface:{valid.sum()}/{hit.sum()} pixels"
+	assert depth_error.max() < fopt.voxel_size, f"Raycast depth error:{depth_error.max()} larger than a voxel"
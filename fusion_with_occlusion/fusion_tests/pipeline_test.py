@@ -0,0 +1,98 @@
+#  The file contains tests on the pipelined frame loop of DynamicFusion 
+import time
+import logging
+import threading
+
+# Fusion modules 
+from fusion import DynamicFusion
+
+# Test imports 
+from .test_utils import Dict2Class
+
+class FrameLoader:
+	"""
+		Frames are read by index like RGBDVideoLoader, an index outside the sequence raises IndexError
+	"""
+	def __init__(self,num_frames):
+		self.images_path = [f"{i}.jpg" for i in range(num_frames)]
+
+	def __len__(self):
+		return len(self.images_path)
+
+	def get_source_data(self,source_frame):
+		return {"id": int(self.images_path[source_frame].split('.')[0]),"cropper": None}
+
+	def get_target_data(self,target_frame,cropper):
+		return {"id": int(self.images_path[target_frame].split('.')[0])}
+
+class Snapshot:
+	def __init__(self,frame_id):
+		self.frame_id = frame_id
+		self.warpfield = None
+		self.graph = None
+		self.meshed = False
+
+	def get_canonical_model(self):
+		time.sleep(0.01)
+		self.meshed = True
+
+	def get_deformed_model(self):
+		pass
+
+class TSDF:
+	frame_id = 0
+	def snapshot(self):
+		return Snapshot(self.frame_id)
+
+	def clear(self):
+		pass
+
+class Visualizer:
+	def __init__(self):
+		self.shown = []
+		self.video = None
+
+	def show(self,debug=False):
+		# Only meshed frames are shown, always on the main thread 
+		assert threading.current_thread() is threading.main_thread(), "Frame shown outside the main thread"
+		assert not isinstance(self.tsdf,Snapshot) or self.tsdf.meshed, "Frame shown before it was meshed"
+		self.shown.append(self.tsdf.frame_id)
+
+	def create_video(self,path):
+		self.video = path
+
+def test_pipeline(num_frames=6,skip_rate=1):
+	"""
+		Run the pipelined frame loop to completion with stub registration and meshing, 
+		with and without concurrent meshing. Every frame after the source frame is registered once, in order, 
+		shown once and the video is created. 
+	"""
+	expected_frames = list(range(skip_rate,num_frames,skip_rate))
+	for mesh_concurrently in [False,True]:
+		fusion = object.__new__(DynamicFusion)
+		fusion.opt = Dict2Class({"pipeline": True,"pipeline_depth": 2,"skip_rate": skip_rate,"deformed_model": "mesh"})
+		fusion.log = logging.getLogger("fusion")
+		fusion.mesh_concurrently = mesh_concurrently
+		fusion.frameloader = FrameLoader(num_frames)
+		fusion.target_frame = 0
+		fusion.tsdf = TSDF()
+		fusion.warpfield = Dict2Class({"clear": lambda: None})
+		fusion.graph = None
+		fusion.vis = Visualizer()
+		fusion.vis.tsdf = fusion.tsdf
+
+		registered = []
+		def register_frame(source_frame,target_frame,frame_data=None):
+			source_frame_data,target_frame_data = frame_data
+			assert (source_frame_data["id"],target_frame_data["id"]) == (source_frame,target_frame), "Registered the wrong frames"
+			registered.append(target_frame)
+			fusion.tsdf.frame_id = target_frame
+			return True,"Registered"
+		fusion.register_frame = register_frame
+
+		fusion.run_pipeline()
+
+		print(f"Pipeline mesh_concurrently:{mesh_concurrently} registered:{registered} shown:{fusion.vis.shown}")
+		assert registered == expected_frames, f"Registered frames:{registered} expected:{expected_frames}"
+		assert fusion.vis.shown == expected_frames, f"Shown frames:{fusion.vis.shown} expected:{expected_frames}"
+		assert fusion.vis.video is not None, "Pipeline did not finish"
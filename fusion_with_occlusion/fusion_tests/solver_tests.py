@@ -0,0 +1,197 @@
+#  The file contains tests on the Gauss-Newton solver of DeformNet
+# Python Imports
+import numpy as np
+import torch
+from scipy.spatial.transform import Rotation as R
+
+# Neural Tracking modules
+import options as opt
+from model.model import DeformNet, GaussNewtonPlan
+
+
+def create_problem(nx=30,ny=20,spacing=0.05,num_points=4000,motion=0.08,device="cuda"):
+	"""
+		Plane of nodes in a grid at depth 1.5 bent around the y-axis and translated.
+		Source points are sampled on the plane and deformed with the ground truth node transformations (4 anchors).
+
+		@returns:
+			problem: dict: Inputs of DeformNet.solve_gauss_newton and the ground truth deformed points
+	"""
+	rng = np.random.default_rng(0)
+
+	xs,ys = np.meshgrid(np.arange(nx)*spacing - nx*spacing/2,np.arange(ny)*spacing - ny*spacing/2,indexing="ij")
+	nodes = np.stack([xs.reshape(-1),ys.reshape(-1),np.full(nx*ny,1.5)],axis=1)
+	N = nodes.shape[0]
+
+	# 8 nearest neighbours as edges
+	node_dist = np.linalg.norm(nodes[:,None] - nodes[None],axis=2)
+	np.fill_diagonal(node_dist,np.inf)
+	graph_edges = np.argsort(node_dist,axis=1)[:,:8]
+	graph_edges_weights = np.exp(-np.take_along_axis(node_dist,graph_edges,axis=1)/spacing)
+	graph_edges_weights /= np.sum(graph_edges_weights,axis=1,keepdims=True)
+
+	# Smooth ground truth deformation
+	rotations = R.from_rotvec(3*nodes[:,0:1]*np.array([[0,1,0]])).as_matrix()
+	translations = np.stack([motion*np.ones(N),0.5*motion*np.sin(6*nodes[:,0]),3*motion*nodes[:,0]],axis=1)
+
+	points = np.stack([(rng.random(num_points)-0.5)*nx*spacing,(rng.random(num_points)-0.5)*ny*spacing,1.5 + 0.01*rng.standard_normal(num_points)],axis=1)
+	point_dist = np.linalg.norm(points[:,None] - nodes[None],axis=2)
+	anchors = np.argsort(point_dist,axis=1)[:,:4]
+	weights = np.exp(-np.take_along_axis(point_dist,anchors,axis=1)**2/(2*spacing**2))
+	weights /= np.sum(weights,axis=1,keepdims=True)
+
+	deformed_points = np.zeros_like(points)
+	for k in range(4):
+		anchor_nodes = nodes[anchors[:,k]]
+		deformed_points += weights[:,k:k+1]*(np.einsum('nij,nj->ni',rotations[anchors[:,k]],points - anchor_nodes) + anchor_nodes + translations[anchors[:,k]])
+
+	fx,fy,cx,cy = 500.0,500.0,320.0,240.0
+	xy_pixels = np.stack([fx*deformed_points[:,0]/deformed_points[:,2] + cx,fy*deformed_points[:,1]/deformed_points[:,2] + cy],axis=1)
+
+	to_torch = lambda x,dtype=torch.float32: torch.from_numpy(np.ascontiguousarray(x)).type(dtype).to(device)
+	graph_nodes = to_torch(nodes)
+	return {
+		"graph_nodes": graph_nodes,
+		"original_graph_nodes": graph_nodes,
+		"solver_plan": GaussNewtonPlan.from_graph(to_torch(graph_edges,torch.int64),to_torch(graph_edges_weights)),
+		"source_points": to_torch(points).view(-1,3,1),
+		"target_matches": to_torch(deformed_points).view(-1,3,1),
+		"xy_pixels_warped": to_torch(xy_pixels).view(-1,2,1),
+		"correspondence_weights": torch.ones(num_points,dtype=torch.float32,device=device),
+		"source_anchors": to_torch(anchors,torch.int64),
+		"source_weights": to_torch(weights),
+		"intrinsics": to_torch([fx,fy,cx,cy]),
+		"deformed_points": to_torch(deformed_points)
+	}
+
+def solver_inputs(problem):
+	return [problem[k] for k in ["graph_nodes","original_graph_nodes","solver_plan","source_points","target_matches",
+		"xy_pixels_warped","correspondence_weights","source_anchors","source_weights","intrinsics"]]
+
+def identity(problem):
+	N = problem["graph_nodes"].shape[0]
+	device = problem["graph_nodes"].device
+	return torch.eye(3,device=device).repeat(N,1,1),torch.zeros((N,3,1),device=device)
+
+def convergence_info():
+	return {"total": [],"arap": [],"data": [],"condition_numbers": [],"valid": 0,"errors": []}
+
+def point_error(problem,R_current,t_current):
+	"""
+		Mean distance between the source points deformed with the estimated transformations and the ground truth
+	"""
+	deformed_points = torch.zeros_like(problem["source_points"])
+	for k in range(4):
+		node_idxs_k = problem["source_anchors"][:,k]
+		nodes_k = problem["graph_nodes"][node_idxs_k].view(-1,3,1)
+		deformed_points += problem["source_weights"][:,k].view(-1,1,1)*(torch.matmul(R_current[node_idxs_k],problem["source_points"] - nodes_k) + nodes_k + t_current[node_idxs_k])
+	return torch.mean(torch.norm(deformed_points.view(-1,3) - problem["deformed_points"],dim=1)).item()
+
+
+def test_hierarchical_solve(motions=(0.02,0.08,0.2)):
+	"""
+		Coarse-to-fine solve (coarse graph + gn_num_fine_iter iterations) from identity
+		should reach the same alignment as the direct solve with gn_num_iter iterations.
+		The coarse graph is sampled once per solver plan.
+	"""
+	model = DeformNet().cuda()
+	opt.gn_use_adaptive_lm = False
+	opt.gn_coarse_node_coverage = 0.15
+
+	with torch.no_grad():
+		for motion in motions:
+			problem = create_problem(motion=motion)
+
+			R_direct,t_direct,_,ill_posed_system = model.solve_gauss_newton(*solver_inputs(problem),*identity(problem),model.gn_num_iter,convergence_info())
+			assert not ill_posed_system
+			direct_error = point_error(problem,R_direct,t_direct)
+
+			info = convergence_info()
+			R_coarse,t_coarse,valid_coarse_solve = model.solve_coarse_graph(*solver_inputs(problem),*identity(problem),info)
+			assert valid_coarse_solve, "Coarse solve failed"
+			coarse_graph = problem["solver_plan"].coarse_graph
+			R_fine,t_fine,_,ill_posed_system = model.solve_gauss_newton(*solver_inputs(problem),R_coarse,t_coarse,opt.gn_num_fine_iter,info)
+			assert not ill_posed_system
+			hierarchical_error = point_error(problem,R_fine,t_fine)
+
+			# Second solve with the same plan reuses the coarse graph
+			model.solve_coarse_graph(*solver_inputs(problem),*identity(problem),convergence_info())
+			assert problem["solver_plan"].coarse_graph is coarse_graph, "Coarse graph was sampled again"
+
+			print(f"Motion:{motion} Direct solve error:{direct_error:.4f} Coarse-to-fine error:{hierarchical_error:.4f}")
+			assert hierarchical_error <= 1.1*direct_error + 1e-3, f"Coarse-to-fine solve error:{hierarchical_error} larger than direct solve error:{direct_error}"
+
+def test_adaptive_lm(motions=(0.0,0.02,0.08,0.2),max_iter=20):
+	"""
+		Adaptive Levenberg-Marquardt against Gauss-Newton with fixed damping (gn_num_iter iterations) from identity.
+		LM should stop early on small motions and reach at least the alignment of Gauss-Newton.
+		Checking for convergence on the host every k iterations should not change the result.
+	"""
+	model = DeformNet().cuda()
+	check_interval = opt.gn_lm_convergence_check_interval
+
+	with torch.no_grad():
+		for motion in motions:
+			problem = create_problem(motion=motion)
+
+			opt.gn_use_adaptive_lm = False
+			R_gn,t_gn,_,ill_posed_system = model.solve_gauss_newton(*solver_inputs(problem),*identity(problem),model.gn_num_iter,convergence_info())
+			assert not ill_posed_system
+			gn_error = point_error(problem,R_gn,t_gn)
+
+			opt.gn_use_adaptive_lm = True
+			lm_results = []
+			for k in [0,1]:
+				opt.gn_lm_convergence_check_interval = k
+				info = convergence_info()
+				R_lm,t_lm,_,ill_posed_system = model.solve_gauss_newton(*solver_inputs(problem),*identity(problem),max_iter,info)
+				assert not ill_posed_system
+				lm_results.append((len(info["lm"]["active"]),point_error(problem,R_lm,t_lm)))
+
+			(lm_iter,lm_error),(lm_iter_checked,lm_error_checked) = lm_results
+			print(f"Motion:{motion} GN iterations:{model.gn_num_iter} error:{gn_error:.4f} LM iterations:{lm_iter} error:{lm_error:.4f}")
+			assert lm_iter == lm_iter_checked and abs(lm_error - lm_error_checked) < 1e-6, "Host convergence check changed the LM result"
+			assert lm_error <= 1.05*gn_error + 1e-3, f"LM error:{lm_error} larger than GN error:{gn_error}"
+			if motion <= 0.02:
+				assert lm_iter < model.gn_num_iter, f"LM did not converge early:{lm_iter} iterations"
+
+	opt.gn_lm_convergence_check_interval = check_interval
+	opt.gn_use_adaptive_lm = False
+
+def test_fused_data_term(motion=0.08,num_iter=4):
+	"""
+		The data term normal equations of the C++ extension (CPU only) should give the same solve 
+		and the same gradients w.r.t. the correspondences as the dense data jacobian.
+		On CUDA tensors the solve falls back to the dense jacobian without changing the option.
+	"""
+	model = DeformNet()
+	fused_data_term = opt.gn_use_fused_data_term
+	problem = create_problem(nx=12,ny=10,num_points=2000,motion=motion,device="cpu")
+
+	results = []
+	for fused in [False,True]:
+		opt.gn_use_fused_data_term = fused
+		inputs = solver_inputs(problem)
+		target_matches,xy_pixels_warped = inputs[4].clone().requires_grad_(),inputs[5].clone().requires_grad_()
+		inputs[4],inputs[5] = target_matches,xy_pixels_warped
+
+		R_current,t_current,_,ill_posed_system = model.solve_gauss_newton(*inputs,*identity(problem),num_iter,convergence_info())
+		assert not ill_posed_system
+		(torch.sum(t_current**2) + torch.sum(R_current)).backward()
+		results.append([R_current.detach(),t_current.detach(),target_matches.grad,xy_pixels_warped.grad])
+
+	opt.gn_use_fused_data_term = fused_data_term
+
+	for name,dense,fused in zip(["R","t","grad target_matches","grad xy_pixels_warped"],*results):
+		relative_error = (torch.norm(dense - fused)/torch.clamp(torch.norm(dense),min=1e-12)).item()
+		print(f"Fused data term {name} relative error:{relative_error:.2e}")
+		assert relative_error < 1e-3, f"Fused data term {name} differs from the dense jacobian:{relative_error}"
+
+	# CUDA tensors fall back to the dense jacobian for the solve, the option set by the user is kept
+	opt.gn_use_fused_data_term = True
+	problem = create_problem(nx=12,ny=10,num_points=2000,motion=motion,device="cuda")
+	with torch.no_grad():
+		_,_,_,ill_posed_system = model.cuda().solve_gauss_newton(*solver_inputs(problem),*identity(problem),num_iter,convergence_info())
+	assert not ill_posed_system
+	assert opt.gn_use_fused_data_term, "Solve on CUDA tensors changed opt.gn_use_fused_data_term"
+	opt.gn_use_fused_data_term = fused_data_term
@@ -2,6 +2,7 @@
 # Python Imports
 import numpy as np
 import open3d as o3d
+from pykdtree.kdtree import KDTree as KDTreeCPU
 
 # Import Fusion Modules 
 from embedded_deformation_graph import EDGraph # Create ED graph from mesh, depth image, tsdf  
@@ -58,6 +59,61 @@ class TestMesh:
 		return self.get_mesh()	
 
 
+class TestPlane:
+	"""
+		Planar grid mesh in the z=1 plane, cut by a slit along x = slit_x from y=0 up to y = slit_y. 
+		Cells of the slit below bridge_y are kept, bridging the two sides of the slit. 
+	"""
+	def __init__(self,fopt,width,height,spacing,slit_x,slit_y,bridge_y=0.0):
+		self.fopt = fopt
+		self.frame_id = fopt.source_frame
+		self.spacing = spacing
+		self.height = height
+		self.slit_x = slit_x
+		self.slit_y = slit_y
+		self.set_model(width,bridge_y)
+
+	def set_model(self,width,bridge_y):
+		# Vertices are ordered by column, extending the width appends vertices
+		nx,ny = int(round(width/self.spacing)) + 1,int(round(self.height/self.spacing)) + 1
+		xs,ys = np.meshgrid(np.arange(nx)*self.spacing,np.arange(ny)*self.spacing,indexing='ij')
+		self.vertices = np.stack([xs.reshape(-1),ys.reshape(-1),np.ones(nx*ny)],axis=1).astype(np.float32)
+
+		faces = []
+		for i in range(nx-1):
+			for j in range(ny-1):
+				x,y = i*self.spacing,j*self.spacing
+				if abs(x - self.slit_x) < 1e-6 and bridge_y - 1e-6 <= y < self.slit_y: continue
+				v = i*ny + j
+				faces.extend([[v,v + ny,v + 1],[v + 1,v + ny,v + ny + 1]])
+		self.faces = np.array(faces,dtype=np.int32)
+
+	@property
+	def world_pts(self):
+		return self.vertices
+
+	def get_mesh(self):
+		normals = np.tile(np.array([[0,0,-1]],dtype=np.float32),(self.vertices.shape[0],1))
+		return self.vertices,self.faces,normals,None
+
+	def get_canonical_model(self):
+		return self.get_mesh()
+
+
+class TestVolume(TestMesh):
+	"""
+		Mesh whose skinned points also include a shell of free space points at free_space_offset outside the surface, 
+		like the voxels of a TSDF volume
+	"""
+	def __init__(self,fopt,mesh,free_space_offset):
+		super().__init__(fopt,mesh)
+		self.free_space_pts = self.vertices*(1 + free_space_offset)
+
+	@property
+	def world_pts(self):
+		return np.concatenate([super().world_pts,self.free_space_pts])
+
+
 class Model:
 	def __init__(self):
 		pass
@@ -123,3 +179,211 @@ def test1():
 
 		# Plot deformed graph with different color 
 		vis.plot([canonical_mesh,rendered_graph_nodes,rendered_graph_edges],title="Gradually increasing speher",debug=True)
+
+
+def test_incremental_update():
+	"""
+		Gradually show the sphere and add nodes with the incremental update (EDGraph.update). 
+		Compared with a full rebuild:
+			1. The edges are the same as recomputing the edges of all nodes
+			2. Every vertex used for sampling is covered by a node (within node_coverage)
+			3. The number of nodes is close to the number of nodes of a graph created from the complete mesh 
+	"""
+	fopt = Dict2Class({"source_frame":0,\
+		"gpu":False,"visualizer":"open3d",\
+		"datadir":"/media/srialien/Elements/AT-Datasets/DeepDeform/new_test/sphere",\
+		"skip_rate":1})
+
+	# Vertices closer than the node coverage, otherwise nodes have no neighbours and are removed
+	mesh_sphere = o3d.geometry.TriangleMesh.create_sphere(radius=1,resolution=60)
+	tsdf = TestMesh(fopt,mesh_sphere)
+	tsdf.visible_verts_percentage = 30
+	graph = EDGraph(tsdf,None)
+	node_coverage = graph.graph_generation_parameters["node_coverage"]
+
+	for visible_verts_percentage in range(40,110,20):
+		tsdf.set_visisble_node_percentage(visible_verts_percentage)
+		vertices,faces = tsdf.get_canonical_model()[:2]
+
+		# Non eroded vertices outside the node coverage, sorted by decreasing distance (see WarpField.update_graph)
+		non_eroded_indices = np.where(graph.erode_mesh(vertices,faces,num_iterations=3).reshape(-1))[0]
+		dist,_ = KDTreeCPU(graph.nodes.astype(np.float32)).query(vertices[non_eroded_indices],k=1)
+		dist = dist.reshape(-1)
+		new_verts_indices = non_eroded_indices[dist > node_coverage]
+		new_verts_indices = new_verts_indices[np.argsort(dist[dist > node_coverage])[::-1]]
+
+		old_num_nodes = graph.nodes.shape[0]
+		old_version = graph.version
+		update,old_nodes_mask = graph.update(vertices,faces,new_verts_indices)
+		assert old_nodes_mask.shape[0] == old_num_nodes
+		assert graph.version > old_version or not update, "Graph version not incremented after the update"
+		num_nodes = graph.nodes.shape[0]
+
+		# 1. Incremental edges against the edges of all nodes
+		edges,edges_weights,edges_distances = graph.edges.copy(),graph.edges_weights.copy(),graph.edges_distances.copy()
+		graph.update_edges(vertices,faces,np.ones(num_nodes,dtype=bool))
+		assert np.array_equal(edges,graph.edges), "Incremental edges differ from recomputing all edges"
+		assert np.allclose(edges_weights,graph.edges_weights) and np.allclose(edges_distances,graph.edges_distances)
+
+		# 2. Coverage
+		dist,_ = KDTreeCPU(graph.nodes.astype(np.float32)).query(vertices[non_eroded_indices],k=1)
+		assert np.all(dist <= node_coverage + 1e-6), f"Vertices not covered by the graph, max distance:{dist.max()}"
+
+		# 3. Full rebuild from the current mesh
+		full_graph = EDGraph(tsdf,None)
+		print(f"Visible:{visible_verts_percentage}% Nodes:{old_num_nodes}->{num_nodes} (updated:{update}) Full rebuild nodes:{full_graph.nodes.shape[0]}")
+		assert num_nodes <= 1.5*full_graph.nodes.shape[0], "Incremental update sampled too many nodes"
+
+def test_prune_graph(num_duplicate_nodes=50):
+	"""
+		Add nodes next to existing nodes of the sphere graph and prune them (WarpField.prune_graph). 
+			1. No two nodes are closer than the merge radius 
+			2. No node is left with not enough neighbours 
+			3. The voxel skinning is the same as skinning the voxels to the pruned graph, without duplicate anchors
+			4. The deformation of the kept nodes is kept
+	"""
+	fopt = Dict2Class({"source_frame":0,\
+		"gpu":False,"visualizer":"open3d",\
+		"datadir":"/media/srialien/Elements/AT-Datasets/DeepDeform/new_test/sphere",\
+		"skip_rate":1})
+
+	mesh_sphere = o3d.geometry.TriangleMesh.create_sphere(radius=1,resolution=60)
+	tsdf = TestMesh(fopt,mesh_sphere)
+	tsdf.visible_verts_percentage = 100
+	graph = EDGraph(tsdf,None)
+	vertices,faces = tsdf.get_canonical_model()[:2]
+	merge_radius = graph.graph_generation_parameters.get("merge_node_ratio",0.5)*graph.graph_generation_parameters["node_coverage"]
+
+	# Duplicate nodes at a vertex within the merge radius of an existing node
+	dist,nearby_vertices = KDTreeCPU(vertices).query(graph.nodes.astype(np.float32),k=8)
+	nearby_vertices = nearby_vertices.astype(np.int64)
+	nearby_vertices[(dist < 1e-6) | (dist >= merge_radius)] = -1
+	duplicated_nodes = np.where(np.any(nearby_vertices >= 0,axis=1))[0][:num_duplicate_nodes]
+	duplicate_node_indices = np.array([nearby_vertices[n][nearby_vertices[n] >= 0][0] for n in duplicated_nodes],dtype=np.int32)
+	assert len(duplicate_node_indices) > 0, "No vertex within the merge radius of a node"
+
+	num_nodes = graph.nodes.shape[0]
+	num_neighbours = graph.edges.shape[1]
+	graph.nodes = np.concatenate([graph.nodes,vertices[duplicate_node_indices]])
+	graph.node_indices = np.concatenate([graph.node_indices,duplicate_node_indices.reshape(-1,1)]).astype(np.int32)
+	graph.edges = np.concatenate([graph.edges,-np.ones((len(duplicate_node_indices),num_neighbours),dtype=graph.edges.dtype)])
+	graph.edges_weights = np.concatenate([graph.edges_weights,np.zeros((len(duplicate_node_indices),num_neighbours),dtype=graph.edges_weights.dtype)])
+	graph.edges_distances = np.concatenate([graph.edges_distances,np.zeros((len(duplicate_node_indices),num_neighbours),dtype=graph.edges_distances.dtype)])
+	graph.clusters = -np.ones((graph.nodes.shape[0],1),dtype=np.int32)
+	graph.update_edges(vertices,faces,np.ones(graph.nodes.shape[0],dtype=bool))
+	graph.compute_clusters()
+
+	warpfield = WarpField(graph,tsdf,None)
+	warpfield.translations = np.random.default_rng(0).random(warpfield.translations.shape).astype(np.float32)
+	translations = warpfield.translations.copy()
+	nodes = graph.nodes.copy()
+
+	old_version = graph.version
+	assert warpfield.prune_graph(), "Duplicate nodes were not pruned"
+	assert graph.version > old_version, "Graph version not incremented after pruning"
+	print(f"Pruned graph. Nodes:{num_nodes}+{len(duplicate_node_indices)}->{graph.nodes.shape[0]}")
+
+	# 1. Merge radius
+	dist,_ = KDTreeCPU(graph.nodes.astype(np.float32)).query(graph.nodes.astype(np.float32),k=2)
+	assert np.all(dist[:,1] >= merge_radius - 1e-6), f"Nodes closer than the merge radius:{dist[:,1].min()}"
+
+	# 2. Neighbours  
+	assert np.all(graph.remove_nodes_with_not_enough_neighbours()), "Pruned graph has nodes with not enough neighbours"
+
+	# 3. Skinning
+	world_anchors,world_weights,world_valid_pts = warpfield.skin_tsdf()
+	anchors,weights,valid_pts = warpfield.skin(tsdf.world_pts)
+	assert np.array_equal(world_anchors,anchors) and np.allclose(world_weights,weights) and np.array_equal(world_valid_pts,valid_pts), "Voxel skinning differs from skinning to the pruned graph"
+	sorted_anchors = np.sort(world_anchors,axis=1)
+	assert not np.any((sorted_anchors[:,1:] == sorted_anchors[:,:-1]) & (sorted_anchors[:,1:] >= 0)), "Voxel skinned twice to the same node"
+
+	# 4. Deformation 
+	kept_nodes = KDTreeCPU(nodes.astype(np.float32)).query(graph.nodes.astype(np.float32),k=1)[1].reshape(-1)
+	assert np.allclose(warpfield.translations,translations[kept_nodes]), "Deformation of the kept nodes changed"
+
+def test_prune_unsupported_node():
+	"""
+		Add a node in free space, outside the sphere graph, and prune the graph (WarpField.prune_graph). 
+		Free space voxels are skinned to the node, but no surface point is. The node is removed and all other nodes are kept. 
+	"""
+	fopt = Dict2Class({"source_frame":0,\
+		"gpu":False,"visualizer":"open3d",\
+		"datadir":"/media/srialien/Elements/AT-Datasets/DeepDeform/new_test/sphere",\
+		"skip_rate":1})
+
+	mesh_sphere = o3d.geometry.TriangleMesh.create_sphere(radius=1,resolution=60)
+	node_coverage = 0.05
+	tsdf = TestVolume(fopt,mesh_sphere,free_space_offset=3*node_coverage)
+	tsdf.visible_verts_percentage = 100
+	graph = EDGraph(tsdf,None)
+	assert graph.graph_generation_parameters["node_coverage"] == node_coverage
+	vertices,faces = tsdf.get_canonical_model()[:2]
+
+	# Node 3*node_coverage outside the surface, farther than the skinning radius (2*node_coverage) from every vertex 
+	free_vertex = np.setdiff1d(np.arange(vertices.shape[0]),graph.node_indices.reshape(-1))[0]
+	free_node = vertices[free_vertex]*(1 + 3*node_coverage)
+
+	num_nodes = graph.nodes.shape[0]
+	num_neighbours = graph.edges.shape[1]
+	graph.nodes = np.concatenate([graph.nodes,free_node.reshape(1,3)]).astype(np.float32)
+	graph.node_indices = np.concatenate([graph.node_indices,np.array([[free_vertex]])]).astype(np.int32)
+	graph.edges = np.concatenate([graph.edges,-np.ones((1,num_neighbours),dtype=graph.edges.dtype)])
+	graph.edges_weights = np.concatenate([graph.edges_weights,np.zeros((1,num_neighbours),dtype=graph.edges_weights.dtype)])
+	graph.edges_distances = np.concatenate([graph.edges_distances,np.zeros((1,num_neighbours),dtype=graph.edges_distances.dtype)])
+	graph.clusters = -np.ones((graph.nodes.shape[0],1),dtype=np.int32)
+	graph.update_edges(vertices,faces,np.ones(graph.nodes.shape[0],dtype=bool))
+	graph.compute_clusters()
+	nodes = graph.nodes.copy()
+
+	warpfield = WarpField(graph,tsdf,None)
+	world_anchors,_,_ = warpfield.skin_tsdf()
+	assert np.any(world_anchors == num_nodes), "Free space points not skinned to the free node"
+
+	assert warpfield.prune_graph(), "Free node was not pruned"
+	print(f"Pruned graph. Nodes:{num_nodes}+1->{graph.nodes.shape[0]}")
+	assert graph.nodes.shape[0] == num_nodes and np.array_equal(graph.nodes,nodes[:num_nodes]), "Pruning changed the nodes on the surface"
+	assert warpfield.translations.shape[0] == num_nodes
+	assert not np.any(warpfield.skin_tsdf()[0] >= num_nodes), "Points skinned to a removed node"
+
+def test_update_bridged_surface():
+	"""
+		Plane cut by a slit, nodes on the two sides of the slit are close but geodesically far apart. 
+		The update extends the plane away from the slit and closes the bottom of the slit. 
+		Old nodes on the two sides of the bridge are farther than 2*node_coverage from every new node, 
+		but the bridge is a geodesic shortcut between them, their edges have to be recomputed. 
+		The edges after the update are the same as recomputing the edges of all nodes. 
+	"""
+	fopt = Dict2Class({"source_frame":0,\
+		"gpu":False,"visualizer":"open3d",\
+		"datadir":"/media/srialien/Elements/AT-Datasets/DeepDeform/new_test/sphere",\
+		"skip_rate":1})
+
+	plane = TestPlane(fopt,width=0.6,height=0.6,spacing=0.01,slit_x=0.3,slit_y=0.5)
+	graph = EDGraph(plane,None)
+	node_coverage = graph.graph_generation_parameters["node_coverage"]
+	old_num_nodes = graph.nodes.shape[0]
+	edges = graph.edges.copy()
+
+	plane.set_model(width=1.0,bridge_y=0.1)
+	vertices,faces = plane.get_canonical_model()[:2]
+
+	non_eroded_indices = np.where(graph.erode_mesh(vertices,faces,num_iterations=3).reshape(-1))[0]
+	dist,_ = KDTreeCPU(graph.nodes.astype(np.float32)).query(vertices[non_eroded_indices],k=1)
+	dist = dist.reshape(-1)
+	new_verts_indices = non_eroded_indices[dist > node_coverage]
+	new_verts_indices = new_verts_indices[np.argsort(dist[dist > node_coverage])[::-1]]
+
+	update,old_nodes_mask = graph.update(vertices,faces,new_verts_indices)
+	assert update and np.all(old_nodes_mask), "Update did not add nodes or removed old nodes"
+
+	# Old nodes across the bridge, not reached by any new node, gained edges 
+	dist_to_new_nodes,_ = KDTreeCPU(graph.nodes[old_num_nodes:].astype(np.float32)).query(graph.nodes[:old_num_nodes].astype(np.float32),k=1)
+	bridged_nodes = np.any(graph.edges[:old_num_nodes] != edges,axis=1) & (dist_to_new_nodes.reshape(-1) > 2*node_coverage)
+	print(f"Bridged surface. Nodes:{old_num_nodes}->{graph.nodes.shape[0]} Old nodes with new edges across the bridge:{np.sum(bridged_nodes)}")
+	assert np.any(bridged_nodes), "No node far from the new nodes gained edges across the bridge"
+
+	# Incremental edges against the edges of all nodes
+	edges,edges_weights,edges_distances = graph.edges.copy(),graph.edges_weights.copy(),graph.edges_distances.copy()
+	graph.update_edges(vertices,faces,np.ones(graph.nodes.shape[0],dtype=bool))
+	assert np.array_equal(edges,graph.edges), "Incremental edges differ from recomputing all edges"
+	assert np.allclose(edges_weights,graph.edges_weights) and np.allclose(edges_distances,graph.edges_distances)
@@ -5,7 +5,7 @@ import torch
 import numpy as np
 import logging
 # Modules (make sure modules are visible in sys.path)
-from model.model import DeformNet
+from model.model import DeformNet, GaussNewtonPlan
 
 import options as opt
 
@@ -13,7 +13,17 @@ class Deformnet_runner():
 	"""
 		Runs deformnet to outputs result
 	"""
-	def __init__(self):
+
+	# DeformNet outputs used by fusion (registration and plotting the alignment)
+	FUSION_OUTPUTS = {"node_rotations","node_translations","valid_solve","mask_pred",
+		"target_matches","valid_source_points","valid_correspondences"}
+
+	def __init__(self,outputs=FUSION_OUTPUTS,device_resident=True):
+		"""
+			@params:
+				outputs: set of DeformNet outputs to compute and copy to host, see DeformNet.forward. All outputs if None. 
+				device_resident: Keep graph data (edges, weights, clusters, ...) on the device between frames and only transfer it again after it changes  
+		"""
 
 		#####################################################################################################
 		# Options
@@ -55,9 +65,73 @@ class Deformnet_runner():
 
 		self.model.eval()
 
+		self.outputs = outputs
+
+		# Device copies of data which only changes when the graph is updated  
+		self.device_resident = device_resident
+		self.device_tensors = {}
+
+		# Gauss-Newton solver plans, reused while the graph topology doesn't change
+		self.solver_plans = {}
+
 		# Set logging level 
 		self.log = logging.getLogger(__name__)
 
+	def to_device(self,name,array,version):
+		"""
+			Returns array as a cuda tensor. In device resident mode the tensor is kept and 
+			returned again while the version of the data doesn't change, hence it is transferred only after graph updates. 
+
+			@params:
+				name: str: Unique name of the data, e.g "arap_graph_edges"
+				array: np.ndarray
+				version: hashable: Changes whenever the array changes, e.g EDGraph.version for the graph 
+		"""
+		if self.device_resident and name in self.device_tensors:
+			cached_version,tensor = self.device_tensors[name]
+			if cached_version == version:
+				return tensor
+
+		tensor = torch.from_numpy(array).cuda()
+
+		if self.device_resident:
+			self.log.debug(f"Updating device data:{name}")
+			self.device_tensors[name] = (version,tensor)
+
+		return tensor
+
+	def get_reduced_graph_version(self,valid_nodes_mask):
+		"""
+			Version of the reduced graph, it only changes with graph updates or the visibility of the nodes 
+		"""
+		return (self.graph.version,np.asarray(valid_nodes_mask,dtype=bool).tobytes())
+
+	def get_solver_plan(self,name,version,graph_edges,graph_edges_weights,graph_clusters=None):
+		"""
+			Returns the cached solver plan if the graph version is the same
+			as in the previous call for this solve, else computes a new plan. 
+
+			@params:
+				name: str: Which solve the plan is used for ("deformnet" or "arap") 
+				version: hashable: Version of the graph, see to_device
+				graph_edges: np.ndarray(int32): (N,K)
+				graph_edges_weights: np.ndarray(float32): (N,K)
+				graph_clusters: np.ndarray(int32): (N,1) 
+		"""
+		if name in self.solver_plans:
+			cached_version,plan = self.solver_plans[name]
+			if cached_version == version:
+				return plan
+
+		self.log.debug(f"Computing new solver plan for:{name}")
+		plan = GaussNewtonPlan.from_graph(self.to_device(f"{name}_graph_edges",graph_edges,version),
+			self.to_device(f"{name}_graph_edges_weights",graph_edges_weights,version),
+			self.to_device(f"{name}_graph_clusters",graph_clusters,version) if graph_clusters is not None else None)
+
+		self.solver_plans[name] = (version,plan)
+
+		return plan
+
 	def __call__(self,source_data,target_data,graph_data,skin_data):
 		"""
 			Main Module to run the Neural Tracking estimator 
@@ -67,24 +141,28 @@ class Deformnet_runner():
 
 		source_cuda               = torch.from_numpy(source_data["im"]).cuda().unsqueeze(0)
 		target_cuda               = torch.from_numpy(target_data["im"]).cuda().unsqueeze(0)
-		target_boundary_mask_cuda = torch.from_numpy(target_data["target_boundary_mask"]).cuda().unsqueeze(0)
+
+		graph_nodes_cuda          = torch.from_numpy(graph_data["valid_nodes_at_source"]).cuda().unsqueeze(0)
 
 		# Send the canonical position to calculate arap loss, Not sure why doesn't work. Sending deformed nodes for now  
 		# canonical_cuda 			  = torch.from_numpy(self.graph.nodes[graph_data["valid_nodes_mask"]]).cuda().unsqueeze(0)
-		canonical_cuda 			  = torch.from_numpy(graph_data["valid_nodes_at_source"]).cuda().unsqueeze(0)
+		canonical_cuda 			  = graph_nodes_cuda
 
-		graph_nodes_cuda          = torch.from_numpy(graph_data["valid_nodes_at_source"]).cuda().unsqueeze(0)
-		graph_edges_cuda          = torch.from_numpy(graph_data["graph_edges"]).cuda().unsqueeze(0)
-		graph_edges_weights_cuda  = torch.from_numpy(graph_data["graph_edges_weights"]).cuda().unsqueeze(0)
-		graph_clusters_cuda       = torch.from_numpy(graph_data["graph_clusters"]).cuda().unsqueeze(0)
+		# Reduced graph only changes with the visibility of nodes or graph updates
+		reduced_graph_version     = self.get_reduced_graph_version(graph_data["valid_nodes_mask"])
+		graph_edges_cuda          = self.to_device("deformnet_graph_edges",graph_data["graph_edges"],reduced_graph_version).unsqueeze(0)
+		graph_edges_weights_cuda  = self.to_device("deformnet_graph_edges_weights",graph_data["graph_edges_weights"],reduced_graph_version).unsqueeze(0)
+		graph_clusters_cuda       = self.to_device("deformnet_graph_clusters",graph_data["graph_clusters"],reduced_graph_version).unsqueeze(0)
 		pixel_anchors_cuda        = torch.from_numpy(skin_data["pixel_anchors"]).cuda().unsqueeze(0)
 		pixel_weights_cuda        = torch.from_numpy(skin_data["pixel_weights"]).cuda().unsqueeze(0)
-		intrinsics_cuda           = torch.from_numpy(source_data["intrinsics"]).cuda().unsqueeze(0)
+		intrinsics_cuda           = self.to_device("intrinsics",source_data["intrinsics"],source_data["intrinsics"].tobytes()).unsqueeze(0)
 
-		num_nodes_cuda            = torch.from_numpy(graph_data["num_nodes"]).cuda().unsqueeze(0)
+		num_nodes_cuda            = self.to_device("deformnet_num_nodes",graph_data["num_nodes"],reduced_graph_version).unsqueeze(0)
 		prev_rot = None
 		prev_trans = None
 
+		solver_plan = self.get_solver_plan("deformnet",reduced_graph_version,graph_data["graph_edges"],graph_data["graph_edges_weights"],graph_data["graph_clusters"])
+
 		
 		# Check all objects map have same number of nodes
 		print([canonical_cuda.shape[1],graph_nodes_cuda.shape[1],graph_edges_cuda.shape[1],graph_edges_weights_cuda.shape[1]])
@@ -106,32 +184,32 @@ class Deformnet_runner():
 				evaluate=True, split="test",
 				prev_rot=prev_rot,
 				prev_trans=prev_trans,
+				solver_plans=[solver_plan],
+				outputs=self.outputs
 			)	
 
 		# Post Process output   
 		model_data["node_rotations"]    = model_data["node_rotations"].view(-1, 3, 3).cpu().numpy()
 		model_data["node_translations"] = model_data["node_translations"].view(-1, 3).cpu().numpy()
 		
-		assert model_data["mask_pred"] is not None, "Make sure use_mask=True in options.py"
-		model_data["mask_pred"] = model_data["mask_pred"].view(-1, opt.image_height, opt.image_width).cpu().numpy()
+		if "mask_pred" in model_data:
+			assert model_data["mask_pred"] is not None, "Make sure use_mask=True in options.py"
+			model_data["mask_pred"] = model_data["mask_pred"].view(-1, opt.image_height, opt.image_width).cpu().numpy()
 
 		# Correspondence info
-		xy_coords_warped,\
-		source_points, valid_source_points,\
-		target_matches, valid_target_matches,\
-		valid_correspondences, deformed_points_idxs, deformed_points_subsampled = model_data["correspondence_info"].values()
-
-		model_data["target_matches"]        = target_matches.view(-1, opt.image_height, opt.image_width).cpu().numpy()
-		model_data["valid_source_points"]   = valid_source_points.view(-1, opt.image_height, opt.image_width).cpu().numpy()
-		# model_data["valid_target_matches"]  = valid_target_matches.view(-1, opt.image_height, opt.image_width).cpu().numpy()
-		model_data["valid_correspondences"] = valid_correspondences.view(-1, opt.image_height, opt.image_width).cpu().numpy()
+		correspondence_info = model_data.get("correspondence_info",{})
+		for k in ["target_matches","valid_source_points","valid_correspondences"]:
+			if k in correspondence_info:
+				model_data[k] = correspondence_info.pop(k).view(-1, opt.image_height, opt.image_width).cpu().numpy()
+		if len(correspondence_info) == 0: model_data.pop("correspondence_info",None)
+
 		model_data["deformed_nodes_to_target"] = graph_data["valid_nodes_at_source"] + model_data["node_translations"]
 
 		model_data["source_frame_id"] = source_data["id"]
 		model_data["target_frame_id"] = target_data["id"]
 
 		# TODO: ? Might be important later. 
-		del model_data["flow_data"]
+		model_data.pop("flow_data",None)
 		
 
 		model_data = self.dict_to_numpy(model_data)
@@ -303,11 +381,12 @@ class Deformnet_runner():
 		source_node_position_cuda   = torch.from_numpy(reduced_graph_dict["valid_nodes_at_source"]).cuda()	 # Position of valid graph nodes at source frame	
 		target_node_position_cuda= torch.from_numpy(model_data["deformed_nodes_to_target"]).cuda() # Position of valid nodes at target frame		
 
-		valid_nodes_mask_cuda = torch.from_numpy(valid_nodes_mask).cuda()
+		valid_nodes_mask_cuda = self.to_device("valid_nodes_mask",valid_nodes_mask,self.get_reduced_graph_version(valid_nodes_mask))
 		
-		graph_edges_cuda          = torch.from_numpy(graph.edges).cuda()
-		graph_edges_weights_cuda  = torch.from_numpy(graph.edges_weights).cuda()
-		graph_clusters_cuda       = torch.from_numpy(graph.clusters).cuda().unsqueeze(0)
+		# Complete graph only changes with graph updates
+		graph_edges_cuda          = self.to_device("arap_graph_edges",graph.edges,graph.version)
+		graph_edges_weights_cuda  = self.to_device("arap_graph_edges_weights",graph.edges_weights,graph.version)
+		graph_clusters_cuda       = self.to_device("arap_graph_clusters",graph.clusters,graph.version).unsqueeze(0)
 
 		R_current_cuda 			  =	torch.from_numpy(R_current).cuda()
 		T_current_cuda 			  =	torch.from_numpy(T_current).cuda()
@@ -316,7 +395,7 @@ class Deformnet_runner():
 		# Send arap graph in original position for calculating arap.  
 		# canonical_all_node_cuda = torch.from_numpy(graph.nodes).cuda() # Not sure why but this doens't work. Maybe the displacement changed between the current and deformed position causes problems 
 		
-		canonical_all_node_cuda = torch.from_numpy(reduced_graph_dict["all_nodes_at_source"]).cuda()
+		canonical_all_node_cuda = source_all_nodes_cuda
 		
 
 		assert source_node_position_cuda.shape[0] == target_node_position_cuda.shape[0], f"Source != Target. shapes:{source_node_position_cuda.shape} {target_node_position_cuda.shape}"
@@ -331,7 +410,8 @@ class Deformnet_runner():
 			valid_nodes_mask_cuda,
 			canonical_all_node_cuda,
 			graph_edges_cuda,graph_edges_weights_cuda,graph_clusters_cuda,
-			R_current_cuda,T_current_cuda)
+			R_current_cuda,T_current_cuda,
+			solver_plan=self.get_solver_plan("arap",graph.version,graph.edges,graph.edges_weights))
 
 		arap_data = self.dict_to_numpy(arap_data)
 		arap_data["deformed_nodes_to_target"] = reduced_graph_dict["all_nodes_at_source"] + arap_data["node_translations"]
@@ -16,6 +16,8 @@ from warpfield import WarpField # Connects ED Graph and TSDF/Mesh/Whatever needs
 from fusion_tests import deformation_test
 from fusion_tests import arap_tests
 from fusion_tests import update_graph_test
+from fusion_tests import solver_tests
+from fusion_tests import pipeline_test
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger('numba').setLevel(logging.WARNING)
@@ -24,6 +26,10 @@ logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
 logging.getLogger('embedded_deformation_graph').setLevel(logging.DEBUG)
 update_graph_test.test1()
+update_graph_test.test_incremental_update()
+update_graph_test.test_update_bridged_surface()
+update_graph_test.test_prune_graph()
+update_graph_test.test_prune_unsupported_node()
 logging.getLogger('embedded_deformation_graph').setLevel(logging.INFO)
 
 
@@ -38,5 +44,17 @@ logging.getLogger('warpfield').setLevel(logging.DEBUG)
 deformation_test.test1(use_gpu=False)
 deformation_test.test1(use_gpu=True)
 deformation_test.test2(use_gpu=False)
+deformation_test.test_raycast_sphere(use_gpu=False)
 logging.getLogger('warpfield').setLevel(logging.INFO)
 print("Completed deformation tests")
+
+print("Running solver tests")
+solver_tests.test_hierarchical_solve()
+solver_tests.test_adaptive_lm()
+solver_tests.test_fused_data_term()
+print("Completed solver tests")
+
+print("Running pipeline tests")
+pipeline_test.test_pipeline()
+pipeline_test.test_pipeline(num_frames=10,skip_rate=3)
+print("Completed pipeline tests")
\ No newline at end of file
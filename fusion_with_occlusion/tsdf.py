@@ -3,6 +3,7 @@
 # Library imports
 import os
 import sys
+import copy
 import pickle
 import numpy as np
 import logging 
@@ -28,10 +29,112 @@ except Exception as err:
 # Modules
 sys.path.append("../")
 import options as opt
+from utils import se3
 
 
 torch.cuda.init()  # any torch cuda initialization before pycuda calls, torch.randn(10).cuda() works too
 
+@njit(nogil=True)
+def _sample_tsdf(tsdf_vol, weight_vol, x):
+    """
+        Trilinear interpolation of the TSDF at voxel coordinates x
+
+        @returns:
+            valid: bool: False if any of the 8 surrounding voxels was never integrated
+            value: float
+    """
+    i, j, k = int(np.floor(x[0])), int(np.floor(x[1])), int(np.floor(x[2]))
+    if i < 0 or j < 0 or k < 0 or i+1 >= tsdf_vol.shape[0] or j+1 >= tsdf_vol.shape[1] or k+1 >= tsdf_vol.shape[2]:
+        return False, 0.
+    
+    a, b, c = x[0]-i, x[1]-j, x[2]-k
+    value = 0.
+    for di in range(2):
+        for dj in range(2):
+            for dk in range(2):
+                if weight_vol[i+di, j+dj, k+dk] <= 0:
+                    return False, 0.
+                w = (a if di else 1-a)*(b if dj else 1-b)*(c if dk else 1-c)
+                value += w*tsdf_vol[i+di, j+dj, k+dk]
+    return True, value
+
+@njit(nogil=True)
+def _inverse_warp(x, nodes, rotations, translations, grid_origin, grid_dims, node_order, cell_start, node_coverage, best_dist, best_node, A, b, x_canonical):
+    """
+        Canonical position of a live point x. 
+        The anchors are the K nearest live nodes within 2*node_coverage, 
+        their transformations are blended (LBS) into A x + b which is inverted. 
+
+        @params: 
+            best_dist, best_node: (K) np.ndarray: scratch buffers, K is the number of anchors 
+            A: (3x3) np.ndarray: output, blended rotation 
+            b: (3) np.ndarray: output, blended translation 
+            x_canonical: (3) np.ndarray: output 
+
+        @returns:
+            valid: bool: False if no node is close to x  
+    """
+    K = best_dist.shape[0]
+    cell_size = 2*node_coverage
+    radius2 = cell_size*cell_size
+    for n in range(K):
+        best_dist[n] = np.inf
+        best_node[n] = -1
+
+    cx = int(np.floor((x[0] - grid_origin[0])/cell_size))
+    cy = int(np.floor((x[1] - grid_origin[1])/cell_size))
+    cz = int(np.floor((x[2] - grid_origin[2])/cell_size))
+    for gx in range(max(cx-1, 0), min(cx+2, grid_dims[0])):
+        for gy in range(max(cy-1, 0), min(cy+2, grid_dims[1])):
+            for gz in range(max(cz-1, 0), min(cz+2, grid_dims[2])):
+                key = (gx*grid_dims[1] + gy)*grid_dims[2] + gz
+                for s in range(cell_start[key], cell_start[key+1]):
+                    node = node_order[s]
+                    d2 = (x[0]-nodes[node, 0])**2 + (x[1]-nodes[node, 1])**2 + (x[2]-nodes[node, 2])**2
+                    if d2 > radius2 or d2 >= best_dist[K-1]:
+                        continue
+                    # Insertion sort
+                    n = K-1
+                    while n > 0 and best_dist[n-1] > d2:
+                        best_dist[n] = best_dist[n-1]
+                        best_node[n] = best_node[n-1]
+                        n -= 1
+                    best_dist[n] = d2
+                    best_node[n] = node
+
+    if best_node[0] == -1:
+        return False
+
+    A[:] = 0
+    b[:] = 0
+    total_weight = 0.
+    for n in range(K):
+        if best_node[n] == -1:
+            break
+        w = np.exp(-best_dist[n]/(2*node_coverage*node_coverage))
+        total_weight += w
+        for r in range(3):
+            b[r] += w*translations[best_node[n], r]
+            for c in range(3):
+                A[r, c] += w*rotations[best_node[n], r, c]
+    if total_weight <= 0:
+        return False
+    A /= total_weight
+    b /= total_weight
+
+    # x_canonical = A^-1 (x - b) using the adjugate 
+    y0, y1, y2 = x[0]-b[0], x[1]-b[1], x[2]-b[2]
+    c00 = A[1, 1]*A[2, 2] - A[1, 2]*A[2, 1]
+    c01 = A[1, 2]*A[2, 0] - A[1, 0]*A[2, 2]
+    c02 = A[1, 0]*A[2, 1] - A[1, 1]*A[2, 0]
+    det = A[0, 0]*c00 + A[0, 1]*c01 + A[0, 2]*c02
+    if abs(det) < 1e-6:
+        return False
+    x_canonical[0] = (c00*y0 + (A[0, 2]*A[2, 1] - A[0, 1]*A[2, 2])*y1 + (A[0, 1]*A[1, 2] - A[0, 2]*A[1, 1])*y2)/det
+    x_canonical[1] = (c01*y0 + (A[0, 0]*A[2, 2] - A[0, 2]*A[2, 0])*y1 + (A[0, 2]*A[1, 0] - A[0, 0]*A[1, 2])*y2)/det
+    x_canonical[2] = (c02*y0 + (A[0, 1]*A[2, 0] - A[0, 0]*A[2, 1])*y1 + (A[0, 0]*A[1, 1] - A[0, 1]*A[1, 0])*y2)/det
+    return True
+
 class TSDFVolume:
     """
         Volumetric TSDF Fusion of RGB-D Images.
@@ -275,7 +378,7 @@ class TSDFVolume:
         return xyz_t_h[:, :3]
 
     @staticmethod
-    @njit(parallel=True)
+    @njit(parallel=True, nogil=True)
     def vox2world(vol_origin, vox_coords, vox_size):
         """Convert voxel grid coordinates to world coordinates.
         """
@@ -288,7 +391,7 @@ class TSDFVolume:
         return cam_pts
 
     @staticmethod
-    @njit(parallel=True)
+    @njit(parallel=True, nogil=True)
     def cam2pix(cam_pts, intr):
         """
             Convert camera coordinates to pixel coordinates.
@@ -303,7 +406,7 @@ class TSDFVolume:
         return pix
 
     @staticmethod
-    @njit(parallel=True)
+    @njit(parallel=True, nogil=True)
     def integrate_tsdf(tsdf_vol, dist, w_old, obs_weight):
         """Integrate the TSDF volume.
         """
@@ -578,7 +681,7 @@ class TSDFVolume:
             pycuda_ctx.pop()
 
     @staticmethod
-    @njit(parallel=True)
+    @njit(parallel=True, nogil=True)
     def compute_truncated_region(tsdf_vol,max_diff):
         """
             Find truncated region in tsdf, 
@@ -594,7 +697,7 @@ class TSDFVolume:
         truncated_region = np.ones_like(tsdf_vol, dtype=bool_)
         W,H,D = tsdf_vol.shape
         for i in prange(W*H*D):
-            w = i//(H*W)
+            w = i//(H*D)
             h = (i//D)%H
             d = i%D
 
@@ -710,6 +813,183 @@ class TSDFVolume:
     def save_deformed_mesh(self):
         pass
 
+    @staticmethod
+    @njit(parallel=True, nogil=True)
+    def raycast_depth_range(node_bounds, z_range, im_h, im_w):
+        """
+            Splat the screen space footprint of every live node, 
+            rays of pixels outside all footprints cannot hit the deformed surface 
+
+            @params:
+                node_bounds: (Nx4) np.ndarray(int): u_min, u_max, v_min, v_max of the footprint of each node 
+                z_range: (Nx2) np.ndarray: depth range of each node's footprint 
+
+            @returns:
+                z_near, z_far: (HxW) np.ndarray: depth interval to march for each pixel, z_near > z_far if no node covers the pixel   
+        """
+        z_near = np.full((im_h, im_w), np.inf)
+        z_far = np.full((im_h, im_w), -np.inf)
+        for v in prange(im_h):
+            for n in range(node_bounds.shape[0]):
+                if v < node_bounds[n, 2] or v > node_bounds[n, 3]:
+                    continue
+                for u in range(node_bounds[n, 0], node_bounds[n, 1]+1):
+                    z_near[v, u] = min(z_near[v, u], z_range[n, 0])
+                    z_far[v, u] = max(z_far[v, u], z_range[n, 1])
+        return z_near, z_far
+
+    @staticmethod
+    @njit(parallel=True, nogil=True)
+    def raycast_kernel(tsdf_vol, weight_vol, color_vol, vol_origin, voxel_size, trunc_margin, color_const, intr, z_near, z_far, 
+            nodes, rotations, translations, grid_origin, grid_dims, node_order, cell_start, node_coverage, num_anchors, 
+            point_im, normal_im, color_im):
+        """
+            March the ray of each pixel through the warped TSDF until the first +ve to -ve zero crossing.
+            Each sample is mapped to the canonical volume using the inverse of its blended node transformation. 
+            Steps are a fraction of the sampled distance in the truncated region, half the node coverage outside the influence of the nodes and a voxel elsewhere. 
+
+            @params:
+                intr: (3x3) np.ndarray: camera intrinsics 
+                z_near, z_far: (HxW) np.ndarray: depth interval to march for each pixel 
+                nodes: (Nx3) np.ndarray: live (deformed) node positions 
+                rotations, translations: transformations of the nodes w.r.t origin 
+                grid_origin, grid_dims, node_order, cell_start: grid of live nodes, see WarpField.build_node_grid
+
+            @returns: (Filled inplace)
+                point_im, normal_im, color_im: (3xHxW) np.ndarray: live point, normal and rgb ([0,1]) of the surface hit by each ray
+        """
+        im_h, im_w = z_near.shape
+        fx, fy, cx, cy = intr[0, 0], intr[1, 1], intr[0, 2], intr[1, 2]
+        for v in prange(im_h):
+            best_dist = np.empty(num_anchors)
+            best_node = np.empty(num_anchors, dtype=np.int64)
+            A = np.empty((3, 3))
+            b = np.empty(3)
+            x = np.empty(3)
+            x_canonical = np.empty(3)
+            x_voxel = np.empty(3)
+            for u in range(im_w):
+                if z_near[v, u] > z_far[v, u]:
+                    continue
+                ray_x = (u - cx)/fx
+                ray_y = (v - cy)/fy
+                ray_norm = np.sqrt(ray_x*ray_x + ray_y*ray_y + 1)
+
+                z = z_near[v, u]
+                prev_valid = False
+                prev_f = 0.
+                prev_z = 0.
+                while z <= z_far[v, u]:
+                    x[0], x[1], x[2] = ray_x*z, ray_y*z, z
+                    valid = False
+                    f = 0.
+                    warped = _inverse_warp(x, nodes, rotations, translations, grid_origin, grid_dims, node_order, cell_start, node_coverage, best_dist, best_node, A, b, x_canonical)
+                    if warped:
+                        for i in range(3):
+                            x_voxel[i] = (x_canonical[i] - vol_origin[i])/voxel_size
+                        valid, f = _sample_tsdf(tsdf_vol, weight_vol, x_voxel)
+
+                    if valid and prev_valid and prev_f > 0 and f <= 0:
+                        # Linear interpolation of the zero crossing 
+                        z_hit = prev_z + (z - prev_z)*prev_f/(prev_f - f)
+                        x[0], x[1], x[2] = ray_x*z_hit, ray_y*z_hit, z_hit
+                        point_im[0, v, u], point_im[1, v, u], point_im[2, v, u] = x[0], x[1], x[2]
+
+                        if not _inverse_warp(x, nodes, rotations, translations, grid_origin, grid_dims, node_order, cell_start, node_coverage, best_dist, best_node, A, b, x_canonical):
+                            break
+                        for i in range(3):
+                            x_voxel[i] = (x_canonical[i] - vol_origin[i])/voxel_size
+
+                        # Normal from the central difference of the canonical TSDF, rotated by the blended transformation 
+                        gradient = np.zeros(3)
+                        gradient_valid = True
+                        for i in range(3):
+                            x_voxel[i] += 1
+                            valid_plus, f_plus = _sample_tsdf(tsdf_vol, weight_vol, x_voxel)
+                            x_voxel[i] -= 2
+                            valid_minus, f_minus = _sample_tsdf(tsdf_vol, weight_vol, x_voxel)
+                            x_voxel[i] += 1
+                            gradient_valid = gradient_valid and valid_plus and valid_minus
+                            gradient[i] = f_plus - f_minus
+                        if gradient_valid:
+                            normal = A @ gradient
+                            normal_length = np.sqrt(normal[0]**2 + normal[1]**2 + normal[2]**2)
+                            if normal_length > 0:
+                                for i in range(3):
+                                    normal_im[i, v, u] = normal[i]/normal_length
+
+                        # Color of the nearest voxel 
+                        i, j, k = int(np.round(x_voxel[0])), int(np.round(x_voxel[1])), int(np.round(x_voxel[2]))
+                        i = min(max(i, 0), color_vol.shape[0]-1)
+                        j = min(max(j, 0), color_vol.shape[1]-1)
+                        k = min(max(k, 0), color_vol.shape[2]-1)
+                        rgb_val = color_vol[i, j, k]
+                        color_b = np.floor(rgb_val/color_const)
+                        color_g = np.floor((rgb_val - color_b*color_const)/256)
+                        color_r = rgb_val - color_b*color_const - color_g*256
+                        color_im[0, v, u], color_im[1, v, u], color_im[2, v, u] = color_r/255, color_g/255, color_b/255
+                        break
+
+                    prev_valid, prev_f, prev_z = valid, f, z
+                    if valid and f > 0:
+                        z += max(voxel_size, 0.8*f*trunc_margin)/ray_norm
+                    elif not warped: # Far from the nodes, the surface lies within node_coverage of a node 
+                        z += max(voxel_size, 0.5*node_coverage)/ray_norm
+                    else:
+                        z += voxel_size/ray_norm
+
+    def raycast(self):
+        """
+            Render the deformed model from the camera by raycasting the TSDF through the warpfield. 
+            Unlike get_deformed_model, no mesh is extracted, the cost scales with the image size. 
+
+            @returns: 
+                rendered_data: dict 
+                    "im": (6xHxW) np.ndarray: rgb ([0,1]) and live points, 0 for pixels whose ray hits no surface 
+                    "normals": (3xHxW) np.ndarray
+                    "valid": (HxW) np.ndarray(bool): pixels whose ray hit the surface 
+        """
+        tsdf_vol, color_vol, weight_vol = self.get_volume()
+        warpfield = self.warpfield
+        im_h = opt.image_height
+        im_w = opt.image_width
+
+        # Transformations and positions of nodes at the live frame 
+        rotations = warpfield.rotations.astype(np.float64)
+        translations = warpfield.translations.astype(np.float64)
+        nodes = se3.apply(rotations, translations, warpfield.graph.nodes.astype(np.float64))
+        grid_origin, grid_dims, node_order, cell_start = warpfield.build_node_grid(nodes)
+
+        # Screen space bounding box of the sphere of influence (radius 2*node_coverage) of each node in front of the camera 
+        radius = 2*warpfield.node_coverage
+        z_range = np.stack([np.maximum(nodes[:, 2] - radius, 1e-3), nodes[:, 2] + radius], axis=1)
+        fx, fy, cx, cy = self.cam_intr[0, 0], self.cam_intr[1, 1], self.cam_intr[0, 2], self.cam_intr[1, 2]
+        x_min = (nodes[:, 0:2] - radius)[:, :, None]/z_range[:, None, :]
+        x_max = (nodes[:, 0:2] + radius)[:, :, None]/z_range[:, None, :]
+        node_bounds = np.stack([
+            np.floor(fx*x_min[:, 0].min(axis=1) + cx), np.ceil(fx*x_max[:, 0].max(axis=1) + cx),
+            np.floor(fy*x_min[:, 1].min(axis=1) + cy), np.ceil(fy*x_max[:, 1].max(axis=1) + cy)], axis=1)
+        visible_nodes = (nodes[:, 2] + radius > 0) & (node_bounds[:, 0] < im_w) & (node_bounds[:, 1] >= 0) & (node_bounds[:, 2] < im_h) & (node_bounds[:, 3] >= 0)
+        node_bounds[:, 0:2] = np.clip(node_bounds[:, 0:2], 0, im_w-1)
+        node_bounds[:, 2:4] = np.clip(node_bounds[:, 2:4], 0, im_h-1)
+        z_near, z_far = self.raycast_depth_range(node_bounds[visible_nodes].astype(np.int64), z_range[visible_nodes], im_h, im_w)
+
+        point_im = np.zeros((3, im_h, im_w))
+        normal_im = np.zeros((3, im_h, im_w))
+        color_im = np.zeros((3, im_h, im_w))
+        self.raycast_kernel(tsdf_vol, weight_vol, color_vol, self._vol_origin.astype(np.float64), self._voxel_size, self._trunc_margin, float(self._color_const), self.cam_intr, z_near, z_far, 
+            nodes, rotations, translations, grid_origin.astype(np.float64), grid_dims, node_order, cell_start, float(warpfield.node_coverage), warpfield.graph_neighbours, 
+            point_im, normal_im, color_im)
+
+        return {"im": np.concatenate([color_im, point_im], axis=0), "normals": normal_im, "valid": point_im[2] > 0}
+
+    def get_raycasted_model(self):
+        # Check model rendered at current frame 
+        if hasattr(self,'raycasted_model'): return self.raycasted_model
+
+        self.raycasted_model = self.raycast()
+        return self.raycasted_model
+
     def clear(self):
         """
             Remove data from previous frame registration to make sure consistant data is used cross modules
@@ -721,8 +1001,42 @@ class TSDFVolume:
         # del self.depth_im
 
         # Clear graph data 
-        del self.reduced_graph_dict
+        if hasattr(self,"reduced_graph_dict"): del self.reduced_graph_dict
 
-        # Clear mesh data
-        del self.deformed_model
-        del self.canonical_model
\ No newline at end of file
+        # Clear mesh data, not computed if the frame was visualized on a snapshot
+        if hasattr(self,"deformed_model"): del self.deformed_model
+        if hasattr(self,"canonical_model"): del self.canonical_model
+        if hasattr(self,"raycasted_model"): del self.raycasted_model
+
+    def snapshot(self):
+        """
+            Copy of the TSDF (with its warpfield and graph) at the current frame, 
+            used to extract the models while the next frame is registered. 
+            Integration updates the volume inplace, hence only the integrated region of the volume is copied to host (with a 1 voxel border), 
+            the weights only if the deformed model is raycasted. Other data is replaced, not modified, hence is shared. 
+        """
+        tsdf_vol, color_vol, weight_vol = self.get_volume()
+
+        # Bounding box of the integrated voxels, voxels outside were never observed and contain no surface 
+        crop = []
+        for axis in range(3):
+            observed = np.where(np.any(weight_vol > 0, axis=tuple(a for a in range(3) if a != axis)))[0]
+            if len(observed) == 0: # Nothing integrated, copy a single voxel
+                observed = np.zeros(1, dtype=int)
+            crop.append(slice(max(observed[0]-1, 0), observed[-1]+2))
+        crop = tuple(crop)
+
+        tsdf = copy.copy(self)
+        tsdf._tsdf_vol_cpu = tsdf_vol[crop].copy()
+        tsdf._color_vol_cpu = color_vol[crop].copy()
+        tsdf._weight_vol_cpu = weight_vol[crop].copy() if self.fopt.deformed_model == "raycast" else None
+        tsdf._vol_origin = (self._vol_origin + np.array([s.start for s in crop])*self._voxel_size).astype(np.float32)
+        tsdf._vol_dim = np.array(tsdf._tsdf_vol_cpu.shape)
+        tsdf.gpu_mode = False # Volume only on host 
+
+        tsdf.graph = copy.copy(self.graph)
+        tsdf.warpfield = copy.copy(self.warpfield)
+        tsdf.warpfield.graph = tsdf.graph
+        tsdf.warpfield.tsdf = tsdf
+
+        return tsdf
\ No newline at end of file
@@ -87,9 +87,27 @@ class VisualizeOpen3D(Visualizer):
 	def get_deformed_model_from_tsdf(self,trans=np.zeros((3,1))):
 		assert hasattr(self,'tsdf'),  "TSDF not defined. Add tsdf as attribute to visualizer first." 
 
+		if self.opt.deformed_model == "raycast":
+			return self.get_raycasted_model_from_tsdf(trans=trans)
+
 		verts,faces,normals,colors = self.tsdf.get_deformed_model()
 		return self.get_mesh(verts,faces,trans=trans,color=colors,normals=normals)
 
+	def get_raycasted_model_from_tsdf(self,trans=np.zeros((3,1))):
+		"""
+			Deformed model as a point cloud rendered by raycasting the TSDF from the camera (No marching cubes)
+		"""
+		assert hasattr(self,'tsdf'),  "TSDF not defined. Add tsdf as attribute to visualizer first." 
+
+		rendered_data = self.tsdf.get_raycasted_model()
+		valid = rendered_data["valid"]
+
+		deformed_pcd = viz_utils.get_pcd(rendered_data["im"][:,valid].reshape(6,1,-1))
+		deformed_pcd.normals = o3d.utility.Vector3dVector(viz_utils.transform_pointcloud_to_opengl_coords(rendered_data["normals"][:,valid].T))
+		deformed_pcd.translate(trans)
+
+		return deformed_pcd
+
 	@staticmethod	
 	def get_rendered_graph(nodes,edges,color=None,trans=np.zeros((1,3))):
 		"""
@@ -11,11 +11,10 @@ from numba import njit, prange
 from pykdtree.kdtree import KDTree as KDTreeCPU
 
 # Neural Tracking modules 
-from utils import utils, image_proc
-from NeuralNRT._C import compute_mesh_from_depth as compute_mesh_from_depth_c
+from utils import utils, image_proc, dual_quaternion, se3
 
 class WarpField:
-    def __init__(self, graph, tsdf, visualizer, kdtree_leaf_size=16):
+    def __init__(self, graph, tsdf, visualizer, kdtree_leaf_size=16, skinning_method="lbs", knn_method="grid"):
         """
             Warp field to deform unerlying volume/mesh/image 
             Args: 
@@ -23,6 +22,8 @@ class WarpField:
                 data_structure: TSDFVolume/Open3DMesh/DepthImage: Class containing the estimated tsdf volume
                 fopt: Hyperparameter for fusion
                 kdtree_leaf_size: Number of nodes in leaf in kdtree (larger leaf size means smaller tree depth)
+                skinning_method: lbs/dqs: Linear blend skinning or dual quaternion skinning, can be changed at runtime 
+                knn_method: grid/kdtree: Find anchors by bucketing nodes in a grid of cell size 2*node_coverage or by kdtree query for each point
         
             This module mainly does:
                 1. Skinning the data structure w.r.t graph nodes
@@ -55,6 +56,8 @@ class WarpField:
         self.graph_neighbours = min(N,4)
         self.node_coverage = self.graph.graph_generation_parameters["node_coverage"]
         self.gpu = self.tsdf.fopt.gpu 
+        self.skinning_method = skinning_method
+        self.knn_method = knn_method
 
 
 
@@ -80,15 +83,22 @@ class WarpField:
                 weights: (Nx4) np.ndarray , skinning weights for closest neighbours of each point  
 
 
-            Use KDTree GPU for faster computation   
+            Neighbours farther than 2*node_coverage are not used, 
+            hence the grid only needs to search the 27 cells around each point. 
         """
         points = points.astype(np.float32)
         
-        if nodes is None: # If no node information is passed, it means use graph nodes at source grame
-            kdtree = self.source_frame_kdtree
-        else:    
-            kdtree = KDTreeCPU(nodes, leafsize=self.kdtree_leaf_size)
-        dist, anchors = kdtree.query(points, k=self.graph_neighbours)
+        if self.knn_method == "grid":
+            dist, anchors = self.grid_knn(points, self.graph.nodes if nodes is None else nodes)
+        elif self.knn_method == "kdtree":
+            if nodes is None: # If no node information is passed, it means use graph nodes at source grame
+                kdtree = self.source_frame_kdtree
+            else:    
+                kdtree = KDTreeCPU(nodes, leafsize=self.kdtree_leaf_size)
+            dist, anchors = kdtree.query(points, k=self.graph_neighbours)
+            anchors = anchors.astype(np.int64) # pykdtree returns uint32 indices which can't be set to -1
+        else:
+            raise NotImplementedError(f"KNN method:{self.knn_method} not implemented. Use grid/kdtree")
 
         # Removes miss alignments but reduces new surface from being added
         dist[dist > 2*self.node_coverage] = np.inf
@@ -117,6 +127,148 @@ class WarpField:
 
         return anchors,weights,valid_pts
 
+    def build_node_grid(self, nodes):
+        """
+            Bucket nodes in a uniform grid of cell size 2*node_coverage, 
+            all nodes within 2*node_coverage of a point lie in the 27 cells around it. 
+
+            @params:
+                nodes: (Nx3) np.ndarray(float32)
+
+            @returns:
+                origin: (3) np.ndarray(float32): Position of the grid corner
+                grid_dims: (3) np.ndarray(int64): Number of cells along each axis, cell (x,y,z) has key (x*grid_dims[1] + y)*grid_dims[2] + z
+                node_order: (N) np.ndarray(int32): Nodes sorted by cell key
+                cell_start: (num_cells+1) np.ndarray(int32): Nodes of cell c are node_order[cell_start[c]:cell_start[c+1]]
+        """
+        cell_size = 2*self.node_coverage
+
+        # Pad by one cell so all neighbouring cells of a node lie inside the grid 
+        origin = (nodes.min(axis=0) - cell_size).astype(np.float32)
+        grid_dims = np.floor((nodes.max(axis=0) - origin)/cell_size).astype(np.int64) + 2
+
+        node_cells = np.floor((nodes - origin)/cell_size).astype(np.int64)
+        node_keys = (node_cells[:,0]*grid_dims[1] + node_cells[:,1])*grid_dims[2] + node_cells[:,2]
+        node_order = np.argsort(node_keys, kind="stable").astype(np.int32)
+        cell_start = np.searchsorted(node_keys[node_order], np.arange(np.prod(grid_dims)+1)).astype(np.int32)
+
+        return origin, grid_dims, node_order, cell_start
+
+    def grid_knn(self, points, nodes):
+        """
+            K nearest nodes within 2*node_coverage of each point. 
+            Nodes are bucketed in a grid of cell size 2*node_coverage, points are grouped by their cell 
+            and all points of a cell are searched in the nodes of its 27 neighbouring cells.
+
+            @params:
+                points: (Px3) np.ndarray(float32)
+                nodes: (Nx3) np.ndarray
+
+            @returns:
+                dist: (PxK) np.ndarray: distance to anchors sorted in increasing order, inf if no anchor 
+                anchors: (PxK) np.ndarray(int): -1 if no anchor
+        """
+        nodes = nodes.astype(np.float32)
+        cell_size = 2*self.node_coverage
+        origin, grid_dims, node_order, cell_start = self.build_node_grid(nodes)
+
+        # Points outside the grid are farther than 2*node_coverage from every node 
+        point_cells = np.floor((points - origin)/cell_size).astype(np.int64)
+        inside = np.all((point_cells >= 0) & (point_cells < grid_dims), axis=1)
+        point_keys = (point_cells[:,0]*grid_dims[1] + point_cells[:,1])*grid_dims[2] + point_cells[:,2]
+        point_keys[~inside] = -1
+
+        point_order = np.argsort(point_keys, kind="stable").astype(np.int32)
+        sorted_keys = point_keys[point_order]
+        block_start = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]).astype(np.int32)
+        block_start = np.r_[block_start, len(points)].astype(np.int32)
+
+        dist = np.full((points.shape[0], self.graph_neighbours), np.inf, dtype=np.float32)
+        anchors = np.full((points.shape[0], self.graph_neighbours), -1, dtype=np.int64)
+        self.grid_knn_kernel(points, point_order, sorted_keys, block_start, nodes, node_order, cell_start, grid_dims, origin, np.float32(cell_size), dist, anchors)
+
+        if self.graph_neighbours == 1: # Same shape as kdtree query 
+            dist, anchors = dist[:,0], anchors[:,0]
+
+        return dist, anchors
+
+    @staticmethod
+    @njit(parallel=True, nogil=True)
+    def grid_knn_kernel(points, point_order, sorted_keys, block_start, nodes, node_order, cell_start, grid_dims, origin, cell_size, dist, anchors):
+        K = dist.shape[1]
+        radius2 = cell_size*cell_size
+        for b in prange(block_start.shape[0]-1):
+            key = sorted_keys[block_start[b]]
+            if key < 0:
+                continue
+
+            cz = key % grid_dims[2]
+            cy = (key // grid_dims[2]) % grid_dims[1]
+            cx = key // (grid_dims[1]*grid_dims[2])
+
+            # Shared candidate list of the block, cells along z are contiguous in the sorted nodes 
+            x0, x1 = max(cx-1, 0), min(cx+2, grid_dims[0])
+            y0, y1 = max(cy-1, 0), min(cy+2, grid_dims[1])
+            z0, z1 = max(cz-1, 0), min(cz+2, grid_dims[2])
+
+            num_candidates = 0
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    c = (x*grid_dims[1] + y)*grid_dims[2]
+                    num_candidates += cell_start[c+z1] - cell_start[c+z0]
+
+            # Keep only nodes within the radius of the block's cell 
+            box_min = origin + cell_size*np.array([cx, cy, cz], dtype=np.float32)
+            candidates = np.empty(num_candidates, dtype=np.int32)
+            candidate_pos = np.empty((num_candidates, 3), dtype=np.float32)
+            num_candidates = 0
+            for x in range(x0, x1):
+                for y in range(y0, y1):
+                    c = (x*grid_dims[1] + y)*grid_dims[2]
+                    for j in range(cell_start[c+z0], cell_start[c+z1]):
+                        n = node_order[j]
+                        box_d2 = 0.0
+                        for d in range(3):
+                            gap = max(box_min[d] - nodes[n,d], nodes[n,d] - box_min[d] - cell_size, 0.0)
+                            box_d2 += gap*gap
+                        if box_d2 > radius2:
+                            continue
+                        candidates[num_candidates] = n
+                        candidate_pos[num_candidates] = nodes[n]
+                        num_candidates += 1
+
+            if num_candidates == 0:
+                continue
+
+            best_d2 = np.empty(K, dtype=np.float32)
+            best_n = np.empty(K, dtype=np.int64)
+            for i in range(block_start[b], block_start[b+1]):
+                p = point_order[i]
+                px, py, pz = points[p,0], points[p,1], points[p,2]
+
+                # Insertion sort of the k closest candidates inside the radius 
+                best_d2[:] = np.inf
+                best_n[:] = -1
+                for j in range(num_candidates):
+                    ddx = px - candidate_pos[j,0]
+                    ddy = py - candidate_pos[j,1]
+                    ddz = pz - candidate_pos[j,2]
+                    d2 = ddx*ddx + ddy*ddy + ddz*ddz
+                    if d2 > radius2 or d2 >= best_d2[K-1]:
+                        continue
+
+                    k = K-1
+                    while k > 0 and best_d2[k-1] > d2:
+                        best_d2[k] = best_d2[k-1]
+                        best_n[k] = best_n[k-1]
+                        k -= 1
+                    best_d2[k] = d2
+                    best_n[k] = candidates[j]
+
+                for k in range(K):
+                    dist[p,k] = np.sqrt(best_d2[k])
+                    anchors[p,k] = best_n[k]
+
     def skin_tsdf(self):    
 
         if not hasattr(self,"world_anchors") or not hasattr(self,"world_weights") or self.updating_warpfield:  
@@ -137,26 +289,15 @@ class WarpField:
 
         self.source_im = image_data["im"]   
 
-        # Get vertices and their indices 
         # Invalidate depth values outside object mask.
         # We only define graph over dynamic object (inside the object mask).
-        
+        point_image = image_data["im"][3:]
         if "mask" in image_data and image_data["mask"] is not None: 
-            mask_image = image_data["mask"].copy()
-            point_image = image_data["im"][3:].copy()
-            mask_image[mask_image > 0] = 1
-            point_image = point_image * mask_image[None,...]
-
-
-        vertices = np.zeros((0), dtype=np.float32)
-        vertex_pixels = np.zeros((0), dtype=np.int32)
-        faces = np.zeros((0), dtype=np.int32)
-
-        compute_mesh_from_depth_c(
-            point_image,
-            self.graph.graph_generation_parameters["max_triangle_distance"],
-            vertices, vertex_pixels, faces)
+            point_image = point_image * (image_data["mask"] > 0)[None,...]
 
+        # Skin the pixels which are vertices of the depth mesh directly, without building the mesh 
+        vertex_mask = image_proc.compute_mesh_vertex_mask(point_image, self.graph.graph_generation_parameters["max_triangle_distance"])
+        vertices = point_image[:, vertex_mask].T
 
         #########################################################################
         # Compute pixel anchors.
@@ -164,14 +305,11 @@ class WarpField:
         anchors,weights,valid_verts = self.skin(vertices,nodes=nodes)
 
         im_h,im_w = point_image.shape[1:3]
-        pixel_anchors = np.zeros((im_h,im_w,self.graph_neighbours), dtype=np.int32)
+        pixel_anchors = np.full((im_h,im_w,self.graph_neighbours), -1, dtype=np.int32)
         pixel_weights = np.zeros((im_h,im_w,self.graph_neighbours), dtype=np.float32)
 
-        pix_y = vertex_pixels[:,1]
-        pix_x = vertex_pixels[:,0]
-
-        pixel_anchors[pix_y,pix_x,:] = anchors
-        pixel_weights[pix_y,pix_x,:] = weights
+        pixel_anchors[vertex_mask] = anchors
+        pixel_weights[vertex_mask] = weights
 
         # self.log.info(f"Skinned Source Image, valid pixels:{np.sum(np.all(pixel_anchors != -1, axis=2))}")
         self.log.info(f"Skinned Source Image, valid pixels:{np.sum(np.all(pixel_anchors != -1, axis=2))}")
@@ -195,7 +333,7 @@ class WarpField:
     #     Functions to deform data structures    #
     ##############################################
     @staticmethod
-    @njit(parallel=True)
+    @njit(parallel=True, nogil=True)
     def deform_lbs(node_rotations, node_translations, world_pts, world_anchors, world_weights,valid_pts):
         
         deformed_world_pts = np.empty_like(world_pts, dtype=world_pts.dtype)
@@ -215,10 +353,54 @@ class WarpField:
                     deformed_world_pts[i] += world_weights_normalized[k] * deformed_points_k  # (num_pixels, 3, 1)
 
             else: # No deformation 
-                deformed_world_pts[i] = world_pts
+                deformed_world_pts[i] = world_pts[i]
                    
         return deformed_world_pts
 
+    @staticmethod
+    @njit(parallel=True, nogil=True)
+    def deform_lbs_with_normals(node_rotations, node_translations, points, normals, anchors, weights, valid_pts):
+        """
+            Deform points and their normals in a single pass, gathering the anchors' transformations once.
+            Normals are rotated (rotation is its own inverse transpose) and renormalized. 
+        """
+        deformed_points = np.empty_like(points)
+        deformed_normals = np.empty_like(normals)
+        for i in prange(points.shape[0]):
+
+            px, py, pz = points[i, 0], points[i, 1], points[i, 2]
+            nx, ny, nz = normals[i, 0], normals[i, 1], normals[i, 2]
+
+            if valid_pts[i]:
+                dpx = dpy = dpz = 0.0
+                dnx = dny = dnz = 0.0
+                for k in range(weights.shape[1]):
+                    w = weights[i, k]
+                    if w == 0:
+                        continue
+                    R = node_rotations[anchors[i, k]]
+                    t = node_translations[anchors[i, k]]
+                    dpx += w * (R[0, 0] * px + R[0, 1] * py + R[0, 2] * pz + t[0])
+                    dpy += w * (R[1, 0] * px + R[1, 1] * py + R[1, 2] * pz + t[1])
+                    dpz += w * (R[2, 0] * px + R[2, 1] * py + R[2, 2] * pz + t[2])
+                    dnx += w * (R[0, 0] * nx + R[0, 1] * ny + R[0, 2] * nz)
+                    dny += w * (R[1, 0] * nx + R[1, 1] * ny + R[1, 2] * nz)
+                    dnz += w * (R[2, 0] * nx + R[2, 1] * ny + R[2, 2] * nz)
+                px, py, pz = dpx, dpy, dpz
+                nx, ny, nz = dnx, dny, dnz
+
+            # Normalize, zero normals (e.g. opposite normals blended) are kept as they are
+            norm = np.sqrt(nx * nx + ny * ny + nz * nz)
+            if norm == 0:
+                norm = 1.0
+            deformed_points[i, 0] = px
+            deformed_points[i, 1] = py
+            deformed_points[i, 2] = pz
+            deformed_normals[i, 0] = nx / norm
+            deformed_normals[i, 1] = ny / norm
+            deformed_normals[i, 2] = nz / norm
+
+        return deformed_points, deformed_normals
 
     @staticmethod   
     @ncuda.jit()
@@ -261,6 +443,9 @@ class WarpField:
         rotations = self.rotations.astype(np.float32)
         translations = self.translations.astype(np.float32)
 
+        if self.skinning_method == "dqs":
+            return dual_quaternion.deform_dqs(rotations, translations, points, anchors, weights, valid_pts)
+
         ### Write gpu code for deform world points lbs, currently only works on volume points 
         if self.gpu:
             points = np.ascontiguousarray(points.reshape(reshape_gpu_vol+[3]))
@@ -324,7 +509,9 @@ class WarpField:
                             valid_pts)
 
         # Normalize 
-        deform_normals = deform_pts/np.linalg.norm(deform_pts,axis=1,keepdims=True)
+        norm = np.linalg.norm(deform_pts,axis=1,keepdims=True)
+        norm[norm == 0] = 1
+        deform_normals = deform_pts/norm
 
         return deform_normals    
 
@@ -337,9 +524,24 @@ class WarpField:
         # Todo, this can be optimised such that skin is only computed for new vertices 
         skin_anchors,skin_weights,valid_verts = self.skin(vertices)
 
-        reshape_gpu_vol = [vertices.shape[0],1,1]        
-        deformed_vertices = self.deform(vertices,skin_anchors,skin_weights,reshape_gpu_vol,valid_verts)    
-        deformed_normals = self.deform_normals(normals,skin_anchors,skin_weights,reshape_gpu_vol,valid_verts)    
+        if self.skinning_method not in ["lbs","dqs"]:
+            raise NotImplementedError(f"Skinning method:{self.skinning_method} is not implemented. Kindly use Linear Blend Skinning:lbs or Dual Quaternion Skinning:dqs")
+
+        if self.skinning_method == "dqs":
+            deformed_vertices,deformed_normals = dual_quaternion.deform_dqs(self.rotations, self.translations,
+                                                    vertices, skin_anchors, skin_weights, valid_verts, normals=normals)
+
+        elif self.gpu:
+            reshape_gpu_vol = [vertices.shape[0],1,1]        
+            deformed_vertices = self.deform(vertices,skin_anchors,skin_weights,reshape_gpu_vol,valid_verts)    
+            deformed_normals = self.deform_normals(normals,skin_anchors,skin_weights,reshape_gpu_vol,valid_verts)    
+
+        else:
+            # Positions and normals in a single pass 
+            deformed_vertices,deformed_normals = self.deform_lbs_with_normals(
+                self.rotations.astype(np.float32), self.translations.astype(np.float32),
+                np.ascontiguousarray(vertices), np.ascontiguousarray(normals),
+                skin_anchors, skin_weights, valid_verts)
 
         return deformed_vertices,deformed_normals        
                     
@@ -376,17 +578,10 @@ class WarpField:
         assert self.frame_id == self.tsdf.frame_id,f"Warpfield maps to:{self.frame_id}th frame but TSDF maps to:{self.tsdf.frame_id}th frame"
 
         assert self.rotations.shape[0] == self.deformed_nodes.shape[0],f"Nodes mismatch between transformation data:{self.rotations.shape} and deformed node:{self.deformed_nodes.shape} data"
-        # Update deformed_nodes
-        N = self.deformed_nodes.shape[0]
-
         # Update transformation paramaeters to get transformation from source frame to target frame of all nodes
-        # Make sure to update translations first, so we can use previous rotations
-        self.translations = np.array([ nnrt_data["node_rotations"][i]@self.translations[i]for i in range(N)])\
-                            - np.array([ nnrt_data["node_rotations"][i]@self.deformed_nodes[i] for i in range(N)])\
-                            + self.deformed_nodes + nnrt_data["node_translations"]
-
-        # Since                     
-        self.rotations = np.array([ nnrt_data["node_rotations"][i]@self.rotations[i]for i in range(N)])
+        # NNRT estimates transformations w.r.t the deformed nodes, compose them (w.r.t origin) after the previous ones
+        nnrt_rotations, nnrt_translations = se3.from_node_frame(nnrt_data["node_rotations"], nnrt_data["node_translations"], self.deformed_nodes)
+        self.rotations, self.translations = se3.compose(nnrt_rotations, nnrt_translations, self.rotations, self.translations)
 
         # Finally update graph nodes
         self.deformed_nodes = nnrt_data["deformed_nodes_to_target"]                            
@@ -400,11 +595,7 @@ class WarpField:
         """    
         N = self.rotations.shape[0]
 
-        rotations = self.rotations
-        translations = self.translations - self.graph.nodes[:N]\
-                    + np.array([ rotations[i]@self.graph.nodes[i]for i in range(N)])
-
-        return rotations,translations
+        return se3.to_node_frame(self.rotations, self.translations, self.graph.nodes[:N])
 
     def get_transformation_wrt_origin(self,rotations,translations):
         """
@@ -413,11 +604,7 @@ class WarpField:
         """    
         N = rotations.shape[0]
 
-        rotations = rotations
-        translations = translations + self.graph.nodes[:N]\
-                    - np.array([ rotations[i]@self.graph.nodes[i]for i in range(N)])
-
-        return rotations,translations                
+        return se3.from_node_frame(rotations, translations, self.graph.nodes[:N])                
 
 
     #######################################
@@ -448,10 +635,14 @@ class WarpField:
 
         return unreachable_verts 
 
-    def update_graph(self):
+    def update_graph(self,prune=True):
         """
             1. After fusion if new nodes are added to the graph.
             2. Update skinning parameters for data structure(tsdf)  
+            3. If prune, merge redundant nodes and remove nodes not skinning the tsdf (see prune_graph) 
+
+            @params: 
+                prune: bool: Whether to prune the graph after adding nodes
         """
 
         self.updating_warpfield = True
@@ -472,11 +663,17 @@ class WarpField:
 
         # Get vertices not skinned, sorted by their ditance from graph 
         new_verts_indices = self.find_unreachable_nodes(canonical_model_vertices[canonical_model_non_eroded_indices])
+        new_verts_indices = np.where(canonical_model_non_eroded_indices)[0][new_verts_indices] # Indices w.r.t to all the vertices of the canonical model
         
-        old_num_nodes = self.graph.nodes.shape[0]
-        update = self.graph.update(canonical_model_vertices,canonical_model_faces,new_verts_indices) # Update graph and return whether succesfully updated or not 
+        update, old_nodes_mask = self.graph.update(canonical_model_vertices,canonical_model_faces,new_verts_indices) # Update graph and return whether succesfully updated or not 
 
         if update:
+            # Keep the deformation of the old nodes still in the graph, they come before the new nodes
+            self.rotations = self.rotations[old_nodes_mask]
+            self.translations = self.translations[old_nodes_mask]
+            self.deformed_nodes = self.deformed_nodes[old_nodes_mask]
+            old_num_nodes = self.rotations.shape[0]
+
             ##################################
             # Update skinning parameters     #
             ##################################
@@ -487,7 +684,7 @@ class WarpField:
             # Update deformation parameters  #
             ##################################
 
-            valid_nodes_mask = np.zeros(self.graph.nodes.shape[0],dtype=np.bool)
+            valid_nodes_mask = np.zeros(self.graph.nodes.shape[0],dtype=bool)
             valid_nodes_mask[:old_num_nodes] = True
 
             # While running ARAP to add nodes, source_frame = canonical frame adding
@@ -509,16 +706,65 @@ class WarpField:
             self.deformed_nodes = estimated_new_graph_parameters["deformed_nodes_to_target"] # Just update graph nodes (Unlike during registration no need to save previous data)
             self.rotations,self.translations = self.get_transformation_wrt_origin(estimated_new_graph_parameters["node_rotations"],estimated_new_graph_parameters["node_translations"])
 
-
-            
-
         # Finally update the frame id to target frame showing that the defornmation is completed
         self.frame_id = self.tsdf.frame_id
         self.updating_warpfield = False
 
+        # Merge redundant nodes and remove nodes not skinning the tsdf (uses the skinning computed above)
+        if prune:
+            self.prune_graph()
+
         return update
 
 
+    def prune_graph(self):
+        """
+            Graph maintenance, keeps the graph size bounded by the surface area. 
+            Merges nodes too close to one another and removes nodes with no vertex of the canonical model skinned to them (see EDGraph.prune). 
+            Deformation parameters are remapped to the pruned graph. 
+            Voxels skinned to a merged or removed node are skinned again to the remaining nodes. 
+
+            @returns: 
+                pruned: bool: Whether nodes were removed from the graph 
+        """
+
+        canonical_model = self.tsdf.get_canonical_model()
+        canonical_model_vertices, canonical_model_faces = canonical_model[0],canonical_model[1]
+
+        # Support of a node is the number of surface points skinned to it. 
+        # Voxels in free or unobserved space are skinned too and would support almost every node
+        model_anchors,_,_ = self.skin(canonical_model_vertices)
+        num_nodes = self.graph.nodes.shape[0]
+        node_support = np.bincount(model_anchors[model_anchors >= 0], minlength=num_nodes)
+
+        world_anchors,world_weights,world_valid_pts = self.skin_tsdf()
+
+        valid_nodes_mask, node_id_mapping = self.graph.prune(canonical_model_vertices,canonical_model_faces,node_support)
+        if np.all(valid_nodes_mask): 
+            return False
+
+        # Keep the deformation of the remaining nodes 
+        self.rotations = self.rotations[valid_nodes_mask]
+        self.translations = self.translations[valid_nodes_mask]
+        self.deformed_nodes = self.deformed_nodes[valid_nodes_mask]
+
+        self.source_frame_kdtree = KDTreeCPU(self.graph.nodes, leafsize=self.kdtree_leaf_size) # Update the main kdtree 
+
+        # Remap the anchors of the kept nodes 
+        self.world_anchors = np.where(world_anchors >= 0, node_id_mapping[world_anchors], -1).astype(np.int32)
+        self.world_weights = world_weights.copy()
+        self.world_valid_pts = world_valid_pts.copy()
+
+        # Voxels anchored to a merged or removed node need new weights (and could have the same anchor twice)
+        reskin_pts = np.any((world_anchors >= 0) & ~np.append(valid_nodes_mask, True)[world_anchors], axis=1)
+        if np.any(reskin_pts):
+            anchors,weights,valid_pts = self.skin(self.tsdf.world_pts[reskin_pts])
+            self.world_anchors[reskin_pts] = anchors
+            self.world_weights[reskin_pts] = weights
+            self.world_valid_pts[reskin_pts] = valid_pts
+
+        return True
+
     def get_deformed_nodes(self):
 
         # Make sure the translation nodes are updated 
@@ -5,6 +5,9 @@ import numpy as np
 from timeit import default_timer as timer
 import math
 import kornia
+import torch.utils.checkpoint
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from timeit import default_timer as timer
 from decimal import Decimal
 import options as opt
@@ -18,6 +21,7 @@ from NeuralNRT._C import erode_mesh as erode_mesh_c
 from NeuralNRT._C import sample_nodes as sample_nodes_c
 from NeuralNRT._C import compute_edges_geodesic as compute_edges_geodesic_c
 from NeuralNRT._C import compute_edges_euclidean as compute_edges_euclidean_c
+from NeuralNRT._C import compute_data_normal_equations as compute_data_normal_equations_c
 
 
 class MaskNet(torch.nn.Module):
@@ -79,11 +83,283 @@ class LinearSolverLU(torch.autograd.Function):
         # grad_A = -grad_b * x^T
 
         grad_b = torch.lu_solve(grad_x, A_LU, pivots)
-        grad_A = -torch.matmul(grad_b, x.view(1, -1))
+        grad_A = -torch.matmul(grad_b, x.transpose(-2, -1))
         
         return grad_A, grad_b
 
 
+class DataNormalEquationsC(torch.autograd.Function):
+    """
+    Data term residuals and normal equations (J^TJ, J^Tr) computed by the C++ extension (CPU only).
+    The backward pass recomputes the residuals and the non-zero jacobian blocks of every correspondence
+    with torch ops (DeformNet.compute_data_blocks) and differentiates through them, the dense data
+    jacobian is never built.
+    """
+
+    @staticmethod
+    def forward(ctx, net, problem, R, t, graph_nodes, source_points, target_matches, xy_pixels_warped, correspondence_weights, source_weights):
+        fx, fy, cx, cy = problem["intrinsics"]
+
+        res_data, JtJ, gradient = compute_data_normal_equations_c(
+            R, t, graph_nodes, source_points, target_matches, xy_pixels_warped, correspondence_weights,
+            problem["source_anchors"], source_weights,
+            float(fx), float(fy), float(cx), float(cy),
+            float(problem["lambda_data_flow"]), float(problem["lambda_data_depth"])
+        )
+
+        ctx.net = net
+        ctx.problem = problem
+        ctx.save_for_backward(R, t, graph_nodes, source_points, target_matches, xy_pixels_warped, correspondence_weights, source_weights)
+
+        return res_data, JtJ, gradient
+
+    @staticmethod
+    def backward(ctx, grad_res_data, grad_JtJ, grad_gradient):
+        inputs = [x.detach().requires_grad_(needs_grad) for x, needs_grad in zip(ctx.saved_tensors, ctx.needs_input_grad[2:])]
+        R, t, graph_nodes, source_points, target_matches, xy_pixels_warped, correspondence_weights, source_weights = inputs
+
+        differentiable_inputs = [x for x in inputs if x.requires_grad]
+        if len(differentiable_inputs) == 0:
+            return (None,) * (2 + len(inputs))
+
+        num_matches = ctx.problem["num_matches"]
+
+        with torch.enable_grad():
+            problem = dict(ctx.problem,
+                graph_nodes=graph_nodes, source_points=source_points, target_matches=target_matches,
+                xy_pixels_warped=xy_pixels_warped, correspondence_weights=correspondence_weights, source_weights=source_weights
+            )
+            res_data, jacobian_blocks = ctx.net.compute_data_blocks(problem, R, t)
+            jacobian_blocks = jacobian_blocks.view(num_matches, 3, 24)
+            jacobian_blocks_t = torch.transpose(jacobian_blocks, 1, 2)
+
+            # Columns of the 4 anchors of every correspondence in J^TJ and J^Tr
+            _, jacobian_cols = ctx.net.data_block_indices(problem)
+            block_cols = jacobian_cols[:, 0].reshape(num_matches, 24)
+
+            # J^TJ = sum_m J_m^T J_m and J^Tr = sum_m J_m^T r_m, so their vector-jacobian products only need
+            # the output gradients at the (24, 24) / (24) entries of every correspondence.
+            grad_JtJ_blocks = grad_JtJ[block_cols.view(num_matches, 24, 1), block_cols.view(num_matches, 1, 24)] # (num_matches, 24, 24)
+            grad_gradient_blocks = grad_gradient.view(-1)[block_cols].view(num_matches, 24, 1) # (num_matches, 24, 1)
+
+            objective = torch.sum(grad_JtJ_blocks * torch.matmul(jacobian_blocks_t, jacobian_blocks)) \
+                + torch.sum(grad_gradient_blocks * torch.matmul(jacobian_blocks_t, res_data.view(num_matches, 3, 1))) \
+                + torch.sum(grad_res_data * res_data)
+
+        grads = iter(torch.autograd.grad(objective, differentiable_inputs, allow_unused=True))
+        grad_inputs = [next(grads) if x.requires_grad else None for x in inputs]
+
+        return (None, None, *grad_inputs)
+
+
+class GaussNewtonPlan():
+    """
+    Topology dependent structures of the Gauss-Newton solver: valid edge pairs, sparsity pattern
+    of the ARAP jacobian, node clusters and index helpers.
+    They only depend on the graph edges, edge weights and clusters, so a plan can be computed
+    once and passed back to DeformNet.forward / DeformNet.arap until the graph changes.
+    """
+
+    def __init__(self, num_nodes, graph_edge_pairs, graph_edge_weights, num_neighbors, graph_clusters=None):
+        """
+            @params:
+                num_nodes: int: Number of graph nodes
+                graph_edge_pairs: torch.LongTensor: (E, 2): Valid edges (i, j)
+                graph_edge_weights: torch.Tensor: (E): Weight of every valid edge
+                num_neighbors: int: Maximum number of neighbours of a node, used to scale the edge weights
+                graph_clusters: torch.Tensor: (N, 1): Cluster id of every node (optional)
+        """
+        device = graph_edge_pairs.device
+
+        self.num_nodes = num_nodes
+        self.num_neighbors = num_neighbors
+        self.num_edges = graph_edge_pairs.shape[0]
+        self.graph_edge_pairs = graph_edge_pairs
+        self.graph_edge_weights = graph_edge_weights
+
+        if opt.gn_use_edge_weighting:
+            # Since graph edge weights sum up to 1 for all neighbors, we multiply
+            # it by the number of neighbors to make the setting in the same scale
+            # as in the case of not using edge weights (they are all 1 then).
+            self.arap_edge_weights = float(num_neighbors) * graph_edge_weights
+        else:
+            self.arap_edge_weights = torch.ones_like(graph_edge_weights)
+
+        # Sparsity pattern of the ARAP jacobian, row 3*e + c is coordinate c of the residual of edge e.
+        xyz = torch.arange(3, dtype=torch.int64, device=device).view(1, 3)
+        edge_rows = 3 * torch.arange(self.num_edges, dtype=torch.int64, device=device).view(-1, 1) + xyz # (E, 3)
+        node_cols_0 = 3 * graph_edge_pairs[:, 0:1] + xyz # (E, 3)
+        node_cols_1 = 3 * graph_edge_pairs[:, 1:2] + xyz # (E, 3)
+
+        # Jacobian wrt. translations is +w for node i and -w for node j, it doesn't change during the solve.
+        self.arap_translation_rows = torch.cat([edge_rows.view(-1), edge_rows.view(-1)])
+        self.arap_translation_cols = 3 * num_nodes + torch.cat([node_cols_0.view(-1), node_cols_1.view(-1)])
+        arap_edge_weights_repeat = self.arap_edge_weights.view(-1, 1).repeat(1, 3).view(-1)
+        self.arap_translation_values = torch.cat([arap_edge_weights_repeat, -arap_edge_weights_repeat])
+
+        # Jacobian wrt. rotation of node i, entry (3*e + r, 3*i + c). Derivative wrt. R_j is equal to 0.
+        self.arap_rotation_rows = edge_rows.view(-1, 3, 1).repeat(1, 1, 3).view(-1)
+        self.arap_rotation_cols = node_cols_0.view(-1, 1, 3).repeat(1, 3, 1).view(-1)
+
+        # Clusters relabelled to 0, ..., num_clusters - 1
+        self.cluster_ids = None
+        if graph_clusters is not None:
+            self.cluster_ids, self.node_cluster_idxs = torch.unique(graph_clusters.view(-1), return_inverse=True)
+            self.num_clusters = self.cluster_ids.shape[0]
+
+        # Row indices of the data residuals, grown when needed
+        self.data_increment_vec = torch.zeros((0), dtype=torch.int64, device=device)
+
+        # Coarse graph of the hierarchical solve, sampled once per plan (see get_coarse_graph)
+        self.coarse_graph = None
+
+    def get_solve_blocks(self, source_anchors):
+        """
+            Split the unknowns into independent blocks of the normal equations. Clusters share no ARAP edges,
+            so the system is block diagonal w.r.t. clusters, unless a correspondence is anchored to nodes of
+            different clusters. Such clusters are merged into one block.
+
+            Blocks are grouped by size (rounded up to a power of 2 nodes), every group is solved as one batch.
+
+            @params:
+                source_anchors: torch.LongTensor: (M, 4): Anchor nodes of the correspondences
+            @returns:
+                solve_blocks: list of (block_idxs, block_mask), None if there is only one block
+                    block_idxs: torch.LongTensor: (num_blocks, block_size*6): Unknowns of every block (padded with 0)
+                    block_mask: torch.BoolTensor: (num_blocks, block_size*6): False for padding
+        """
+        if self.cluster_ids is None or self.num_clusters < 2:
+            return None
+
+        # Merge clusters coupled by a correspondence or (for safety) an edge
+        node_cluster_idxs = self.node_cluster_idxs.cpu().numpy()
+        coupled_clusters = np.concatenate([
+            node_cluster_idxs[source_anchors.cpu().numpy()].reshape(-1, 4)[:, [0, 0, 0, 1, 2, 3]].reshape(-1, 2, 3).transpose(0, 2, 1).reshape(-1, 2),
+            node_cluster_idxs[self.graph_edge_pairs.cpu().numpy()].reshape(-1, 2)
+        ], axis=0)
+        coupling = coo_matrix(
+            (np.ones(coupled_clusters.shape[0], dtype=np.int8), (coupled_clusters[:, 0], coupled_clusters[:, 1])),
+            shape=(self.num_clusters, self.num_clusters)
+        )
+        num_blocks, cluster_blocks = connected_components(coupling, directed=False)
+
+        if num_blocks < 2:
+            return None
+
+        node_blocks = cluster_blocks[node_cluster_idxs]
+        block_nodes = [np.where(node_blocks == block_id)[0] for block_id in range(num_blocks)]
+
+        device = self.graph_edge_pairs.device
+        solve_blocks = []
+        block_sizes = np.array([len(nodes) for nodes in block_nodes])
+        padded_sizes = 2**np.ceil(np.log2(block_sizes)).astype(np.int64)
+        for padded_size in np.unique(padded_sizes):
+            group = np.where(padded_sizes == padded_size)[0]
+            block_idxs = np.zeros((len(group), padded_size * 6), dtype=np.int64)
+            block_mask = np.zeros((len(group), padded_size * 6), dtype=bool)
+            for j, block_id in enumerate(group):
+                nodes = block_nodes[block_id]
+                n = len(nodes)
+                # Rotation parameters of all nodes first, then translation parameters
+                unknowns = np.concatenate([
+                    (3 * nodes[:, None] + np.arange(3)[None, :]).reshape(-1),
+                    (3 * self.num_nodes + 3 * nodes[:, None] + np.arange(3)[None, :]).reshape(-1)
+                ])
+                block_idxs[j, :6*n] = unknowns
+                block_mask[j, :6*n] = True
+            solve_blocks.append((torch.from_numpy(block_idxs).to(device), torch.from_numpy(block_mask).to(device)))
+
+        return solve_blocks
+
+    @staticmethod
+    def from_graph(graph_edges, graph_edges_weights, graph_clusters=None):
+        """
+            Build the plan from the per node edge lists
+            @params:
+                graph_edges: torch.Tensor: (N, K): Neighbours of every node, -1 if invalid
+                graph_edges_weights: torch.Tensor: (N, K): Edge weights
+                graph_clusters: torch.Tensor: (N, 1): Cluster id of every node (optional)
+        """
+        num_nodes, num_neighbors = graph_edges.shape
+
+        valid_edge_idxs = torch.where(graph_edges >= 0)
+        graph_edge_pairs = torch.stack([valid_edge_idxs[0], graph_edges[valid_edge_idxs[0], valid_edge_idxs[1]].type(torch.int64)], 1) # (E, 2)
+        graph_edge_weights = graph_edges_weights[valid_edge_idxs[0], valid_edge_idxs[1]]
+
+        return GaussNewtonPlan(num_nodes, graph_edge_pairs, graph_edge_weights, num_neighbors, graph_clusters)
+
+    def get_coarse_graph(self, graph_nodes, coarse_node_coverage):
+        """
+            Coarse graph for the hierarchical solve. The graph nodes are subsampled with a larger node coverage 
+            and every fine node is assigned to its closest coarse node. 
+            Node sampling runs on the host, hence it is only computed for the first solve using this plan 
+            (node positions at that frame), later solves reuse the node indices.
+
+            @params:
+                graph_nodes: torch.Tensor: (N, 3): Graph nodes
+                coarse_node_coverage: float: Node coverage used to sample the coarse nodes
+            @returns:
+                coarse_graph: dict, None if the coarse graph doesn't reduce the number of nodes 
+                    coarse_node_indices: torch.LongTensor: (C): Fine node index of every coarse node
+                    fine_to_coarse: torch.LongTensor: (N): Closest coarse node of every fine node
+                    interpolation_nodes: torch.LongTensor: (N, K): Closest K <= 4 coarse nodes of every fine node
+                    plan: GaussNewtonPlan: Plan of the coarse graph
+        """
+        if self.coarse_graph is not None and self.coarse_graph[0] == coarse_node_coverage:
+            return self.coarse_graph[1]
+
+        device = graph_nodes.device
+
+        # Sample coarse nodes from the graph nodes
+        graph_nodes_numpy = np.ascontiguousarray(graph_nodes.detach().cpu().numpy(), dtype=np.float32)
+        coarse_node_coords = np.zeros((0), dtype=np.float32)
+        coarse_node_indices = np.zeros((0), dtype=np.int32)
+        num_coarse_nodes = sample_nodes_c(
+            graph_nodes_numpy, np.ones(self.num_nodes, dtype=bool),
+            coarse_node_coords, coarse_node_indices,
+            coarse_node_coverage,
+            False, # Use all nodes
+            False  # No random shuffle, keep the coarse graph deterministic
+        )
+
+        coarse_graph = None
+        if 2 <= num_coarse_nodes < self.num_nodes:
+            coarse_node_indices = torch.from_numpy(coarse_node_indices[:num_coarse_nodes, 0].astype(np.int64)).to(device)
+
+            # Assign every fine node to its closest coarse node
+            node_to_coarse_dist = torch.cdist(graph_nodes.detach(), graph_nodes[coarse_node_indices].detach()) # (num_nodes, num_coarse_nodes)
+            fine_to_coarse = torch.argmin(node_to_coarse_dist, dim=1) # (num_nodes)
+            interpolation_nodes = torch.topk(node_to_coarse_dist, min(4, num_coarse_nodes), dim=1, largest=False)[1] # (num_nodes, K)
+
+            # A coarse edge exists if any fine edge connects two different coarse nodes.
+            # Its weight is the mean of the weights of those fine edges.
+            coarse_edge_pairs = fine_to_coarse[self.graph_edge_pairs] # (num_edges, 2)
+            inter_cluster_edges = coarse_edge_pairs[:, 0] != coarse_edge_pairs[:, 1]
+            coarse_edge_pairs, inverse_idxs, edge_counts = torch.unique(coarse_edge_pairs[inter_cluster_edges], dim=0, return_inverse=True, return_counts=True)
+            coarse_edge_weights = torch.zeros((coarse_edge_pairs.shape[0]), dtype=self.graph_edge_weights.dtype, device=device)
+            coarse_edge_weights = coarse_edge_weights.index_add(0, inverse_idxs, self.graph_edge_weights[inter_cluster_edges]) / edge_counts.type(coarse_edge_weights.dtype)
+
+            coarse_graph = {
+                "coarse_node_indices": coarse_node_indices,
+                "fine_to_coarse": fine_to_coarse,
+                "interpolation_nodes": interpolation_nodes,
+                "plan": GaussNewtonPlan(num_coarse_nodes, coarse_edge_pairs, coarse_edge_weights, self.num_neighbors)
+            }
+
+        self.coarse_graph = (coarse_node_coverage, coarse_graph)
+        return coarse_graph
+
+    def data_increment_vecs(self, num_matches):
+        """
+            Row indices (3*m + 0, 3*m + 1, 3*m + 2) of the data residuals of num_matches matches
+        """
+        if self.data_increment_vec.shape[0] < num_matches * 3:
+            self.data_increment_vec = torch.arange(num_matches * 3, dtype=torch.int64, device=self.data_increment_vec.device)
+
+        data_increment_vec = self.data_increment_vec[:num_matches * 3]
+        return data_increment_vec[0::3], data_increment_vec[1::3], data_increment_vec[2::3]
+
+
 class DeformNet(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -110,6 +386,9 @@ class DeformNet(torch.nn.Module):
         # Optimizer fails for > 3 iterations. Current hack is to stop update is loss increases by 1
         self.stop_loss_diff = 1
 
+        # opt.gn_use_fused_data_term falls back to the dense jacobian on non CPU tensors, warn only once 
+        self.warned_fused_data_term_device = False
+
         # Optical flow network
         self.flow_net = pwcnet.PWCNet()
         if opt.freeze_optical_flow_net:
@@ -146,10 +425,21 @@ class DeformNet(torch.nn.Module):
         pixel_anchors, pixel_weights, 
         num_nodes_vec, intrinsics, 
         evaluate=False, split="train", 
-        prev_rot=None,prev_trans=None
+        prev_rot=None,prev_trans=None,
+        solver_plans=None,
+        outputs=None
     ):
+        """
+            solver_plans: list of GaussNewtonPlan (one per sample in batch) for the given graph edges and clusters.
+                Computed here if None.
+            outputs: set of output names to return, keys of the returned dict or of its "correspondence_info". 
+                All outputs if None. Outputs which are not requested are not computed where possible 
+                (deformed_points_pred warps all source points after the solve).
+        """
         batch_size = x1.shape[0]
 
+        compute_deformed_points = outputs is None or len({"deformed_points_pred", "deformed_points_idxs", "deformed_points_subsampled"} & set(outputs)) > 0
+
         image_width = x1.shape[3]
         image_height = x1.shape[2]
 
@@ -174,15 +464,6 @@ class DeformNet(torch.nn.Module):
         
         flow = 20.0 * torch.nn.functional.interpolate(input=flow2, size=(image_height, image_width), mode='bilinear', align_corners=False)
 
-        ########################################################################
-        # Initialize graph data.
-        ########################################################################
-        num_nodes_total = graph_nodes.shape[1]
-        num_neighbors = graph_edges.shape[2]
-
-        # We assume we always use 4 nearest anchors.
-        assert pixel_anchors.shape[3] == 4
-
         ########################################################################
         # Apply dense flow to warp the source points to target frame.
         ########################################################################
@@ -212,23 +493,37 @@ class DeformNet(torch.nn.Module):
         # Mask out invalid source points.
         source_points = x1[:, 3:, :, :].clone()
         source_anchor_validity = torch.all(pixel_anchors >= 0.0, dim=3)          
+        valid_source_points  = (source_points[:, 2, :, :] > 0.0)  & (source_points[:, 2, :, :] <= opt.gn_max_depth)  & source_anchor_validity
 
-        # Sample target points at computed pixel locations.
-        target_points = x2[:, 3:, :, :].clone()
-        target_matches = torch.nn.functional.grid_sample(
-            target_points, xy_coords_warped, mode=opt.gn_depth_sampling_mode, padding_mode='zeros', align_corners=False
-        )
+        if split == "val" or split == "test":
+            max_num_matches = opt.gn_max_matches_eval
+        elif split == "train":
+            max_num_matches = opt.gn_max_matches_train
+        else:
+            raise Exception("Split {} is not defined".format(split))
 
-        # We filter out any boundary matches, where any of the 4 pixels is invalid.
-        target_validity = ((target_points > 0.0) & (target_points <= opt.gn_max_depth)).type(torch.float32)
-        target_matches_validity = torch.nn.functional.grid_sample(
-            target_validity, xy_coords_warped, mode="bilinear", padding_mode='zeros', align_corners=False
-        )
-        target_matches_validity = target_matches_validity[:, 2, :, :] >= 0.999
+        # During evaluation we can sample target matches only at valid source pixels.
+        # MaskNet still needs the dense warped target image as input.
+        use_sparse_correspondences = evaluate and opt.gn_use_sparse_correspondences
 
-        # Prepare masks for both valid source points and target matches
-        valid_source_points  = (source_points[:, 2, :, :] > 0.0)  & (source_points[:, 2, :, :] <= opt.gn_max_depth)  & source_anchor_validity
-        valid_target_matches = (target_matches[:, 2, :, :] > 0.0) & (target_matches[:, 2, :, :] <= opt.gn_max_depth) & target_matches_validity
+        target_points = x2[:, 3:, :, :].clone()
+        target_matches, valid_target_matches = None, None
+        if not use_sparse_correspondences or opt.use_mask:
+            # Sample target points at computed pixel locations.
+            target_matches = torch.nn.functional.grid_sample(
+                target_points, xy_coords_warped, mode=opt.gn_depth_sampling_mode, padding_mode='zeros', align_corners=False
+            )
+
+        if not use_sparse_correspondences:
+            # We filter out any boundary matches, where any of the 4 pixels is invalid.
+            target_validity = ((target_points > 0.0) & (target_points <= opt.gn_max_depth)).type(torch.float32)
+            target_matches_validity = torch.nn.functional.grid_sample(
+                target_validity, xy_coords_warped, mode="bilinear", padding_mode='zeros', align_corners=False
+            )
+            target_matches_validity = target_matches_validity[:, 2, :, :] >= 0.999
+
+            # Prepare masks for valid target matches
+            valid_target_matches = (target_matches[:, 2, :, :] > 0.0) & (target_matches[:, 2, :, :] <= opt.gn_max_depth) & target_matches_validity
 
         # Prepare the input of both the MaskNet and AttentionNet, if we actually use either of them
         if opt.use_mask:
@@ -237,6 +532,12 @@ class DeformNet(torch.nn.Module):
 
             mask_input = torch.cat([x1, target_rgb_warped, target_matches], 1)
 
+        if use_sparse_correspondences:
+            # Compact (bs, M) lists of sampled pixels and their matches. The dense warp computed for MaskNet is reused.
+            sparse_pixel_idxs, sparse_target_matches, sparse_valid_matches = self.sample_sparse_correspondences(
+                xy_pixels_warped, target_points, valid_source_points, opt.gn_sparse_candidates_factor * max_num_matches, target_matches_dense=target_matches
+            )
+
         ########################################################################
         # MaskNet
         ########################################################################
@@ -248,10 +549,22 @@ class DeformNet(torch.nn.Module):
             # print(mask_pred)
 
         # Compute mask of valid correspondences
-        valid_correspondences = valid_source_points & valid_target_matches
+        if use_sparse_correspondences:
+            valid_correspondences = None
+            num_valid_correspondences = torch.sum(sparse_valid_matches, dim=1)
+
+            # Image sized correspondence data is only computed if requested
+            if outputs is None or len({"target_matches", "valid_target_matches", "valid_correspondences"} & set(outputs)) > 0:
+                target_matches, valid_target_matches = self.scatter_sparse_correspondences(
+                    sparse_pixel_idxs, sparse_target_matches, sparse_valid_matches, image_height, image_width, target_matches_dense=target_matches
+                )
+                valid_correspondences = valid_target_matches # Sampled pixels are valid source points
+        else:
+            valid_correspondences = valid_source_points & valid_target_matches
+            num_valid_correspondences = torch.sum(valid_correspondences, dim=(1, 2))
 
-        # Initialize correspondence weights with 1's. We might overwrite them with MaskNet-predicted weights next
-        correspondence_weights = torch.ones(valid_target_matches.shape, dtype=torch.float32, device=valid_target_matches.device)
+        # Initialize correspondence weights with 1's (None). We might overwrite them with MaskNet-predicted weights next
+        correspondence_weights = None
 
         # We invalidate target matches later, when we assign a weight to each match.
         if opt.use_mask:
@@ -270,13 +583,10 @@ class DeformNet(torch.nn.Module):
 
                     correspondence_weights = mask_pred * selected #* opt.patch_size**2
 
-        num_valid_correspondences = torch.sum(valid_correspondences, dim=(1, 2))
-
         ########################################################################
         # Initialize graph data.
         ########################################################################
         num_nodes_total = graph_nodes.shape[1]
-        num_neighbors = graph_edges.shape[2]
 
         # We assume we always use 4 nearest anchors.
         assert pixel_anchors.shape[3] == 4
@@ -285,13 +595,15 @@ class DeformNet(torch.nn.Module):
         node_translations = torch.zeros((batch_size, num_nodes_total, 3), dtype=x1.dtype, device=x1.device) 
         deformations_validity = torch.zeros((batch_size, num_nodes_total), dtype=x1.dtype, device=x1.device) 
         valid_solve = torch.zeros((batch_size), dtype=torch.uint8, device=x1.device) 
-        deformed_points_pred = torch.zeros((batch_size, opt.gn_max_warped_points, 3), dtype=x1.dtype, device=x1.device) 
-        deformed_points_idxs = torch.zeros((batch_size, opt.gn_max_warped_points), dtype=torch.int64, device=x1.device) 
-        deformed_points_subsampled = torch.zeros((batch_size), dtype=torch.uint8, device=x1.device) 
+        deformed_points_pred, deformed_points_idxs, deformed_points_subsampled = None, None, None
+        if compute_deformed_points:
+            deformed_points_pred = torch.zeros((batch_size, opt.gn_max_warped_points, 3), dtype=x1.dtype, device=x1.device) 
+            deformed_points_idxs = torch.zeros((batch_size, opt.gn_max_warped_points), dtype=torch.int64, device=x1.device) 
+            deformed_points_subsampled = torch.zeros((batch_size), dtype=torch.uint8, device=x1.device) 
 
         # Skip the solver
         if not evaluate and opt.skip_solver:
-            return {
+            return self.select_outputs({
                 "flow_data": [flow2, flow3, flow4, flow5, flow6], 
                 "node_rotations": node_rotations,
                 "node_translations": node_translations,
@@ -314,7 +626,7 @@ class DeformNet(torch.nn.Module):
                     "total_corres_num": 0,
                     "total_corres_weight": 0.0
                 }
-            }
+            }, outputs)
 
         ########################################################################
         # Estimate node deformations using differentiable Gauss-Newton.
@@ -354,26 +666,31 @@ class DeformNet(torch.nn.Module):
             graph_edges_weights_i = graph_edges_weights[i, :num_nodes_i, :]     # (num_nodes_i, 8)
             graph_clusters_i      = graph_clusters[i, :num_nodes_i, :]          # (num_nodes_i, 1)
 
-            fx = intrinsics[i, 0]
-            fy = intrinsics[i, 1]
-            cx = intrinsics[i, 2]
-            cy = intrinsics[i, 3]
-
             ###############################################################################################################
             # Filter invalid matches.
             ###############################################################################################################
-            valid_correspondences_idxs = torch.where(valid_correspondences[i])
+            if use_sparse_correspondences:
+                valid_matches_i = sparse_valid_matches[i]
+                valid_pixel_idxs_i = sparse_pixel_idxs[i][valid_matches_i]
+                valid_correspondences_idxs = (valid_pixel_idxs_i // image_width, valid_pixel_idxs_i % image_width)
+
+                target_matches_filtered = sparse_target_matches[i][valid_matches_i].view(-1, 3, 1)
+            else:
+                valid_correspondences_idxs = torch.where(valid_correspondences[i])
+
+                target_matches_filtered = target_matches[i].permute(1, 2, 0)
+                target_matches_filtered = target_matches_filtered[valid_correspondences_idxs[0], valid_correspondences_idxs[1], :].view(-1, 3, 1)
 
             source_points_filtered = source_points[i].permute(1, 2, 0)
             source_points_filtered = source_points_filtered[valid_correspondences_idxs[0], valid_correspondences_idxs[1], :].view(-1, 3, 1)
-            
-            target_matches_filtered = target_matches[i].permute(1, 2, 0)
-            target_matches_filtered = target_matches_filtered[valid_correspondences_idxs[0], valid_correspondences_idxs[1], :].view(-1, 3, 1)
 
             xy_pixels_warped_filtered = xy_pixels_warped[i].permute(1, 2, 0) # (height, width, 2)
             xy_pixels_warped_filtered = xy_pixels_warped_filtered[valid_correspondences_idxs[0], valid_correspondences_idxs[1], :].view(-1, 2, 1)
 
-            correspondence_weights_filtered = correspondence_weights[i, valid_correspondences_idxs[0], valid_correspondences_idxs[1]].view(-1) # (num_matches)
+            if correspondence_weights is not None:
+                correspondence_weights_filtered = correspondence_weights[i, valid_correspondences_idxs[0], valid_correspondences_idxs[1]].view(-1) # (num_matches)
+            else:
+                correspondence_weights_filtered = torch.ones((valid_correspondences_idxs[0].shape[0]), dtype=torch.float32, device=x1.device)
 
             source_anchors = pixel_anchors[i, valid_correspondences_idxs[0], valid_correspondences_idxs[1], :] # (num_matches, 4)
             source_weights = pixel_weights[i, valid_correspondences_idxs[0], valid_correspondences_idxs[1], :] # (num_matches, 4)
@@ -391,13 +708,6 @@ class DeformNet(torch.nn.Module):
             ###############################################################################################################
             # Randomly subsample matches, if necessary.
             ###############################################################################################################
-            if split == "val" or split == "test":
-                max_num_matches = opt.gn_max_matches_eval
-            elif split == "train":
-                max_num_matches = opt.gn_max_matches_train
-            else:
-                raise Exception("Split {} is not defined".format(split))
-
             if num_matches > max_num_matches:
                 sampled_idxs = torch.randperm(num_matches)[:max_num_matches]
 
@@ -414,69 +724,49 @@ class DeformNet(torch.nn.Module):
             # Remove nodes if their corresponding clusters don't have enough correspondences
             # (Correspondences that have "bad" nodes as anchors will also be removed)
             ###############################################################################################################
+            if solver_plans is not None:
+                solver_plan_i = solver_plans[i]
+                assert solver_plan_i.num_nodes == num_nodes_i, "Solver plan was computed for a different graph"
+            else:
+                solver_plan_i = GaussNewtonPlan.from_graph(graph_edges_i, graph_edges_weights_i, graph_clusters_i)
+
             map_opt_nodes_to_complete_nodes_i = list(range(0, num_nodes_i))
             opt_num_nodes_i = num_nodes_i
 
             if opt.gn_remove_clusters_with_few_matches:
-                source_anchors_numpy         = source_anchors.clone().cpu().numpy()
-                source_weights_numpy         = source_weights.clone().cpu().numpy()
+                source_anchors_long = source_anchors.type(torch.int64)
 
                 # Compute number of correspondences (or matches) per node in the form of the
-                # match weight sum
-                match_weights_per_node = np.zeros(num_nodes_i)
-
-                # This method adds weight contribution of each match to the corresponding node,
-                # allowing duplicate node ids in the flattened array.
-                np.add.at(match_weights_per_node, source_anchors_numpy.flatten(), source_weights_numpy.flatten())
-                
-                total_match_weights = 0.0
-                match_weights_per_cluster = {}
-                for node_id in range(num_nodes_i):
-                    # Get sum of weights for current node.
-                    match_weights = match_weights_per_node[node_id]
-
-                    # Get cluster id for current node
-                    cluster_id = graph_clusters_i[node_id].item()
-                    
-                    if cluster_id in match_weights_per_cluster:
-                        match_weights_per_cluster[cluster_id] += match_weights
-                    else:
-                        match_weights_per_cluster[cluster_id] = match_weights
+                # match weight sum. index_add adds the weight contribution of each match to the 
+                # corresponding node, allowing duplicate node ids in the flattened array.
+                match_weights_per_node = torch.zeros((num_nodes_i), dtype=source_weights.dtype, device=x1.device)
+                match_weights_per_node = match_weights_per_node.index_add(0, source_anchors_long.view(-1), source_weights.reshape(-1))
 
-                    total_match_weights += match_weights
+                match_weights_per_cluster = torch.zeros((solver_plan_i.num_clusters), dtype=source_weights.dtype, device=x1.device)
+                match_weights_per_cluster = match_weights_per_cluster.index_add(0, solver_plan_i.node_cluster_idxs, match_weights_per_node)
 
-                # we'll build a mask that stores which nodes will survive
-                valid_nodes_mask_i = torch.ones((num_nodes_i), dtype=torch.bool, device=x1.device)
-                
-                # if not enough matches in a cluster, mark all cluster's nodes for removal
-                node_ids_for_removal = []
-                for cluster_id, cluster_match_weights in match_weights_per_cluster.items():
-                    if opt.gn_debug:
+                if opt.gn_debug:
+                    for cluster_id, cluster_match_weights in zip(solver_plan_i.cluster_ids.tolist(), match_weights_per_cluster.tolist()):
                         print('cluster_id', cluster_id, cluster_match_weights)
 
-                    if cluster_match_weights < opt.gn_min_num_correspondences_per_cluster:
-                        x = torch.where(graph_clusters_i == cluster_id)[0].tolist()
-                        node_ids_for_removal += x
+                # if not enough matches in a cluster, mark all cluster's nodes for removal
+                valid_nodes_mask_i = (match_weights_per_cluster >= opt.gn_min_num_correspondences_per_cluster)[solver_plan_i.node_cluster_idxs]
 
                 if opt.gn_debug:
-                    print("node_ids_for_removal", node_ids_for_removal)
-
-                if len(node_ids_for_removal) > 0:
-                    # Mark invalid nodes
-                    valid_nodes_mask_i[node_ids_for_removal] = False
+                    print("node_ids_for_removal", torch.where(~valid_nodes_mask_i)[0].tolist())
 
+                if not valid_nodes_mask_i.all():
                     # Kepp only nodes and edges for valid nodes
-                    graph_nodes_i         = graph_nodes_i[valid_nodes_mask_i.squeeze()]
-                    graph_edges_i         = graph_edges_i[valid_nodes_mask_i.squeeze()] 
-                    graph_edges_weights_i = graph_edges_weights_i[valid_nodes_mask_i.squeeze()] 
+                    graph_nodes_i          = graph_nodes_i[valid_nodes_mask_i]
+                    original_graph_nodes_i = original_graph_nodes_i[valid_nodes_mask_i]
+                    graph_edges_i          = graph_edges_i[valid_nodes_mask_i] 
+                    graph_edges_weights_i  = graph_edges_weights_i[valid_nodes_mask_i] 
 
                     # Update number of nodes
                     opt_num_nodes_i = graph_nodes_i.shape[0]
 
-                    # Get mask of correspondences for which any one of their anchors is an invalid node
-                    valid_corresp_mask = torch.ones((num_matches), dtype=torch.bool, device=x1.device)
-                    for node_id_for_removal in node_ids_for_removal:
-                        valid_corresp_mask = valid_corresp_mask & torch.all(source_anchors != node_id_for_removal, axis=1)
+                    # Keep only correspondences for which all anchors are valid nodes
+                    valid_corresp_mask = torch.all(valid_nodes_mask_i[source_anchors_long], dim=1)
 
                     source_points_filtered           = source_points_filtered[valid_corresp_mask]
                     target_matches_filtered          = target_matches_filtered[valid_corresp_mask]
@@ -487,15 +777,19 @@ class DeformNet(torch.nn.Module):
 
                     num_matches = source_points_filtered.shape[0]
 
-                    # Update node_ids in edges and anchors by mapping old indices to new indices
-                    map_opt_nodes_to_complete_nodes_i = []
-                    node_count = 0
-                    for node_id, is_node_valid in enumerate(valid_nodes_mask_i):
-                        if is_node_valid:
-                            graph_edges_i[graph_edges_i == node_id]     = node_count
-                            source_anchors[source_anchors == node_id]   = node_count
-                            map_opt_nodes_to_complete_nodes_i.append(node_id)
-                            node_count += 1
+                    # Update node_ids in edges and anchors by mapping old indices to new indices.
+                    # Edges to removed nodes become invalid.
+                    map_complete_to_opt_nodes_i = torch.cumsum(valid_nodes_mask_i.type(torch.int64), dim=0) - 1
+                    map_complete_to_opt_nodes_i[~valid_nodes_mask_i] = -1
+
+                    valid_edges_i = graph_edges_i >= 0
+                    graph_edges_i = torch.where(valid_edges_i, map_complete_to_opt_nodes_i[graph_edges_i.type(torch.int64) * valid_edges_i], -torch.ones_like(graph_edges_i, dtype=torch.int64)).type(graph_edges_i.dtype)
+                    source_anchors = map_complete_to_opt_nodes_i[source_anchors.type(torch.int64)].type(source_anchors.dtype)
+
+                    map_opt_nodes_to_complete_nodes_i = torch.where(valid_nodes_mask_i)[0].tolist()
+
+                    # The plan of the complete graph doesn't apply to the reduced graph
+                    solver_plan_i = GaussNewtonPlan.from_graph(graph_edges_i, graph_edges_weights_i, graph_clusters_i[valid_nodes_mask_i])
                     
             if num_matches == 0: 
                 if opt.gn_debug:
@@ -514,33 +808,9 @@ class DeformNet(torch.nn.Module):
             assert torch.all(source_anchors >= 0)
             source_anchors = source_anchors.type(torch.int64)
 
-            ###############################################################################################################
-            # Filter invalid edges.
-            ###############################################################################################################
-            node_ids = torch.arange(opt_num_nodes_i, dtype=torch.int32, device=x1.device).view(-1, 1).repeat(1, num_neighbors) # (opt_num_nodes_i, num_neighbors)
-            graph_edge_pairs = torch.cat([node_ids.view(-1, num_neighbors, 1), graph_edges_i.view(-1, num_neighbors, 1)], 2) # (opt_num_nodes_i, num_neighbors, 2)
-
-            valid_edges = graph_edges_i >= 0
-            valid_edge_idxs = torch.where(valid_edges)
-            graph_edge_pairs_filtered = graph_edge_pairs[valid_edge_idxs[0], valid_edge_idxs[1], :].type(torch.int64)
-            graph_edge_weights_pairs  = graph_edges_weights_i[valid_edge_idxs[0], valid_edge_idxs[1]]
-            
-            num_edges_i = graph_edge_pairs_filtered.shape[0]
-
             ###############################################################################################################
             # Execute Gauss-Newton solver.
             ###############################################################################################################
-            num_gn_iter = self.gn_num_iter
-            lambda_data_flow = math.sqrt(self.gn_data_flow)
-            lambda_data_depth = math.sqrt(self.gn_data_depth)
-            lambda_arap = math.sqrt(self.gn_arap)
-            lm_factor = self.gn_lm_factor
-            
-            # The parameters in GN solver are 3 parameters for rotation and 3 parameters for
-            # translation for every node. All node rotation parameters are listed first, and
-            # then all node translation parameters are listed.
-            #                        x = [w_current_all, t_current_all]
-
             if prev_rot is None and prev_trans is None:
                 R_current = torch.eye(3, dtype=x1.dtype, device=x1.device).view(1, 3, 3).repeat(opt_num_nodes_i, 1, 1)
                 t_current = torch.zeros((opt_num_nodes_i, 3, 1), dtype=x1.dtype, device=x1.device) 
@@ -548,275 +818,30 @@ class DeformNet(torch.nn.Module):
                 R_current = torch.tensor(prev_rot[map_opt_nodes_to_complete_nodes_i, :, :],dtype=x1.dtype,device=x1.device).view(opt_num_nodes_i, 3, 3)
                 t_current = torch.tensor(prev_trans[map_opt_nodes_to_complete_nodes_i, :],dtype=x1.dtype,device=x1.device).view(opt_num_nodes_i, 3, 1)
 
-            if opt.gn_debug:
-                print("\tNum. matches: {0} || Num. nodes: {1} || Num. edges: {2}".format(num_matches, opt_num_nodes_i, num_edges_i))
-
-            # Helper structures.
-            data_increment_vec_0_3 = torch.arange(0, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_matches)
-            data_increment_vec_1_3 = torch.arange(1, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_matches)
-            data_increment_vec_2_3 = torch.arange(2, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_matches)
-
-            if num_edges_i > 0:
-                arap_increment_vec_0_3 = torch.arange(0, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_edges_i)
-                arap_increment_vec_1_3 = torch.arange(1, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_edges_i)
-                arap_increment_vec_2_3 = torch.arange(2, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=x1.device) # (num_edges_i)
-                arap_one_vec = torch.ones((num_edges_i), dtype=x1.dtype, device=x1.device)
-
-            ill_posed_system = False
-
-
-            # print("Valid Edges Weights",graph_edge_weights_pairs)
-            # print("Valid Edges", graph_edge_pairs_filtered)    
-
-            # print("Source Weights:",source_weights)
-            # print("Source anchors:",source_anchors)
-            for gn_i in range(num_gn_iter):
-
-                if gn_i % 3 == 2:
-                    lm_factor /= 2;
-
-                timer_data_start = timer()
-
-                ##########################################
-                # Compute data residual and jacobian.
-                ##########################################
-                jacobian_data = torch.zeros((num_matches * 3, opt_num_nodes_i * 6), dtype=x1.dtype, device=x1.device) # (num_matches*3, opt_num_nodes_i*6)
-                deformed_points = torch.zeros((num_matches, 3, 1), dtype=x1.dtype, device=x1.device) 
-
-                for k in range(4): # Our data uses 4 anchors for every point
-                    node_idxs_k = source_anchors[:, k] # (num_matches)
-                    nodes_k = graph_nodes_i[node_idxs_k].view(num_matches, 3, 1) # (num_matches, 3, 1)
-
-                    # Compute deformed point contribution.                    
-                    rotated_points_k = torch.matmul(R_current[node_idxs_k], source_points_filtered - nodes_k) # (num_matches, 3, 1) = (num_matches, 3, 3) * (num_matches, 3, 1)
-                    deformed_points_k = rotated_points_k + nodes_k + t_current[node_idxs_k]
-                    deformed_points += source_weights[:, k].view(num_matches, 1, 1).repeat(1, 3, 1) * deformed_points_k # (num_matches, 3, 1)
-
-
-                # Get necessary components of deformed points.
-                eps = 1e-7 # Just as good practice, although matches should all have valid depth at this stage
-
-                deformed_x = deformed_points[:, 0, :].view(num_matches) # (num_matches)
-                deformed_y = deformed_points[:, 1, :].view(num_matches) # (num_matches)
-                deformed_z_inverse = torch.div(1.0, deformed_points[:, 2, :].view(num_matches) + eps) # (num_matches)
-                fx_mul_x = fx * deformed_x # (num_matches)
-                fy_mul_y = fy * deformed_y # (num_matches)
-                fx_div_z = fx * deformed_z_inverse # (num_matches)
-                fy_div_z = fy * deformed_z_inverse # (num_matches)
-                fx_mul_x_div_z = fx_mul_x * deformed_z_inverse # (num_matches)
-                fy_mul_y_div_z = fy_mul_y * deformed_z_inverse # (num_matches)
-                minus_fx_mul_x_div_z_2 = -fx_mul_x_div_z * deformed_z_inverse # (num_matches)
-                minus_fy_mul_y_div_z_2 = -fy_mul_y_div_z * deformed_z_inverse # (num_matches)
-
-                for k in range(4): # Our data uses 4 anchors for every point
-                    node_idxs_k = source_anchors[:, k] # (num_matches)
-                    nodes_k = graph_nodes_i[node_idxs_k].view(num_matches, 3, 1) # (num_matches, 3, 1)
-
-                    weights_k = source_weights[:, k] * correspondence_weights_filtered # (num_matches)
-
-                    # Compute skew symetric part.                
-                    rotated_points_k = torch.matmul(R_current[node_idxs_k], source_points_filtered - nodes_k) # (num_matches, 3, 1) = (num_matches, 3, 3) * (num_matches, 3, 1)
-                    weighted_rotated_points_k = weights_k.view(num_matches, 1, 1).repeat(1, 3, 1) * rotated_points_k # (num_matches, 3, 1)
-                    skew_symetric_mat_data = -torch.matmul(self.vec_to_skew_mat, weighted_rotated_points_k).view(num_matches, 3, 3) # (num_matches, 3, 3)
-
-                    # Compute jacobian wrt. TRANSLATION.
-                    # FLOW PART
-                    jacobian_data[data_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_k + 0] += lambda_data_flow * weights_k * fx_div_z # (num_matches)
-                    jacobian_data[data_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_k + 2] += lambda_data_flow * weights_k * minus_fx_mul_x_div_z_2 # (num_matches)
-                    jacobian_data[data_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_k + 1] += lambda_data_flow * weights_k * fy_div_z # (num_matches)
-                    jacobian_data[data_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_k + 2] += lambda_data_flow * weights_k * minus_fy_mul_y_div_z_2 # (num_matches)
-                    
-                    # DEPTH PART
-                    jacobian_data[data_increment_vec_2_3, 3 * opt_num_nodes_i + 3 * node_idxs_k + 2] += lambda_data_depth * weights_k # (num_matches)
-
-                    # Compute jacobian wrt. ROTATION.
-                    # FLOW PART
-                    jacobian_data[data_increment_vec_0_3,                   3 * node_idxs_k + 0] += lambda_data_flow * fx_div_z * skew_symetric_mat_data[:, 0, 0] + minus_fx_mul_x_div_z_2 * skew_symetric_mat_data[:, 2, 0]
-                    jacobian_data[data_increment_vec_0_3,                   3 * node_idxs_k + 1] += lambda_data_flow * fx_div_z * skew_symetric_mat_data[:, 0, 1] + minus_fx_mul_x_div_z_2 * skew_symetric_mat_data[:, 2, 1]
-                    jacobian_data[data_increment_vec_0_3,                   3 * node_idxs_k + 2] += lambda_data_flow * fx_div_z * skew_symetric_mat_data[:, 0, 2] + minus_fx_mul_x_div_z_2 * skew_symetric_mat_data[:, 2, 2]
-                    jacobian_data[data_increment_vec_1_3,                   3 * node_idxs_k + 0] += lambda_data_flow * fy_div_z * skew_symetric_mat_data[:, 1, 0] + minus_fy_mul_y_div_z_2 * skew_symetric_mat_data[:, 2, 0]
-                    jacobian_data[data_increment_vec_1_3,                   3 * node_idxs_k + 1] += lambda_data_flow * fy_div_z * skew_symetric_mat_data[:, 1, 1] + minus_fy_mul_y_div_z_2 * skew_symetric_mat_data[:, 2, 1]
-                    jacobian_data[data_increment_vec_1_3,                   3 * node_idxs_k + 2] += lambda_data_flow * fy_div_z * skew_symetric_mat_data[:, 1, 2] + minus_fy_mul_y_div_z_2 * skew_symetric_mat_data[:, 2, 2]
-                    
-                    # DEPTH PART
-                    jacobian_data[data_increment_vec_2_3,                   3 * node_idxs_k + 0] += lambda_data_depth * skew_symetric_mat_data[:, 2, 0]
-                    jacobian_data[data_increment_vec_2_3,                   3 * node_idxs_k + 1] += lambda_data_depth * skew_symetric_mat_data[:, 2, 1]
-                    jacobian_data[data_increment_vec_2_3,                   3 * node_idxs_k + 2] += lambda_data_depth * skew_symetric_mat_data[:, 2, 2]
-
-                    assert torch.isfinite(jacobian_data).all(), jacobian_data
-
-                res_data = torch.zeros((num_matches * 3, 1), dtype=x1.dtype, device=x1.device)
-
-                # FLOW PART
-                res_data[data_increment_vec_0_3, 0] = lambda_data_flow * correspondence_weights_filtered * (fx_mul_x_div_z + cx - xy_pixels_warped_filtered[:, 0, :].view(num_matches))
-                res_data[data_increment_vec_1_3, 0] = lambda_data_flow * correspondence_weights_filtered * (fy_mul_y_div_z + cy - xy_pixels_warped_filtered[:, 1, :].view(num_matches))
-                
-                # DEPTH PART
-                res_data[data_increment_vec_2_3, 0] = lambda_data_depth * correspondence_weights_filtered * (deformed_points[:, 2, :] - target_matches_filtered[:, 2, :]).view(num_matches)
-
-
-                if opt.gn_print_timings: print("\t\tData term: {:.3f} s".format(timer() - timer_data_start))
-                timer_arap_start = timer()
-
-                ##########################################
-                # Compute arap residual and jacobian.
-                ##########################################
-                if num_edges_i > 0:
-                    jacobian_arap = torch.zeros((num_edges_i * 3, opt_num_nodes_i * 6), dtype=x1.dtype, device=x1.device) # (num_edges_i*3, opt_num_nodes_i*6)
-
-                    node_idxs_0 = graph_edge_pairs_filtered[:, 0] # i node
-                    node_idxs_1 = graph_edge_pairs_filtered[:, 1] # j node
-
-                    w = torch.ones_like(graph_edge_weights_pairs)
-                    if opt.gn_use_edge_weighting:
-                        # Since graph edge weights sum up to 1 for all neighbors, we multiply
-                        # it by the number of neighbors to make the setting in the same scale
-                        # as in the case of not using edge weights (they are all 1 then).
-                        w = float(num_neighbors) * graph_edge_weights_pairs
-
-                    w_repeat        = w.unsqueeze(-1).repeat(1, 3).unsqueeze(-1)
-                    w_repeat_repeat = w_repeat.repeat(1, 1, 3)
-
-                    nodes_0 = original_graph_nodes_i[node_idxs_0].view(num_edges_i, 3, 1)
-                    nodes_1 = original_graph_nodes_i[node_idxs_1].view(num_edges_i, 3, 1)
-
-                    # Compute residual.
-                    rotated_node_delta = torch.matmul(R_current[node_idxs_0], nodes_1 - nodes_0) # (num_edges_i, 3)
-                    res_arap = lambda_arap * w_repeat * (rotated_node_delta + nodes_0 + t_current[node_idxs_0] - (nodes_1 + t_current[node_idxs_1]))
-                    res_arap = res_arap.view(num_edges_i * 3, 1)
-
-                    # Compute jacobian wrt. translations.
-                    jacobian_arap[arap_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 0] += lambda_arap * w * arap_one_vec # (num_edges_i)
-                    jacobian_arap[arap_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 1] += lambda_arap * w * arap_one_vec # (num_edges_i)
-                    jacobian_arap[arap_increment_vec_2_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 2] += lambda_arap * w * arap_one_vec # (num_edges_i)
-
-                    jacobian_arap[arap_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 0] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-                    jacobian_arap[arap_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 1] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-                    jacobian_arap[arap_increment_vec_2_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 2] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-
-                    # Compute jacobian wrt. rotations.
-                    # Derivative wrt. R_1 is equal to 0.
-                    skew_symetric_mat_arap = -lambda_arap * w_repeat_repeat * torch.matmul(self.vec_to_skew_mat, rotated_node_delta).view(num_edges_i, 3, 3) # (num_edges_i, 3, 3)
-
-                    jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 0, 0]
-                    jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 0, 1]
-                    jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 0, 2]
-                    jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 1, 0]
-                    jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 1, 1]
-                    jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 1, 2]
-                    jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 2, 0]
-                    jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 2, 1]
-                    jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 2, 2]
-
-                    assert torch.isfinite(jacobian_arap).all(), jacobian_arap
-                    
-                if opt.gn_print_timings: print("\t\tARAP term: {:.3f} s".format(timer() - timer_arap_start))
-
-                ##########################################
-                # Solve linear system.
-                ##########################################
-                if num_edges_i > 0:
-                    res = torch.cat((res_data, res_arap), 0)
-                    jac = torch.cat((jacobian_data, jacobian_arap), 0)
-                else:
-                    res = res_data
-                    jac = jacobian_data
-
-                timer_system_start = timer()
-
-                # Compute A = J^TJ and b = -J^Tr.
-                jac_t = torch.transpose(jac, 0, 1)
-                A = torch.matmul(jac_t, jac)
-                b = torch.matmul(-jac_t, res)
-
-                # Solve linear system Ax = b.
-                A = A + torch.eye(A.shape[0], dtype=A.dtype, device=A.device) * lm_factor
-
-                assert torch.isfinite(A).all(), A
-
-                if opt.gn_print_timings: print("\t\tSystem computation: {:.3f} s".format(timer() - timer_system_start))
-                timer_cond_start = timer()
-
-                # Check the determinant/condition number.
-                # If unstable, we break optimization.
-                if opt.gn_check_condition_num:
-                    with torch.no_grad():
-                        # Condition number.
-                        values, _ = torch.eig(A)
-                        real_values = values[:, 0]
-                        assert torch.isfinite(real_values).all(), real_values 
-                        max_eig_value = torch.max(torch.abs(real_values))
-                        min_eig_value = torch.min(torch.abs(real_values))
-                        condition_number = max_eig_value / min_eig_value
-                        condition_number = condition_number.item()
-                        convergence_info[i]["condition_numbers"].append(condition_number)
-
-                        if opt.gn_break_on_condition_num and (not math.isfinite(condition_number) or condition_number > opt.gn_max_condition_num):
-                            print("\t\tToo high condition number: {0:e} (max: {1:.3f}, min: {2:.3f}). Discarding sample".format(condition_number, max_eig_value.item(), min_eig_value.item()))
-                            convergence_info[i]["errors"].append("Too high condition number: {0:e} (max: {1:.3f}, min: {2:.3f}). Discarding sample".format(condition_number, max_eig_value.item(), min_eig_value.item()))
-                            ill_posed_system = True
-                            break
-                        elif opt.gn_debug: 
-                            print("\t\tCondition number: {0:e} (max: {1:.3f}, min: {2:.3f})".format(condition_number, max_eig_value.item(), min_eig_value.item()))
-
-                if opt.gn_print_timings: print("\t\tComputation of cond. num.: {:.3f} s".format(timer() - timer_cond_start))
-                timer_solve_start = timer()
-
-                linear_solver = LinearSolverLU.apply
-
-                try:
-                    x = linear_solver(A, b)
-
-                except RuntimeError as e:
-                    ill_posed_system = True
-                    print("\t\tSolver failed: Ill-posed system!", e)
-                    convergence_info[i]["errors"].append("Solver failed: Ill-posed system!")
-                    break
-
-                if not torch.isfinite(x).all():
-                    ill_posed_system = True
-                    print("\t\tSolver failed: Non-finite solution x!")
-                    convergence_info[i]["errors"].append("Solver failed: Non-finite solution x!")
-                    break
-            
-                if opt.gn_print_timings: print("\t\tLinear solve: {:.3f} s".format(timer() - timer_solve_start))
-                    
-                loss_data = torch.norm(res_data).item()
-                loss_total = torch.norm(res).item()
-
-                if len(convergence_info[i]["total"]): 
-                    if loss_total - convergence_info[i]["total"][-1] > self.stop_loss_diff:
-                        print("As loss is greater than before breaking optimization")
-                        break
-                    if loss_total == convergence_info[i]["total"][-1]:
-                        print("loss not changing")
-                        break
-
-                convergence_info[i]["data"].append(loss_data)
-                convergence_info[i]["total"].append(loss_total)
-
-                # Increment the current rotation and translation.
-                R_inc = kornia.geometry.conversions.angle_axis_to_rotation_matrix(x[:opt_num_nodes_i*3].view(opt_num_nodes_i, 3))
-                t_inc = x[opt_num_nodes_i*3:].view(opt_num_nodes_i, 3, 1)
-
-                R_current = torch.matmul(R_inc, R_current)
-                t_current = t_current + t_inc
-
-
-                if num_edges_i > 0:
-                    loss_arap = torch.norm(res_arap).item()
-                    convergence_info[i]["arap"].append(loss_arap)
+            num_gn_iter = self.gn_num_iter
 
-                if opt.gn_debug:
-                    if num_edges_i > 0:
-                        print("\t\t-->Iteration: {0}. Lm:{1:.3f} Loss: \tdata = {2:.3f}, \tarap = {3:.3f}, \ttotal = {4:.3f}".format(gn_i, lm_factor,loss_data, loss_arap, loss_total))
-                    else:
-                        print("\t\t-->Iteration: {0}. Loss: \tdata = {1:.3f}, \ttotal = {2:.3f}".format(gn_i, loss_data, loss_total))
+            # Converge the large motions on a coarse graph first, then only refine on the complete graph.
+            if opt.gn_use_hierarchical_solve:
+                R_current, t_current, valid_coarse_solve = self.solve_coarse_graph(
+                    graph_nodes_i, original_graph_nodes_i, solver_plan_i,
+                    source_points_filtered, target_matches_filtered, xy_pixels_warped_filtered, correspondence_weights_filtered,
+                    source_anchors, source_weights, intrinsics[i],
+                    R_current, t_current, convergence_info[i]
+                )
+                if valid_coarse_solve:
+                    num_gn_iter = opt.gn_num_fine_iter
+
+            R_current, t_current, res, ill_posed_system = self.solve_gauss_newton(
+                graph_nodes_i, original_graph_nodes_i, solver_plan_i,
+                source_points_filtered, target_matches_filtered, xy_pixels_warped_filtered, correspondence_weights_filtered,
+                source_anchors, source_weights, intrinsics[i],
+                R_current, t_current, num_gn_iter, convergence_info[i]
+            )
 
             ###############################################################################################################
             # Write the solutions.
             ###############################################################################################################
-            if not ill_posed_system and torch.isfinite(res).all():
+            if not ill_posed_system and res is not None and torch.isfinite(res).all():
                 node_rotations[i, map_opt_nodes_to_complete_nodes_i, :, :] = R_current.view(opt_num_nodes_i, 3, 3)
                 node_translations[i, map_opt_nodes_to_complete_nodes_i, :] = t_current.view(opt_num_nodes_i, 3)
                 deformations_validity[i, map_opt_nodes_to_complete_nodes_i] = 1 
@@ -825,7 +850,7 @@ class DeformNet(torch.nn.Module):
             ###############################################################################################################
             # Warp all valid source points using estimated deformations.
             ###############################################################################################################
-            if valid_solve[i]:
+            if valid_solve[i] and compute_deformed_points:
                 # Filter out any invalid pixel anchors, and invalid source points.
                 source_points_i = source_points[i].permute(1, 2, 0)
                 source_points_i = source_points_i[valid_correspondences_idxs[0], valid_correspondences_idxs[1], :].view(-1, 3, 1)
@@ -891,7 +916,7 @@ class DeformNet(torch.nn.Module):
                 convergence_info[i]["errors"].append("Solver failed: Too many matches per batch: {}".format(total_num_matches_per_batch))
                 valid_solve[i] = 0
 
-        return {
+        return self.select_outputs({
             "flow_data": [flow2, flow3, flow4, flow5, flow6], 
             "node_rotations": node_rotations,
             "node_translations": node_translations,
@@ -911,19 +936,929 @@ class DeformNet(torch.nn.Module):
             }, 
             "convergence_info": convergence_info,
             "weight_info": weight_info,
+        }, outputs)
+
+    @staticmethod
+    def select_outputs(model_data, outputs):
+        """
+            Keep only the requested outputs (see forward), so tensors which are not needed are released
+            @params:
+                model_data: dict: All outputs of forward
+                outputs: set of output names or None to keep everything
+        """
+        if outputs is None:
+            return model_data
+
+        selected = {k: v for k, v in model_data.items() if k in outputs}
+
+        if "correspondence_info" not in outputs:
+            correspondence_info = {k: v for k, v in model_data["correspondence_info"].items() if k in outputs}
+            if len(correspondence_info) > 0:
+                selected["correspondence_info"] = correspondence_info
+
+        return selected
+
+    def solve_gauss_newton(
+        self, graph_nodes_i, original_graph_nodes_i, solver_plan_i,
+        source_points_filtered, target_matches_filtered, xy_pixels_warped_filtered, correspondence_weights_filtered,
+        source_anchors, source_weights, intrinsics_i,
+        R_current, t_current, num_gn_iter, convergence_info_i
+    ):
+        """
+            Run the differentiable Gauss-Newton solver for the deformation of a single graph
+            @params:
+                graph_nodes_i: torch.Tensor: (N, 3): Graph nodes at source
+                original_graph_nodes_i: torch.Tensor: (N, 3): Graph nodes used for the ARAP term
+                solver_plan_i: GaussNewtonPlan: Edges and index helpers of the graph
+                source_points_filtered, target_matches_filtered: torch.Tensor: (M, 3, 1): Correspondences
+                xy_pixels_warped_filtered: torch.Tensor: (M, 2, 1): Target pixel of each correspondence
+                correspondence_weights_filtered: torch.Tensor: (M): Weight of each correspondence
+                source_anchors, source_weights: (M, 4): Anchor nodes and skinning weights of the source points
+                intrinsics_i: (4): fx, fy, cx, cy
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Initial node transformations
+                num_gn_iter: int: Maximum number of GN iterations
+                convergence_info_i: dict: Convergence info of this sample, filled in place
+            @returns:
+                R_current, t_current: Estimated node transformations
+                res: torch.Tensor: Residual vector of the last iteration (None if no iteration was run)
+                ill_posed_system: bool: True if the solver failed
+        """
+        dtype = graph_nodes_i.dtype
+        device = graph_nodes_i.device
+
+        opt_num_nodes_i = graph_nodes_i.shape[0]
+        num_matches = source_points_filtered.shape[0]
+        num_edges_i = solver_plan_i.num_edges
+
+        fx = intrinsics_i[0]
+        fy = intrinsics_i[1]
+        cx = intrinsics_i[2]
+        cy = intrinsics_i[3]
+
+        lambda_data_flow = math.sqrt(self.gn_data_flow)
+        lambda_data_depth = math.sqrt(self.gn_data_depth)
+        lambda_arap = math.sqrt(self.gn_arap)
+
+        # The parameters in GN solver are 3 parameters for rotation and 3 parameters for
+        # translation for every node. All node rotation parameters are listed first, and
+        # then all node translation parameters are listed.
+        #                        x = [w_current_all, t_current_all]
+
+        if opt.gn_debug:
+            print("\tNum. matches: {0} || Num. nodes: {1} || Num. edges: {2}".format(num_matches, opt_num_nodes_i, num_edges_i))
+
+        # Nodes of different clusters can be solved independently.
+        solve_blocks = None
+        if opt.gn_solve_clusters_independently:
+            solve_blocks = solver_plan_i.get_solve_blocks(source_anchors)
+
+            if opt.gn_debug and solve_blocks is not None:
+                print("\tSolving {0} independent blocks".format(sum(block_idxs.shape[0] for block_idxs, _ in solve_blocks)))
+
+        problem = {
+            "dtype": dtype, "device": device,
+            "num_nodes": opt_num_nodes_i, "num_matches": num_matches, "num_edges": num_edges_i,
+            "graph_nodes": graph_nodes_i, "original_graph_nodes": original_graph_nodes_i, "plan": solver_plan_i,
+            "source_points": source_points_filtered, "target_matches": target_matches_filtered,
+            "xy_pixels_warped": xy_pixels_warped_filtered, "correspondence_weights": correspondence_weights_filtered,
+            "source_anchors": source_anchors, "source_weights": source_weights,
+            "intrinsics": (fx, fy, cx, cy),
+            "lambda_data_flow": lambda_data_flow, "lambda_data_depth": lambda_data_depth, "lambda_arap": lambda_arap,
+            "data_increment_vecs": solver_plan_i.data_increment_vecs(num_matches),
+            "solve_blocks": solve_blocks,
+        }
+
+        solver = self.solve_levenberg_marquardt if opt.gn_use_adaptive_lm else self.solve_fixed_damping
+
+        if opt.gn_backward_mode == "implicit" and torch.is_grad_enabled() and num_gn_iter > 1:
+            # Only the final GN step at the solution is differentiated. At convergence (J^T r = 0) its
+            # gradient is the implicit function gradient -(J^TJ)^-1 d(J^T r), so the unrolled iterations
+            # don't need to be stored for the backward pass.
+            with torch.no_grad():
+                R_current, t_current, res, ill_posed_system = solver(problem, R_current, t_current, num_gn_iter - 1, convergence_info_i)
+
+            if ill_posed_system:
+                return R_current, t_current, res, ill_posed_system
+
+            return self.solve_final_step(problem, R_current.detach(), t_current.detach(), num_gn_iter, convergence_info_i)
+
+        return solver(problem, R_current, t_current, num_gn_iter, convergence_info_i)
+
+    def solve_final_step(self, problem, R_current, t_current, num_gn_iter, convergence_info_i):
+        """
+            Differentiable GN step from the (detached) solution, used for gn_backward_mode == "implicit".
+            The step is always applied, it is close to zero at convergence.
+            @params:
+                problem: dict: Solver inputs, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Solution of the solver
+                num_gn_iter: int: Number of iterations of the solve, selects the damping of the last iteration
+                convergence_info_i: dict: Convergence info of this sample, filled in place
+            @returns:
+                R_current, t_current, res, ill_posed_system: Same as solve_gauss_newton
+        """
+        opt_num_nodes_i = problem["num_nodes"]
+        lm_factor = self.gn_lm_factor / 2**(num_gn_iter // 3)
+
+        _, _, res, JtJ, gradient = self.compute_normal_equations(problem, R_current, t_current)
+        A = JtJ + torch.eye(JtJ.shape[0], dtype=JtJ.dtype, device=JtJ.device) * lm_factor
+
+        try:
+            x = self.solve_linear_system(A, -gradient, problem["solve_blocks"])
+        except RuntimeError as e:
+            print("\t\tSolver failed: Ill-posed system!", e)
+            convergence_info_i["errors"].append("Solver failed: Ill-posed system!")
+            return R_current, t_current, res, True
+
+        if not torch.isfinite(x).all():
+            print("\t\tSolver failed: Non-finite solution x!")
+            convergence_info_i["errors"].append("Solver failed: Non-finite solution x!")
+            return R_current, t_current, res, True
+
+        R_inc = kornia.geometry.conversions.angle_axis_to_rotation_matrix(x[:opt_num_nodes_i*3].view(opt_num_nodes_i, 3))
+        t_inc = x[opt_num_nodes_i*3:].view(opt_num_nodes_i, 3, 1)
+
+        return torch.matmul(R_inc, R_current), t_current + t_inc, res, False
+
+    def solve_fixed_damping(self, problem, R_current, t_current, num_gn_iter, convergence_info_i):
+        """
+            Gauss-Newton iterations with the fixed damping schedule (gn_lm_factor, halved every 3 iterations)
+            @params:
+                problem: dict: Solver inputs, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Initial node transformations
+                num_gn_iter: int: Maximum number of iterations
+                convergence_info_i: dict: Convergence info of this sample, filled in place
+            @returns:
+                R_current, t_current, res, ill_posed_system: Same as solve_gauss_newton
+        """
+        opt_num_nodes_i = problem["num_nodes"]
+        num_edges_i = problem["num_edges"]
+        solve_blocks = problem["solve_blocks"]
+        lm_factor = self.gn_lm_factor
+
+        ill_posed_system = False
+        res = None
+
+        for gn_i in range(num_gn_iter):
+
+            if gn_i % 3 == 2:
+                lm_factor /= 2;
+
+            timer_build_start = timer()
+
+            # Compute A = J^TJ and b = -J^Tr.
+            res_data, res_arap, res, A, gradient = self.compute_normal_equations(problem, R_current, t_current)
+            b = -gradient
+
+            if opt.gn_print_timings: print("\t\tData and ARAP term: {:.3f} s".format(timer() - timer_build_start))
+
+            ##########################################
+            # Solve linear system.
+            ##########################################
+            timer_system_start = timer()
+
+            # Solve linear system Ax = b.
+            A = A + torch.eye(A.shape[0], dtype=A.dtype, device=A.device) * lm_factor
+
+            assert torch.isfinite(A).all(), A
+
+            if opt.gn_print_timings: print("\t\tSystem computation: {:.3f} s".format(timer() - timer_system_start))
+            timer_cond_start = timer()
+
+            # Check the determinant/condition number.
+            # If unstable, we break optimization.
+            if opt.gn_check_condition_num:
+                with torch.no_grad():
+                    # Condition number.
+                    # A is symmetric, so its eigenvalues are real.
+                    real_values = torch.linalg.eigvalsh(A)
+                    assert torch.isfinite(real_values).all(), real_values 
+                    max_eig_value = torch.max(torch.abs(real_values))
+                    min_eig_value = torch.min(torch.abs(real_values))
+                    condition_number = max_eig_value / min_eig_value
+                    condition_number = condition_number.item()
+                    convergence_info_i["condition_numbers"].append(condition_number)
+
+                    if opt.gn_break_on_condition_num and (not math.isfinite(condition_number) or condition_number > opt.gn_max_condition_num):
+                        print("\t\tToo high condition number: {0:e} (max: {1:.3f}, min: {2:.3f}). Discarding sample".format(condition_number, max_eig_value.item(), min_eig_value.item()))
+                        convergence_info_i["errors"].append("Too high condition number: {0:e} (max: {1:.3f}, min: {2:.3f}). Discarding sample".format(condition_number, max_eig_value.item(), min_eig_value.item()))
+                        ill_posed_system = True
+                        break
+                    elif opt.gn_debug: 
+                        print("\t\tCondition number: {0:e} (max: {1:.3f}, min: {2:.3f})".format(condition_number, max_eig_value.item(), min_eig_value.item()))
+
+            if opt.gn_print_timings: print("\t\tComputation of cond. num.: {:.3f} s".format(timer() - timer_cond_start))
+            timer_solve_start = timer()
+
+            try:
+                x = self.solve_linear_system(A, b, solve_blocks)
+
+            except RuntimeError as e:
+                ill_posed_system = True
+                print("\t\tSolver failed: Ill-posed system!", e)
+                convergence_info_i["errors"].append("Solver failed: Ill-posed system!")
+                break
+
+            if not torch.isfinite(x).all():
+                ill_posed_system = True
+                print("\t\tSolver failed: Non-finite solution x!")
+                convergence_info_i["errors"].append("Solver failed: Non-finite solution x!")
+                break
+
+            if opt.gn_print_timings: print("\t\tLinear solve: {:.3f} s".format(timer() - timer_solve_start))
+
+            loss_data = torch.norm(res_data).item()
+            loss_total = torch.norm(res).item()
+
+            if len(convergence_info_i["total"]): 
+                if loss_total - convergence_info_i["total"][-1] > self.stop_loss_diff:
+                    print("As loss is greater than before breaking optimization")
+                    break
+                if loss_total == convergence_info_i["total"][-1]:
+                    print("loss not changing")
+                    break
+
+            convergence_info_i["data"].append(loss_data)
+            convergence_info_i["total"].append(loss_total)
+
+            # Increment the current rotation and translation.
+            R_inc = kornia.geometry.conversions.angle_axis_to_rotation_matrix(x[:opt_num_nodes_i*3].view(opt_num_nodes_i, 3))
+            t_inc = x[opt_num_nodes_i*3:].view(opt_num_nodes_i, 3, 1)
+
+            R_current = torch.matmul(R_inc, R_current)
+            t_current = t_current + t_inc
+
+
+            if num_edges_i > 0:
+                loss_arap = torch.norm(res_arap).item()
+                convergence_info_i["arap"].append(loss_arap)
+
+            if opt.gn_debug:
+                if num_edges_i > 0:
+                    print("\t\t-->Iteration: {0}. Lm:{1:.3f} Loss: \tdata = {2:.3f}, \tarap = {3:.3f}, \ttotal = {4:.3f}".format(gn_i, lm_factor,loss_data, loss_arap, loss_total))
+                else:
+                    print("\t\t-->Iteration: {0}. Loss: \tdata = {1:.3f}, \ttotal = {2:.3f}".format(gn_i, loss_data, loss_total))
+
+        return R_current, t_current, res, ill_posed_system
+
+    def solve_linear_system(self, A, b, solve_blocks=None):
+        """
+            Solve Ax = b, either as a single system or block by block
+            @params:
+                A: torch.Tensor: (6N, 6N)
+                b: torch.Tensor: (6N, 1)
+                solve_blocks: Independent blocks of A from GaussNewtonPlan.get_solve_blocks, None to solve the complete system
+        """
+        linear_solver = LinearSolverLU.apply
+
+        if solve_blocks is None:
+            return linear_solver(A, b)
+
+        x = torch.zeros_like(b)
+        for block_idxs, block_mask in solve_blocks:
+            block_size = block_idxs.shape[1]
+
+            # Padded unknowns get an identity row/column so that they solve to 0
+            valid_entries = block_mask.unsqueeze(2) & block_mask.unsqueeze(1)
+            identity = torch.eye(block_size, dtype=A.dtype, device=A.device).unsqueeze(0)
+            A_blocks = torch.where(valid_entries, A[block_idxs.unsqueeze(2), block_idxs.unsqueeze(1)], identity)
+            b_blocks = torch.where(block_mask.unsqueeze(2), b[block_idxs], torch.zeros_like(b[block_idxs]))
+
+            x_blocks = linear_solver(A_blocks, b_blocks) # (num_blocks, block_size, 1)
+
+            x = x.index_put((block_idxs[block_mask],), x_blocks[block_mask])
+
+        return x
+
+    def solve_levenberg_marquardt(self, problem, R_current, t_current, num_gn_iter, convergence_info_i):
+        """
+            Gauss-Newton with adaptive Levenberg-Marquardt damping (trust region control).
+
+            Every iteration the actual decrease of the energy E = 0.5*|r|^2 is compared with the decrease
+            predicted by the linearized system, rho = (E(x) - E(x + dx)) / (0.5 * dx^T (lm_factor * dx - J^T r)).
+            Steps with rho <= 0 are rejected and the damping is increased, otherwise the step is accepted
+            and the damping is decreased (Nielsen's update). The solver converges when the gradient J^T r or the
+            step is smaller than opt.gn_lm_gradient_tolerance / opt.gn_lm_step_tolerance, or when an accepted
+            step decreases the energy by less than opt.gn_lm_energy_tolerance (relative).
+
+            Accepting/rejecting steps and convergence are handled on the device with masked updates, 
+            iterations after convergence leave the estimate unchanged. The host only checks for convergence
+            every opt.gn_lm_convergence_check_interval iterations (never if 0) to stop early, and once after the solve.
+            Per iteration telemetry is stored as tensors in convergence_info_i["lm"].
+
+            @params:
+                problem: dict: Solver inputs, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Initial node transformations
+                num_gn_iter: int: Maximum number of iterations
+                convergence_info_i: dict: Convergence info of this sample, filled in place
+            @returns:
+                R_current, t_current, res, ill_posed_system: Same as solve_gauss_newton
+        """
+        dtype = problem["dtype"]
+        device = problem["device"]
+        opt_num_nodes_i = problem["num_nodes"]
+
+        telemetry = {
+            "energy":     torch.zeros((num_gn_iter + 1), dtype=dtype, device=device), # Energy of the current estimate, before the first iteration and after every iteration
+            "data":       torch.zeros((num_gn_iter + 1), dtype=dtype, device=device), # Norm of the data residual
+            "arap":       torch.zeros((num_gn_iter + 1), dtype=dtype, device=device), # Norm of the arap residual
+            "damping":    torch.zeros((num_gn_iter), dtype=dtype, device=device),     # Damping used to compute the step
+            "step_norm":  torch.zeros((num_gn_iter), dtype=dtype, device=device),
+            "gain_ratio": torch.zeros((num_gn_iter), dtype=dtype, device=device),
+            "accepted":   torch.zeros((num_gn_iter), dtype=torch.bool, device=device),
+            "active":     torch.zeros((num_gn_iter), dtype=torch.bool, device=device),   # False for iterations run after convergence
         }
 
+        res_data, res_arap, res, JtJ, gradient = self.compute_normal_equations(problem, R_current, t_current)
+        energy = 0.5 * torch.sum(res**2)
+
+        telemetry["energy"][0] = energy.detach()
+        telemetry["data"][0] = torch.norm(res_data).detach()
+        if res_arap is not None:
+            telemetry["arap"][0] = torch.norm(res_arap).detach()
+
+        identity = torch.eye(opt_num_nodes_i * 6, dtype=dtype, device=device)
+        lm_factor = torch.tensor(float(self.gn_lm_factor), dtype=dtype, device=device)
+        lm_nu = torch.tensor(2.0, dtype=dtype, device=device)
+
+        active = torch.ones((), dtype=torch.bool, device=device)
+        non_finite_step = torch.zeros((), dtype=torch.bool, device=device)
+        ill_posed_system = False
+        num_iter_run = 0
+
+        for gn_i in range(num_gn_iter):
+            timer_iter_start = timer()
+
+            try:
+                x = self.solve_linear_system(JtJ + identity * lm_factor, -gradient, problem["solve_blocks"])
+            except RuntimeError as e:
+                ill_posed_system = True
+                print("\t\tSolver failed: Ill-posed system!", e)
+                convergence_info_i["errors"].append("Solver failed: Ill-posed system!")
+                break
+
+            # A non-finite step stops the solve, replace it to keep the following (masked) computations finite
+            finite_step = torch.isfinite(x).all()
+            non_finite_step = non_finite_step | (active & ~finite_step)
+            x = torch.where(finite_step, x, torch.zeros_like(x))
+
+            # Candidate estimate
+            R_inc = kornia.geometry.conversions.angle_axis_to_rotation_matrix(x[:opt_num_nodes_i*3].view(opt_num_nodes_i, 3))
+            t_inc = x[opt_num_nodes_i*3:].view(opt_num_nodes_i, 3, 1)
+
+            R_candidate = torch.matmul(R_inc, R_current)
+            t_candidate = t_current + t_inc
+
+            res_data_candidate, res_arap_candidate, res_candidate, JtJ_candidate, gradient_candidate = self.compute_normal_equations(problem, R_candidate, t_candidate)
+            energy_candidate = 0.5 * torch.sum(res_candidate**2)
+
+            # Gain ratio between actual and predicted decrease of the energy
+            predicted_decrease = 0.5 * torch.sum(x * (lm_factor * x - gradient))
+            gain_ratio = (energy - energy_candidate) / torch.clamp(predicted_decrease, min=1e-12)
+            accepted = active & finite_step & (gain_ratio > 0) & torch.isfinite(energy_candidate)
+
+            telemetry["damping"][gn_i] = lm_factor.detach()
+            telemetry["step_norm"][gn_i] = torch.norm(x).detach()
+            telemetry["gain_ratio"][gn_i] = gain_ratio.detach()
+            telemetry["accepted"][gn_i] = accepted
+            telemetry["active"][gn_i] = active
+
+            relative_decrease = (energy - energy_candidate) / torch.clamp(energy, min=1e-12)
+
+            # Keep the candidate only if the energy decreased
+            R_current = torch.where(accepted, R_candidate, R_current)
+            t_current = torch.where(accepted, t_candidate, t_current)
+            res_data = torch.where(accepted, res_data_candidate, res_data)
+            res = torch.where(accepted, res_candidate, res)
+            if res_arap is not None:
+                res_arap = torch.where(accepted, res_arap_candidate, res_arap)
+            energy = torch.where(accepted, energy_candidate, energy)
+
+            JtJ = torch.where(accepted, JtJ_candidate, JtJ)
+            gradient = torch.where(accepted, gradient_candidate, gradient)
+
+            # Nielsen's damping update, frozen after convergence
+            lm_factor_accepted = lm_factor * torch.clamp(1.0 - (2.0 * gain_ratio - 1.0)**3, min=1.0/3.0)
+            lm_factor = torch.where(active, torch.where(accepted, lm_factor_accepted, lm_factor * lm_nu), lm_factor)
+            lm_nu = torch.where(active, torch.where(accepted, torch.full_like(lm_nu, 2.0), 2.0 * lm_nu), lm_nu)
+
+            telemetry["energy"][gn_i + 1] = energy.detach()
+            telemetry["data"][gn_i + 1] = torch.norm(res_data).detach()
+            if res_arap is not None:
+                telemetry["arap"][gn_i + 1] = torch.norm(res_arap).detach()
+
+            converged = (torch.max(torch.abs(gradient)) < opt.gn_lm_gradient_tolerance) \
+                | (torch.norm(x) < opt.gn_lm_step_tolerance) \
+                | (accepted & (relative_decrease < opt.gn_lm_energy_tolerance))
+            active = active & finite_step & ~converged
+
+            num_iter_run = gn_i + 1
+
+            if opt.gn_print_timings: print("\t\tLM iteration: {:.3f} s".format(timer() - timer_iter_start))
+
+            if opt.gn_debug:
+                print("\t\t-->Iteration: {0}. Lm:{1:.3e} Step: {2:.3e} Gain ratio: {3:.3f} Accepted: {4} \tenergy = {5:.3f}".format(
+                    gn_i, telemetry["damping"][gn_i].item(), telemetry["step_norm"][gn_i].item(), gain_ratio.item(), bool(accepted), energy.item()))
+
+            if opt.gn_lm_convergence_check_interval > 0 and num_iter_run % opt.gn_lm_convergence_check_interval == 0 and not bool(active):
+                break
+
+        # Single host sync after the solve
+        num_active_iter, non_finite_step = torch.stack([telemetry["active"][:num_iter_run].sum(), non_finite_step.type(torch.int64)]).tolist()
+        if non_finite_step:
+            ill_posed_system = True
+            print("\t\tSolver failed: Non-finite solution x!")
+            convergence_info_i["errors"].append("Solver failed: Non-finite solution x!")
+
+        convergence_info_i["lm"] = {k: v[:num_active_iter + 1] if v.shape[0] > num_gn_iter else v[:num_active_iter] for k, v in telemetry.items()}
+
+        # Losses of the accepted estimates, as for the fixed damping solver
+        accepted_iters = torch.cat([torch.ones((1), dtype=torch.bool, device=device), telemetry["accepted"][:num_active_iter]])
+        convergence_info_i["total"] += torch.sqrt(2.0 * telemetry["energy"][:num_active_iter + 1][accepted_iters]).tolist()
+        convergence_info_i["data"] += telemetry["data"][:num_active_iter + 1][accepted_iters].tolist()
+        if res_arap is not None:
+            convergence_info_i["arap"] += telemetry["arap"][:num_active_iter + 1][accepted_iters].tolist()
+
+        return R_current, t_current, res, ill_posed_system
+
+    def compute_normal_equations(self, problem, R_current, t_current):
+        """
+            Compute the residuals and the normal equations J^TJ, J^Tr of the GN solver.
+
+            With opt.gn_backward_mode == "checkpoint" the jacobian and the intermediate tensors of the data
+            and arap terms are not kept for the backward pass, they are recomputed from R_current, t_current.
+            @params:
+                problem: dict: Solver inputs and helper structures, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Current node transformations
+            @returns:
+                res_data, res_arap, res: torch.Tensor: Residuals, see compute_gauss_newton_system
+                JtJ: torch.Tensor: (N*6, N*6)
+                gradient: torch.Tensor: (N*6, 1): J^Tr
+        """
+        if opt.gn_backward_mode == "checkpoint" and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(self.compute_normal_equations_unchecked, problem, R_current, t_current, use_reentrant=False)
+
+        return self.compute_normal_equations_unchecked(problem, R_current, t_current)
+
+    def compute_normal_equations_unchecked(self, problem, R_current, t_current):
+        if opt.gn_use_fused_data_term:
+            if problem["graph_nodes"].device.type == "cpu":
+                return self.compute_fused_normal_equations(problem, R_current, t_current)
+
+            # The C++ extension has no CUDA kernel, use the dense jacobian for this solve
+            if not self.warned_fused_data_term_device:
+                print("\t\tWarning: gn_use_fused_data_term is only supported for CPU tensors, using the dense jacobian for device:", problem["graph_nodes"].device)
+                self.warned_fused_data_term_device = True
+
+        res_data, res_arap, res, jac = self.compute_gauss_newton_system(problem, R_current, t_current)
+
+        jac_t = torch.transpose(jac, 0, 1)
+        JtJ = torch.matmul(jac_t, jac)
+        gradient = torch.matmul(jac_t, res)
+
+        return res_data, res_arap, res, JtJ, gradient
+
+    def compute_fused_normal_equations(self, problem, R_current, t_current):
+        """
+            Same as compute_normal_equations, but the data term is accumulated into J^TJ and J^Tr by the
+            C++ extension, without building the dense data jacobian.
+        """
+        timer_data_start = timer()
+
+        res_data, JtJ, gradient = DataNormalEquationsC.apply(
+            self, problem, R_current, t_current, problem["graph_nodes"], problem["source_points"], problem["target_matches"],
+            problem["xy_pixels_warped"], problem["correspondence_weights"], problem["source_weights"]
+        )
+
+        if opt.gn_print_timings: print("\t\tData term (fused): {:.3f} s".format(timer() - timer_data_start))
+
+        if problem["num_edges"] == 0:
+            return res_data, None, res_data, JtJ, gradient
+
+        res_arap, jacobian_arap = self.compute_arap_system(problem["plan"], problem["original_graph_nodes"], R_current, t_current, problem["lambda_arap"])
+        jacobian_arap_t = torch.transpose(jacobian_arap, 0, 1)
+
+        JtJ = JtJ + torch.matmul(jacobian_arap_t, jacobian_arap)
+        gradient = gradient + torch.matmul(jacobian_arap_t, res_arap)
+
+        return res_data, res_arap, torch.cat((res_data, res_arap), 0), JtJ, gradient
+
+    def compute_gauss_newton_system(self, problem, R_current, t_current):
+        """
+            Compute the stacked residual and jacobian (data + arap term) of the GN solver
+            @params:
+                problem: dict: Solver inputs and helper structures, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Current node transformations
+            @returns:
+                res_data, res_arap, res: torch.Tensor: Residuals of the data term, arap term (None without edges) and both
+                jac: torch.Tensor: (num_residuals, N*6): Jacobian of res
+        """
+        num_edges_i = problem["num_edges"]
+        original_graph_nodes_i = problem["original_graph_nodes"]
+        lambda_arap = problem["lambda_arap"]
+
+        res_data, jacobian_data = self.compute_data_system(problem, R_current, t_current)
+
+        timer_arap_start = timer()
+
+        ##########################################
+        # Compute arap residual and jacobian.
+        ##########################################
+        if num_edges_i > 0:
+            res_arap, jacobian_arap = self.compute_arap_system(problem["plan"], original_graph_nodes_i, R_current, t_current, lambda_arap)
+
+        if opt.gn_print_timings: print("\t\tARAP term: {:.3f} s".format(timer() - timer_arap_start))
+
+        ##########################################
+        # Solve linear system.
+        ##########################################
+        if num_edges_i > 0:
+            res = torch.cat((res_data, res_arap), 0)
+            jac = torch.cat((jacobian_data, jacobian_arap), 0)
+        else:
+            res_arap = None
+            res = res_data
+            jac = jacobian_data
+
+        return res_data, res_arap, res, jac
+
+    def compute_data_system(self, problem, R_current, t_current):
+        """
+            Compute the data residual (flow and depth) and its dense jacobian
+            @params:
+                problem: dict: Solver inputs and helper structures, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Current node transformations
+            @returns:
+                res_data: torch.Tensor: (num_matches*3, 1)
+                jacobian_data: torch.Tensor: (num_matches*3, N*6)
+        """
+        dtype = problem["dtype"]
+        device = problem["device"]
+        opt_num_nodes_i = problem["num_nodes"]
+        num_matches = problem["num_matches"]
+
+        timer_data_start = timer()
+
+        res_data, jacobian_blocks = self.compute_data_blocks(problem, R_current, t_current)
+        jacobian_rows, jacobian_cols = self.data_block_indices(problem)
+
+        jacobian_data = torch.zeros((num_matches * 3, opt_num_nodes_i * 6), dtype=dtype, device=device) # (num_matches*3, opt_num_nodes_i*6)
+        jacobian_data = jacobian_data.index_put((jacobian_rows.reshape(-1), jacobian_cols.reshape(-1)), jacobian_blocks.view(-1), accumulate=True)
+
+        if opt.gn_debug:
+            assert torch.isfinite(jacobian_data).all(), jacobian_data
+
+        if opt.gn_print_timings: print("\t\tData term: {:.3f} s".format(timer() - timer_data_start))
+
+        return res_data, jacobian_data
+
+    def compute_data_blocks(self, problem, R_current, t_current):
+        """
+            Compute the data residual (flow and depth) and the non-zero blocks of its jacobian.
+            Every correspondence only depends on the rotation and translation of its 4 anchors.
+            @params:
+                problem: dict: Solver inputs and helper structures, see solve_gauss_newton
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Current node transformations
+            @returns:
+                res_data: torch.Tensor: (num_matches*3, 1)
+                jacobian_blocks: torch.Tensor: (num_matches, 3, 4, 6): Derivative of the flow x, flow y and depth residual 
+                    w.r.t. rotation (3) and translation (3) of every anchor, see data_block_indices
+        """
+        dtype = problem["dtype"]
+        device = problem["device"]
+        num_matches = problem["num_matches"]
+
+        graph_nodes_i = problem["graph_nodes"]
+        source_points_filtered = problem["source_points"]
+        target_matches_filtered = problem["target_matches"]
+        xy_pixels_warped_filtered = problem["xy_pixels_warped"]
+        correspondence_weights_filtered = problem["correspondence_weights"]
+        source_anchors = problem["source_anchors"]
+        source_weights = problem["source_weights"]
+
+        fx, fy, cx, cy = problem["intrinsics"]
+        lambda_data_flow = problem["lambda_data_flow"]
+        lambda_data_depth = problem["lambda_data_depth"]
+
+        ##########################################
+        # Compute deformed points.
+        ##########################################
+        deformed_points = torch.zeros((num_matches, 3, 1), dtype=dtype, device=device) 
+        rotated_points = []
+
+        for k in range(4): # Our data uses 4 anchors for every point
+            node_idxs_k = source_anchors[:, k] # (num_matches)
+            nodes_k = graph_nodes_i[node_idxs_k].view(num_matches, 3, 1) # (num_matches, 3, 1)
+
+            # Compute deformed point contribution.                    
+            rotated_points_k = torch.matmul(R_current[node_idxs_k], source_points_filtered - nodes_k) # (num_matches, 3, 1) = (num_matches, 3, 3) * (num_matches, 3, 1)
+            deformed_points_k = rotated_points_k + nodes_k + t_current[node_idxs_k]
+            deformed_points += source_weights[:, k].view(num_matches, 1, 1).repeat(1, 3, 1) * deformed_points_k # (num_matches, 3, 1)
+            rotated_points.append(rotated_points_k)
+
+        # Get necessary components of deformed points.
+        eps = 1e-7 # Just as good practice, although matches should all have valid depth at this stage
+
+        deformed_x = deformed_points[:, 0, :].view(num_matches) # (num_matches)
+        deformed_y = deformed_points[:, 1, :].view(num_matches) # (num_matches)
+        deformed_z_inverse = torch.div(1.0, deformed_points[:, 2, :].view(num_matches) + eps) # (num_matches)
+        fx_mul_x = fx * deformed_x # (num_matches)
+        fy_mul_y = fy * deformed_y # (num_matches)
+        fx_div_z = fx * deformed_z_inverse # (num_matches)
+        fy_div_z = fy * deformed_z_inverse # (num_matches)
+        fx_mul_x_div_z = fx_mul_x * deformed_z_inverse # (num_matches)
+        fy_mul_y_div_z = fy_mul_y * deformed_z_inverse # (num_matches)
+        minus_fx_mul_x_div_z_2 = -fx_mul_x_div_z * deformed_z_inverse # (num_matches)
+        minus_fy_mul_y_div_z_2 = -fy_mul_y_div_z * deformed_z_inverse # (num_matches)
+
+        zeros = torch.zeros_like(fx_div_z)
+        lambda_data_depth_vec = torch.full_like(fx_div_z, float(lambda_data_depth))
+
+        # Derivative of the residuals w.r.t. the deformed point, applied to the rotation part.
+        # lambda_data_flow only scales the x/y part, as in the original jacobian.
+        projection_rotation = torch.stack([
+            lambda_data_flow * fx_div_z, zeros, minus_fx_mul_x_div_z_2,
+            zeros, lambda_data_flow * fy_div_z, minus_fy_mul_y_div_z_2,
+            zeros, zeros, lambda_data_depth_vec
+        ], dim=1).view(num_matches, 3, 3)
+
+        projection_translation = torch.stack([
+            lambda_data_flow * fx_div_z, zeros, lambda_data_flow * minus_fx_mul_x_div_z_2,
+            zeros, lambda_data_flow * fy_div_z, lambda_data_flow * minus_fy_mul_y_div_z_2,
+            zeros, zeros, lambda_data_depth_vec
+        ], dim=1).view(num_matches, 3, 3)
+
+        ##########################################
+        # Compute data jacobian blocks.
+        ##########################################
+        # The fused data term runs on CPU tensors
+        vec_to_skew_mat = self.vec_to_skew_mat.to(device=device, dtype=dtype)
+
+        jacobian_blocks = []
+        for k in range(4): # Our data uses 4 anchors for every point
+            weights_k = (source_weights[:, k] * correspondence_weights_filtered).view(num_matches, 1, 1) # (num_matches, 1, 1)
+
+            # Compute skew symetric part.                
+            weighted_rotated_points_k = weights_k * rotated_points[k] # (num_matches, 3, 1)
+            skew_symetric_mat_data = -torch.matmul(vec_to_skew_mat, weighted_rotated_points_k).view(num_matches, 3, 3) # (num_matches, 3, 3)
+
+            # Jacobian wrt. ROTATION and TRANSLATION.
+            jacobian_blocks.append(torch.cat([
+                torch.matmul(projection_rotation, skew_symetric_mat_data),
+                weights_k * projection_translation
+            ], dim=2)) # (num_matches, 3, 6)
+
+        jacobian_blocks = torch.stack(jacobian_blocks, dim=2) # (num_matches, 3, 4, 6)
+
+        ##########################################
+        # Compute data residual.
+        ##########################################
+        res_data = torch.stack([
+            # FLOW PART
+            lambda_data_flow * correspondence_weights_filtered * (fx_mul_x_div_z + cx - xy_pixels_warped_filtered[:, 0, :].view(num_matches)),
+            lambda_data_flow * correspondence_weights_filtered * (fy_mul_y_div_z + cy - xy_pixels_warped_filtered[:, 1, :].view(num_matches)),
+            # DEPTH PART
+            lambda_data_depth * correspondence_weights_filtered * (deformed_points[:, 2, :] - target_matches_filtered[:, 2, :]).view(num_matches)
+        ], dim=1).view(num_matches * 3, 1)
+
+        return res_data, jacobian_blocks
+
+    def data_block_indices(self, problem):
+        """
+            Rows and columns of the data jacobian blocks (see compute_data_blocks) in the dense data jacobian
+            @returns:
+                jacobian_rows, jacobian_cols: torch.LongTensor: (num_matches, 3, 4, 6)
+        """
+        device = problem["device"]
+        num_matches = problem["num_matches"]
+        opt_num_nodes_i = problem["num_nodes"]
+
+        data_increment_vec_0_3, data_increment_vec_1_3, data_increment_vec_2_3 = problem["data_increment_vecs"]
+        jacobian_rows = torch.stack([data_increment_vec_0_3, data_increment_vec_1_3, data_increment_vec_2_3], dim=1).view(num_matches, 3, 1, 1).expand(-1, -1, 4, 6)
+
+        # Rotation of anchor k: 3*n_k + c, translation: 3*N + 3*n_k + c
+        xyz = torch.arange(3, dtype=torch.int64, device=device)
+        node_cols = 3 * problem["source_anchors"].view(num_matches, 4, 1) + xyz.view(1, 1, 3) # (num_matches, 4, 3)
+        jacobian_cols = torch.cat([node_cols, 3 * opt_num_nodes_i + node_cols], dim=2).view(num_matches, 1, 4, 6).expand(-1, 3, -1, -1)
+
+        return jacobian_rows, jacobian_cols
+
+    def compute_arap_system(self, solver_plan, original_graph_nodes, R_current, t_current, lambda_arap):
+        """
+            Compute the arap residual and jacobian for the edges of the solver plan
+            @params:
+                solver_plan: GaussNewtonPlan
+                original_graph_nodes: torch.Tensor: (N, 3): Graph nodes used for the ARAP term
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Current node transformations
+                lambda_arap: float: Weight of the arap term
+            @returns:
+                res_arap: torch.Tensor: (E*3, 1)
+                jacobian_arap: torch.Tensor: (E*3, N*6)
+        """
+        num_nodes = solver_plan.num_nodes
+        num_edges = solver_plan.num_edges
+
+        node_idxs_0 = solver_plan.graph_edge_pairs[:, 0] # i node
+        node_idxs_1 = solver_plan.graph_edge_pairs[:, 1] # j node
+        w_repeat = solver_plan.arap_edge_weights.view(num_edges, 1, 1)
+
+        nodes_0 = original_graph_nodes[node_idxs_0].view(num_edges, 3, 1)
+        nodes_1 = original_graph_nodes[node_idxs_1].view(num_edges, 3, 1)
+
+        # Compute residual.
+        rotated_node_delta = torch.matmul(R_current[node_idxs_0], nodes_1 - nodes_0) # (num_edges, 3)
+        res_arap = lambda_arap * w_repeat * (rotated_node_delta + nodes_0 + t_current[node_idxs_0] - (nodes_1 + t_current[node_idxs_1]))
+        res_arap = res_arap.view(num_edges * 3, 1)
+
+        jacobian_arap = torch.zeros((num_edges * 3, num_nodes * 6), dtype=R_current.dtype, device=R_current.device) # (num_edges*3, num_nodes*6)
+
+        # Compute jacobian wrt. translations.
+        jacobian_arap[solver_plan.arap_translation_rows, solver_plan.arap_translation_cols] = lambda_arap * solver_plan.arap_translation_values
+
+        # Compute jacobian wrt. rotations.
+        # Derivative wrt. R_1 is equal to 0.
+        skew_symetric_mat_arap = -lambda_arap * w_repeat * torch.matmul(self.vec_to_skew_mat, rotated_node_delta).view(num_edges, 3, 3) # (num_edges, 3, 3)
+        jacobian_arap[solver_plan.arap_rotation_rows, solver_plan.arap_rotation_cols] = skew_symetric_mat_arap.view(-1)
+
+        if opt.gn_debug:
+            assert torch.isfinite(jacobian_arap).all(), jacobian_arap
+
+        return res_arap, jacobian_arap
+
+    def solve_coarse_graph(
+        self, graph_nodes_i, original_graph_nodes_i, solver_plan_i,
+        source_points_filtered, target_matches_filtered, xy_pixels_warped_filtered, correspondence_weights_filtered,
+        source_anchors, source_weights, intrinsics_i,
+        R_current, t_current, convergence_info_i
+    ):
+        """
+            Coarse level of the hierarchical solve. The coarse graph (opt.gn_coarse_node_coverage) is cached
+            in the solver plan, see GaussNewtonPlan.get_coarse_graph. Every anchor is replaced by its closest 
+            coarse node and the coarse graph is solved with Gauss-Newton.
+            The coarse transformations are then interpolated to the fine nodes.
+
+            @params: Same as solve_gauss_newton
+            @returns:
+                R_current, t_current: torch.Tensor: (N, 3, 3), (N, 3, 1): Initialization for the fine nodes
+                valid_coarse_solve: bool: False if no coarse graph could be built or the coarse solve failed,
+                    in which case the input transformations are returned unchanged.
+        """
+        dtype = graph_nodes_i.dtype
+        device = graph_nodes_i.device
+        num_nodes_i = graph_nodes_i.shape[0]
+
+        coarse_graph = solver_plan_i.get_coarse_graph(graph_nodes_i, opt.gn_coarse_node_coverage)
+        if coarse_graph is None:
+            return R_current, t_current, False
+
+        coarse_node_indices = coarse_graph["coarse_node_indices"]
+        fine_to_coarse = coarse_graph["fine_to_coarse"]
+        coarse_solver_plan = coarse_graph["plan"]
+        num_coarse_nodes = coarse_solver_plan.num_nodes
+
+        coarse_convergence_info = {
+            "total": [],
+            "arap": [],
+            "data": [],
+            "condition_numbers": [],
+            "valid": 0,
+            "errors": []
+        }
+        convergence_info_i["coarse"] = coarse_convergence_info
+
+        if opt.gn_debug:
+            print("\tCoarse graph: {0} nodes || {1} edges".format(num_coarse_nodes, coarse_solver_plan.num_edges))
+
+        R_coarse, t_coarse, res, ill_posed_system = self.solve_gauss_newton(
+            graph_nodes_i[coarse_node_indices], original_graph_nodes_i[coarse_node_indices], coarse_solver_plan,
+            source_points_filtered, target_matches_filtered, xy_pixels_warped_filtered, correspondence_weights_filtered,
+            fine_to_coarse[source_anchors], source_weights, intrinsics_i,
+            R_current[coarse_node_indices], t_current[coarse_node_indices], opt.gn_num_coarse_iter, coarse_convergence_info
+        )
+
+        if ill_posed_system or res is None or not torch.isfinite(res).all():
+            return R_current, t_current, False
+
+        coarse_convergence_info["valid"] = 1
+
+        # Interpolate the coarse deformation at the fine nodes, using the same skinning as for the points:
+        #   g_f' = sum_k w_k * (R_k * (g_f - g_k) + g_k + t_k),    t_f = g_f' - g_f
+        # The rotation of a fine node is the rotation of its closest coarse node.
+        interpolation_nodes = coarse_graph["interpolation_nodes"]
+        num_interpolation_nodes = interpolation_nodes.shape[1]
+
+        coarse_nodes = graph_nodes_i[coarse_node_indices].view(num_coarse_nodes, 3, 1)
+        fine_nodes = graph_nodes_i.view(num_nodes_i, 3, 1)
+
+        interpolation_dist = torch.norm(fine_nodes.view(num_nodes_i, 1, 3) - coarse_nodes.view(num_coarse_nodes, 3)[interpolation_nodes], dim=2) # (num_nodes_i, K)
+        interpolation_weights = torch.exp(-interpolation_dist**2 / (2.0 * opt.gn_coarse_node_coverage**2))
+        interpolation_weights = interpolation_weights / interpolation_weights.sum(dim=1, keepdim=True)
+
+        deformed_fine_nodes = torch.zeros((num_nodes_i, 3, 1), dtype=dtype, device=device)
+        for k in range(num_interpolation_nodes):
+            coarse_idxs_k = interpolation_nodes[:, k]
+            deformed_nodes_k = torch.matmul(R_coarse[coarse_idxs_k], fine_nodes - coarse_nodes[coarse_idxs_k]) + coarse_nodes[coarse_idxs_k] + t_coarse[coarse_idxs_k]
+            deformed_fine_nodes += interpolation_weights[:, k].view(num_nodes_i, 1, 1) * deformed_nodes_k
+
+        R_current = R_coarse[fine_to_coarse]
+        t_current = deformed_fine_nodes - fine_nodes
+
+        return R_current, t_current, True
+
+    def sample_sparse_correspondences(self, xy_pixels_warped, target_points, valid_source_points, max_num_candidates, target_matches_dense=None):
+        """
+            Sample target matches only at (a random subset of) the valid source pixels,
+            instead of warping the complete target point image. Vectorised over the batch.
+            The target matches and their validity are only computed at the sampled pixels, 
+            the warped pixel coordinates are still image sized (as the flow).
+            @params:
+                xy_pixels_warped: torch.Tensor: (bs, 2, H, W): Source pixel coordinates warped by the flow
+                target_points: torch.Tensor: (bs, 3, H, W): Target point image
+                valid_source_points: torch.Tensor(bool): (bs, H, W): Valid source pixels
+                max_num_candidates: int: Maximum number of source pixels sampled per sample in batch
+                target_matches_dense: torch.Tensor: (bs, 3, H, W): Already warped target point image (MaskNet input), 
+                    gathered at the sampled pixels instead of sampling the target point image again
+            @returns:
+                pixel_idxs: torch.Tensor(int64): (bs, M): Sampled source pixels (y*W + x)
+                target_matches: torch.Tensor: (bs, M, 3): Target matches of the sampled pixels
+                valid_target_matches: torch.Tensor(bool): (bs, M): True for valid source pixels with a valid match
+        """
+        batch_size, _, image_height, image_width = target_points.shape
+        num_candidates = min(max_num_candidates, image_height * image_width)
+
+        # Random priority, valid source pixels in [1,2) are sampled before invalid pixels in [0,1)
+        valid_source_points = valid_source_points.view(batch_size, -1)
+        priority = torch.rand(valid_source_points.shape, device=valid_source_points.device) + valid_source_points.type(torch.float32)
+        pixel_idxs = torch.topk(priority, num_candidates, dim=1, sorted=False)[1] # (bs, M)
+        valid_candidates = torch.gather(valid_source_points, 1, pixel_idxs)
+
+        # Normalize to be between -1, and 1 (same as for the dense warp).
+        xy_coords_warped = torch.gather(xy_pixels_warped.reshape(batch_size, 2, -1), 2, pixel_idxs.unsqueeze(1).expand(-1, 2, -1)) # (bs, 2, M)
+        xy_coords_warped = xy_coords_warped / torch.tensor([image_width - 1, image_height - 1], dtype=xy_coords_warped.dtype, device=xy_coords_warped.device).view(1, 2, 1)
+        xy_coords_warped = (xy_coords_warped * 2 - 1).permute(0, 2, 1).unsqueeze(1) # (bs, 1, M, 2)
+
+        if target_matches_dense is not None:
+            target_matches = torch.gather(target_matches_dense.reshape(batch_size, 3, -1), 2, pixel_idxs.unsqueeze(1).expand(-1, 3, -1)) # (bs, 3, M)
+        else:
+            target_matches = torch.nn.functional.grid_sample(
+                target_points, xy_coords_warped, mode=opt.gn_depth_sampling_mode, padding_mode='zeros', align_corners=False
+            ).view(batch_size, 3, -1) # (bs, 3, M)
+
+        # We filter out any boundary matches, where any of the 4 pixels is invalid.
+        # Bilinear interpolation of the target depth validity (same as grid_sample with align_corners=False), 
+        # only the 4 target pixels around each match are read.
+        target_depth = target_points[:, 2].reshape(batch_size, -1)
+        x = ((xy_coords_warped[:, 0, :, 0] + 1) * image_width - 1) / 2 # (bs, M)
+        y = ((xy_coords_warped[:, 0, :, 1] + 1) * image_height - 1) / 2
+        x0, y0 = torch.floor(x), torch.floor(y)
+        target_matches_validity = torch.zeros_like(x)
+        for x_corner, weight_x in [(x0, x0 + 1 - x), (x0 + 1, x - x0)]:
+            for y_corner, weight_y in [(y0, y0 + 1 - y), (y0 + 1, y - y0)]:
+                inside = (x_corner >= 0) & (x_corner <= image_width - 1) & (y_corner >= 0) & (y_corner <= image_height - 1)
+                corner_idxs = (y_corner.clamp(0, image_height - 1) * image_width + x_corner.clamp(0, image_width - 1)).long()
+                corner_depth = torch.gather(target_depth, 1, corner_idxs)
+                corner_validity = inside & (corner_depth > 0.0) & (corner_depth <= opt.gn_max_depth)
+                target_matches_validity = target_matches_validity + weight_x * weight_y * corner_validity.type(x.dtype)
+        target_matches_validity = target_matches_validity >= 0.999
+
+        valid_target_matches = valid_candidates & (target_matches[:, 2] > 0.0) & (target_matches[:, 2] <= opt.gn_max_depth) & target_matches_validity
+
+        return pixel_idxs, target_matches.permute(0, 2, 1), valid_target_matches
+
+    @staticmethod
+    def scatter_sparse_correspondences(pixel_idxs, target_matches, valid_target_matches, image_height, image_width, target_matches_dense=None):
+        """
+            Image sized target_matches and valid_target_matches from the output of sample_sparse_correspondences (for visualization and evaluation)
+            @params:
+                target_matches_dense: torch.Tensor: (bs, 3, H, W): Returned as target matches if available 
+            @returns:
+                target_matches: torch.Tensor: (bs, 3, H, W): Target matches, only written at sampled pixels (if not dense)
+                valid_target_matches: torch.Tensor(bool): (bs, H, W): True only for sampled pixels with a valid match
+        """
+        batch_size = pixel_idxs.shape[0]
+
+        if target_matches_dense is None:
+            target_matches_dense = torch.zeros((batch_size, 3, image_height * image_width), dtype=target_matches.dtype, device=target_matches.device)
+            target_matches_dense.scatter_(2, pixel_idxs.unsqueeze(1).expand(-1, 3, -1), target_matches.permute(0, 2, 1))
+            target_matches_dense = target_matches_dense.view(batch_size, 3, image_height, image_width)
+
+        valid_target_matches_dense = torch.zeros((batch_size, image_height * image_width), dtype=torch.bool, device=valid_target_matches.device)
+        valid_target_matches_dense.scatter_(1, pixel_idxs, valid_target_matches)
+
+        return target_matches_dense, valid_target_matches_dense.view(batch_size, image_height, image_width)
+
     def arap(self,graph_nodes,source_node_position,target_node_position,\
             valid_nodes_mask,
             original_graph_nodes,
             graph_edges,graph_edges_weights,graph_clusters,\
-            R_current,t_current):
+            R_current,t_current,
+            solver_plan=None):
         """
             Main module to run ARAP using pytorch 
             @params: 
                 graph_nodes: torch.cuda.Tensor: Nx3: Position of graph nodes at source
                 source_node_position: torch.cuda.Tensor: Mx3: Position of valid graph nodes at source
                 target_node_position: torch.cuda.Tensor: Mx3: Position of valid graph nodes at target
+                solver_plan: GaussNewtonPlan: Plan of graph_edges, computed here if None
         """
 
 
@@ -940,7 +1875,6 @@ class DeformNet(torch.nn.Module):
 
         opt_num_nodes_i = R_current.shape[0]
         num_matches = len(valid_node_indices)
-        num_neighbors = graph_edges.shape[1]
 
         R_current = torch.tensor(R_current,dtype=dtype,device=device).view(opt_num_nodes_i, 3, 3)
         t_current = torch.tensor(t_current,dtype=dtype,device=device).view(opt_num_nodes_i, 3, 1)
@@ -967,22 +1901,11 @@ class DeformNet(torch.nn.Module):
             return {"convergence_info":convergence_info}
 
         timer_start = timer()
-        ###############################################################################################################
-        # Filter invalid edges.
-        ###############################################################################################################
-        node_ids = torch.arange(opt_num_nodes_i, dtype=torch.int32, device=device).view(-1, 1).repeat(1, num_neighbors) # (opt_num_nodes_i, num_neighbors)
-        graph_edge_pairs = torch.cat([node_ids.view(-1, num_neighbors, 1), graph_edges.view(-1, num_neighbors, 1)], 2) # (opt_num_nodes_i, num_neighbors, 2)
+        if solver_plan is None:
+            solver_plan = GaussNewtonPlan.from_graph(graph_edges, graph_edges_weights)
+        assert solver_plan.num_nodes == opt_num_nodes_i, "Solver plan was computed for a different graph"
 
-        valid_edges = graph_edges >= 0
-        valid_edge_idxs = torch.where(valid_edges)
-        graph_edge_pairs_filtered = graph_edge_pairs[valid_edge_idxs[0], valid_edge_idxs[1], :].type(torch.int64)
-        graph_edge_weights_pairs  = graph_edges_weights[valid_edge_idxs[0], valid_edge_idxs[1]]
-        
-        # print("Valid Edges Weights",graph_edge_weights_pairs.shape)
-        # print("Valid Edges", graph_edge_pairs_filtered[:,0])    
-        # print("Valid Edges", graph_edge_pairs_filtered[:,1])    
-
-        num_edges_i = graph_edge_pairs_filtered.shape[0]
+        num_edges_i = solver_plan.num_edges
 
         ###############################################################################################################
         # Execute Gauss-Newton solver.
@@ -1002,15 +1925,7 @@ class DeformNet(torch.nn.Module):
             print("\tNum. matches: {0} || Num. nodes: {1} || Num. edges: {2}".format(num_matches, opt_num_nodes_i, num_edges_i))
 
         # Helper structures.
-        data_increment_vec_0_3 = torch.arange(0, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_matches)
-        data_increment_vec_1_3 = torch.arange(1, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_matches)
-        data_increment_vec_2_3 = torch.arange(2, num_matches * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_matches)
-
-        if num_edges_i > 0:
-            arap_increment_vec_0_3 = torch.arange(0, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_edges_i)
-            arap_increment_vec_1_3 = torch.arange(1, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_edges_i)
-            arap_increment_vec_2_3 = torch.arange(2, num_edges_i * 3, 3, out=torch.cuda.LongTensor(), device=device) # (num_edges_i)
-            arap_one_vec = torch.ones((num_edges_i), dtype=dtype, device=device)
+        data_increment_vec_0_3, data_increment_vec_1_3, data_increment_vec_2_3 = solver_plan.data_increment_vecs(num_matches)
 
         ill_posed_system = False
 
@@ -1066,59 +1981,7 @@ class DeformNet(torch.nn.Module):
             # Compute arap residual and jacobian.
             ##########################################
             if num_edges_i > 0:
-                jacobian_arap = torch.zeros((num_edges_i * 3, opt_num_nodes_i * 6), dtype=dtype, device=device) # (num_edges_i*3, opt_num_nodes_i*6)
-
-                node_idxs_0 = graph_edge_pairs_filtered[:, 0] # i node
-                node_idxs_1 = graph_edge_pairs_filtered[:, 1] # j node
-
-                w = torch.ones_like(graph_edge_weights_pairs)
-                if opt.gn_use_edge_weighting:
-                    # Since graph edge weights sum up to 1 for all neighbors, we multiply
-                    # it by the number of neighbors to make the setting in the same scale
-                    # as in the case of not using edge weights (they are all 1 then).
-                    w = float(num_neighbors) * graph_edge_weights_pairs
-
-                w_repeat        = w.unsqueeze(-1).repeat(1, 3).unsqueeze(-1)
-                w_repeat_repeat = w_repeat.repeat(1, 1, 3)
-
-                # print("Nodes shape:",graph_nodes.shape)
-                # print(graph_nodes[node_idxs_0].shape)
-                # print(graph_nodes[node_idxs_0].view(num_edges_i, 3, 1).shape)
-
-                nodes_0 = original_graph_nodes[node_idxs_0].view(num_edges_i, 3, 1)
-                nodes_1 = original_graph_nodes[node_idxs_1].view(num_edges_i, 3, 1)
-
-                # Compute residual.
-                rotated_node_delta = torch.matmul(R_current[node_idxs_0], nodes_1 - nodes_0) # (num_edges_i, 3)
-                res_arap = lambda_arap * w_repeat * (rotated_node_delta + nodes_0 + t_current[node_idxs_0] - (nodes_1 + t_current[node_idxs_1]))
-                res_arap = res_arap.view(num_edges_i * 3, 1)
-
-
-                # Compute jacobian wrt. translations.
-                jacobian_arap[arap_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 0] += lambda_arap * w * arap_one_vec # (num_edges_i)
-                jacobian_arap[arap_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 1] += lambda_arap * w * arap_one_vec # (num_edges_i)
-                jacobian_arap[arap_increment_vec_2_3, 3 * opt_num_nodes_i + 3 * node_idxs_0 + 2] += lambda_arap * w * arap_one_vec # (num_edges_i)
-
-
-                jacobian_arap[arap_increment_vec_0_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 0] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-                jacobian_arap[arap_increment_vec_1_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 1] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-                jacobian_arap[arap_increment_vec_2_3, 3 * opt_num_nodes_i + 3 * node_idxs_1 + 2] += -lambda_arap * w * arap_one_vec # (num_edges_i)
-
-                # Compute jacobian wrt. rotations.
-                # Derivative wrt. R_1 is equal to 0.
-                skew_symetric_mat_arap = -lambda_arap * w_repeat_repeat * torch.matmul(self.vec_to_skew_mat, rotated_node_delta).view(num_edges_i, 3, 3) # (num_edges_i, 3, 3)
-
-                jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 0, 0]
-                jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 0, 1]
-                jacobian_arap[arap_increment_vec_0_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 0, 2]
-                jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 1, 0]
-                jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 1, 1]
-                jacobian_arap[arap_increment_vec_1_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 1, 2]
-                jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 0] += skew_symetric_mat_arap[:, 2, 0]
-                jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 1] += skew_symetric_mat_arap[:, 2, 1]
-                jacobian_arap[arap_increment_vec_2_3,                   3 * node_idxs_0 + 2] += skew_symetric_mat_arap[:, 2, 2]
-
-                assert torch.isfinite(jacobian_arap).all(), jacobian_arap
+                res_arap, jacobian_arap = self.compute_arap_system(solver_plan, original_graph_nodes, R_current, t_current, lambda_arap)
                 
             if opt.gn_print_timings: print("\t\tARAP term: {:.3f} s".format(timer() - timer_arap_start))
 
@@ -1152,14 +2015,14 @@ class DeformNet(torch.nn.Module):
             if opt.gn_check_condition_num:
                 with torch.no_grad():
                     # Condition number.
-                    values, _ = torch.eig(A)
-                    real_values = values[:, 0]
+                    # A is symmetric, so its eigenvalues are real.
+                    real_values = torch.linalg.eigvalsh(A)
                     assert torch.isfinite(real_values).all(), real_values 
                     max_eig_value = torch.max(torch.abs(real_values))
                     min_eig_value = torch.min(torch.abs(real_values))
                     condition_number = max_eig_value / min_eig_value
                     condition_number = condition_number.item()
-                    convergence_info[i]["condition_numbers"].append(condition_number)
+                    convergence_info["condition_numbers"].append(condition_number)
 
                     if opt.gn_break_on_condition_num and (not math.isfinite(condition_number) or condition_number > opt.gn_max_condition_num):
                         print("\t\tToo high condition number: {0:e} (max: {1:.3f}, min: {2:.3f}). Discarding sample".format(condition_number, max_eig_value.item(), min_eig_value.item()))
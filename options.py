@@ -82,6 +82,12 @@ def print_hyperparams():
     print()
     print("\tgn_max_matches_train         ", gn_max_matches_train)
     print("\tgn_max_matches_eval          ", gn_max_matches_eval)
+    print("\tgn_use_sparse_correspondences", gn_use_sparse_correspondences)
+    print("\tgn_use_hierarchical_solve    ", gn_use_hierarchical_solve)
+    print("\tgn_use_adaptive_lm           ", gn_use_adaptive_lm)
+    print("\tgn_lm_check_interval         ", gn_lm_convergence_check_interval)
+    print("\tgn_solve_clusters_indep      ", gn_solve_clusters_independently)
+    print("\tgn_backward_mode             ", gn_backward_mode)
     print("\tgn_depth_sampling_mode       ", gn_depth_sampling_mode)
     print("\tgn_use_edge_weighting        ", gn_use_edge_weighting)
     print("\tgn_remove_clusters           ", gn_remove_clusters_with_few_matches)
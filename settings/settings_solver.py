@@ -34,6 +34,36 @@ gn_max_matches_train = 10000
 gn_max_matches_train_per_batch = 100000 
 gn_max_matches_eval = 10000 
 gn_max_warped_points = 100000
+
+# Only sample correspondences at valid source pixels when evaluating, instead of
+# warping the complete target point image
+gn_use_sparse_correspondences = False
+gn_sparse_candidates_factor = 2 # Sampled source pixels per match (w.r.t. gn_max_matches_eval)
+
+# Coarse-to-fine solve: solve on a graph subsampled with gn_coarse_node_coverage first and
+# use the interpolated transformations to initialize a few iterations on the complete graph
+gn_use_hierarchical_solve = False
+gn_coarse_node_coverage = 0.15 # in meters
+gn_num_coarse_iter = 6
+gn_num_fine_iter = 2
+
+# Adaptive Levenberg-Marquardt damping instead of the fixed gn_lm_factor schedule: steps that don't
+# decrease the energy are rejected, and the solver stops once the gradient or step is small enough
+gn_use_adaptive_lm = False
+gn_lm_gradient_tolerance = 1e-6
+gn_lm_step_tolerance = 1e-5
+gn_lm_energy_tolerance = 1e-2 # Relative energy decrease
+gn_lm_convergence_check_interval = 0 # Check convergence on the host every k iterations (0: never, run all iterations masked on the device)
+
+# Solve clusters that share no correspondences as independent (batched) blocks of the linear system
+gn_solve_clusters_independently = False
+
+# Backward pass through the GN solver: "unroll" keeps all iterations, "checkpoint" recomputes the
+# jacobians during the backward pass, "implicit" only differentiates the final GN step at the solution
+gn_backward_mode = "unroll"
+
+# Compute the data term normal equations with the C++ extension (CPU tensors only, disabled with a warning for CUDA tensors)
+gn_use_fused_data_term = False
 gn_debug = False
 gn_print_timings = False
 
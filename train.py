@@ -328,6 +328,12 @@ if __name__ == "__main__":
                     print("FORWARD: {0:3f}, LOSS: {1:3f}, BACKWARD: {2:3f}".format(
                         time_statistics.forward_duration, time_statistics.loss_eval_duration, time_statistics.backward_duration
                     ))                       
+                    if time_statistics.num_train_steps > 0:
+                        # Compare gn_backward_mode settings by step time and peak memory
+                        print("TRAIN STEP: {0:3f} s, PEAK GPU MEMORY: {1:.1f} MB (gn_backward_mode: {2})".format(
+                            time_statistics.train_duration / time_statistics.num_train_steps, torch.cuda.max_memory_allocated() / 1024**2, opt.gn_backward_mode
+                        ))
+                    torch.cuda.reset_peak_memory_stats()
                     print()   
 
                     time_statistics = TimeStatistics()
@@ -464,6 +470,7 @@ if __name__ == "__main__":
                 time_statistics.backward_duration += (timer() - train_batch_backprop)
 
                 time_statistics.train_duration += (timer() - train_batch_start)
+                time_statistics.num_train_steps += 1
 
                 if iteration_number % opt.evaluation_frequency == 0:
                     # Store the latest model snapshot, if the required elased time has passed.
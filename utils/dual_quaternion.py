@@ -0,0 +1,155 @@
+import numpy as np
+
+
+def rotation_to_quaternion(rotations):
+    """
+        Converts rotation matrices to unit quaternions (vectorised, Shepperd's method)
+
+        @params:
+            rotations: (Nx3x3) np.ndarray: Rotation matrices
+
+        @returns:
+            quaternions: (Nx4) np.ndarray: Unit quaternions (w,x,y,z) with w >= 0
+    """
+    R = rotations.reshape(-1, 3, 3).astype(np.float64)
+    N = R.shape[0]
+
+    trace = R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2]
+
+    # Divide by the largest of 4w^2, 4x^2, 4y^2, 4z^2 for numerical stability
+    case = np.argmax(np.stack([trace, R[:, 0, 0], R[:, 1, 1], R[:, 2, 2]], axis=1), axis=1)
+    quaternions = np.empty((N, 4), dtype=np.float64)
+
+    m = case == 0
+    s = 2.0 * np.sqrt(np.maximum(1.0 + trace[m], 0))
+    quaternions[m] = np.stack([0.25 * s, (R[m, 2, 1] - R[m, 1, 2]) / s, (R[m, 0, 2] - R[m, 2, 0]) / s, (R[m, 1, 0] - R[m, 0, 1]) / s], axis=1)
+
+    m = case == 1
+    s = 2.0 * np.sqrt(np.maximum(1.0 + R[m, 0, 0] - R[m, 1, 1] - R[m, 2, 2], 0))
+    quaternions[m] = np.stack([(R[m, 2, 1] - R[m, 1, 2]) / s, 0.25 * s, (R[m, 0, 1] + R[m, 1, 0]) / s, (R[m, 0, 2] + R[m, 2, 0]) / s], axis=1)
+
+    m = case == 2
+    s = 2.0 * np.sqrt(np.maximum(1.0 + R[m, 1, 1] - R[m, 0, 0] - R[m, 2, 2], 0))
+    quaternions[m] = np.stack([(R[m, 0, 2] - R[m, 2, 0]) / s, (R[m, 0, 1] + R[m, 1, 0]) / s, 0.25 * s, (R[m, 1, 2] + R[m, 2, 1]) / s], axis=1)
+
+    m = case == 3
+    s = 2.0 * np.sqrt(np.maximum(1.0 + R[m, 2, 2] - R[m, 0, 0] - R[m, 1, 1], 0))
+    quaternions[m] = np.stack([(R[m, 1, 0] - R[m, 0, 1]) / s, (R[m, 0, 2] + R[m, 2, 0]) / s, (R[m, 1, 2] + R[m, 2, 1]) / s, 0.25 * s], axis=1)
+
+    quaternions[quaternions[:, 0] < 0] *= -1
+    quaternions /= np.linalg.norm(quaternions, axis=1, keepdims=True)
+
+    return quaternions
+
+
+def quaternion_to_rotation(quaternions):
+    """
+        Converts unit quaternions (w,x,y,z) to rotation matrices
+
+        @params:
+            quaternions: (...x4) np.ndarray
+
+        @returns:
+            rotations: (...x3x3) np.ndarray
+    """
+    w, x, y, z = quaternions[..., 0], quaternions[..., 1], quaternions[..., 2], quaternions[..., 3]
+
+    rotations = np.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+        2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+        2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)
+    ], axis=-1)
+
+    return rotations.reshape(quaternions.shape[:-1] + (3, 3))
+
+
+def quaternion_multiply(q1, q2):
+    """
+        Hamilton product of quaternions (w,x,y,z), broadcast over the leading dimensions
+    """
+    w1, v1 = q1[..., :1], q1[..., 1:]
+    w2, v2 = q2[..., :1], q2[..., 1:]
+
+    w = w1 * w2 - np.sum(v1 * v2, axis=-1, keepdims=True)
+    v = w1 * v2 + w2 * v1 + np.cross(v1, v2)
+
+    return np.concatenate([w, v], axis=-1)
+
+
+def dual_quaternion_from_transformation(rotations, translations):
+    """
+        Dual quaternions of the transformations x -> Rx + t
+
+        @params:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray
+
+        @returns:
+            real: (Nx4) np.ndarray: Rotation quaternions
+            dual: (Nx4) np.ndarray: 0.5*(0,t)*real
+    """
+    real = rotation_to_quaternion(rotations)
+    translations = translations.reshape(-1, 3).astype(np.float64)
+    dual = 0.5 * quaternion_multiply(np.concatenate([np.zeros((translations.shape[0], 1)), translations], axis=1), real)
+
+    return real, dual
+
+
+def deform_dqs(rotations, translations, points, anchors, weights, valid_pts, normals=None):
+    """
+        Dual quaternion skinning (vectorised over all points)
+        Transformations are w.r.t origin, x -> Rx + t, as the LBS kernels of the warpfield.
+
+        @params:
+            rotations: (Nx3x3) np.ndarray: Node rotations
+            translations: (Nx3) np.ndarray: Node translations
+            points: (Px3) np.ndarray: Points to deform
+            anchors: (PxK) np.ndarray(int): Anchor nodes of every point, -1 if invalid
+            weights: (PxK) np.ndarray: Normalized skinning weights
+            valid_pts: (P) np.ndarray(bool): Points which are deformed, others are left unchanged
+            normals: (Px3) np.ndarray: Normals to rotate with the points (optional)
+
+        @returns:
+            deformed_points: (Px3) np.ndarray
+            deformed_normals: (Px3) np.ndarray, only if normals are passed
+    """
+    real, dual = dual_quaternion_from_transformation(rotations, translations)
+    real, dual = real.astype(points.dtype), dual.astype(points.dtype) # Per point computations in the precision of the points
+
+    anchors = anchors.reshape(points.shape[0], -1)
+    weights = np.where(anchors >= 0, weights.reshape(anchors.shape), 0)
+    anchors = np.where(anchors >= 0, anchors, 0)
+    valid_pts = valid_pts.reshape(-1)
+
+    anchor_real = real[anchors] # (PxKx4)
+    anchor_dual = dual[anchors]
+
+    # q and -q are the same rotation, blend all quaternions in the hemisphere of the most weighted anchor
+    pivot = np.take_along_axis(anchor_real, np.argmax(weights, axis=1)[:, None, None], axis=1)
+    signs = np.where(np.sum(anchor_real * pivot, axis=-1) < 0, -1.0, 1.0)
+
+    blend_real = np.einsum('pk,pkc->pc', weights * signs, anchor_real)
+    blend_dual = np.einsum('pk,pkc->pc', weights * signs, anchor_dual)
+
+    norm = np.linalg.norm(blend_real, axis=1, keepdims=True)
+    norm[norm == 0] = 1
+    blend_real /= norm
+    blend_dual /= norm
+
+    # Rigid transformation of the blended dual quaternion, t = 2*dual*conj(real)
+    blend_rotations = quaternion_to_rotation(blend_real)
+    blend_translations = 2 * (blend_real[:, :1] * blend_dual[:, 1:] - blend_dual[:, :1] * blend_real[:, 1:] + np.cross(blend_real[:, 1:], blend_dual[:, 1:]))
+
+    deformed_points = np.einsum('pij,pj->pi', blend_rotations, points) + blend_translations
+    deformed_points = np.where(valid_pts[:, None], deformed_points, points).astype(points.dtype)
+
+    if normals is None:
+        return deformed_points
+
+    deformed_normals = np.einsum('pij,pj->pi', blend_rotations, normals)
+    deformed_normals = np.where(valid_pts[:, None], deformed_normals, normals)
+    norm = np.linalg.norm(deformed_normals, axis=1, keepdims=True)
+    norm[norm == 0] = 1
+    deformed_normals = deformed_normals / norm
+
+    return deformed_points, deformed_normals.astype(normals.dtype)
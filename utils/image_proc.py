@@ -374,4 +374,36 @@ def compute_boundary_mask(depth_image, max_distance):
     boundary_mask = boundary_horizontal_mask | boundary_vertical_mask
 
 
-    return boundary_mask[None,...]
\ No newline at end of file
+    return boundary_mask[None,...]
+
+def compute_mesh_vertex_mask(point_image, max_triangle_distance):
+    """
+        Pixels which are vertices of the mesh built by compute_mesh_from_depth, without building the mesh. 
+        Each 2x2 pixel square is split into two triangles, valid if all 3 pixels have depth and no edge is longer than max_triangle_distance
+
+        @params:
+            point_image: (3xHxW) np.ndarray: Backprojected depth image
+            max_triangle_distance: float
+
+        @returns:
+            vertex_mask: (HxW) np.ndarray(bool)
+    """
+    valid = point_image[2] > 0
+
+    p00, p01 = point_image[:, :-1, :-1], point_image[:, 1:, :-1]
+    p10, p11 = point_image[:, :-1, 1:], point_image[:, 1:, 1:]
+
+    def short_edge(a, b):
+        return np.sqrt(np.sum((a - b)**2, axis=0)) <= max_triangle_distance
+
+    diagonal = short_edge(p01, p10) & valid[1:, :-1] & valid[:-1, 1:]
+    upper_triangle = diagonal & valid[:-1, :-1] & short_edge(p00, p01) & short_edge(p00, p10)
+    lower_triangle = diagonal & valid[1:, 1:] & short_edge(p10, p11) & short_edge(p01, p11)
+
+    vertex_mask = np.zeros(valid.shape, dtype=bool)
+    vertex_mask[:-1, :-1] |= upper_triangle
+    vertex_mask[1:, :-1] |= upper_triangle | lower_triangle
+    vertex_mask[:-1, 1:] |= upper_triangle | lower_triangle
+    vertex_mask[1:, 1:] |= lower_triangle
+
+    return vertex_mask
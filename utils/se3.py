@@ -0,0 +1,203 @@
+"""
+    Batched SE(3) operations on N rigid transformations x -> Rx + t,
+    stored as rotations (Nx3x3) and translations (Nx3) np.ndarrays.
+"""
+import numpy as np
+
+from utils import dual_quaternion
+
+
+def apply(rotations, translations, points):
+    """
+        Transform one point per transformation
+
+        @params:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray, None to only rotate
+            points: (Nx3) np.ndarray
+
+        @returns:
+            transformed_points: (Nx3) np.ndarray
+    """
+    transformed_points = np.einsum('nij,nj->ni', rotations, points)
+    if translations is not None:
+        transformed_points += translations
+    return transformed_points
+
+
+def compose(rotations_1, translations_1, rotations_2, translations_2):
+    """
+        T1 * T2, i.e. apply T2 first and then T1
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray: R1 R2
+            translations: (Nx3) np.ndarray: R1 t2 + t1
+    """
+    rotations = np.einsum('nij,njk->nik', rotations_1, rotations_2)
+    translations = apply(rotations_1, translations_1, translations_2)
+    return rotations, translations
+
+
+def invert(rotations, translations):
+    """
+        T^-1
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray: R^T
+            translations: (Nx3) np.ndarray: -R^T t
+    """
+    inverse_rotations = np.swapaxes(rotations, 1, 2)
+    inverse_translations = -apply(inverse_rotations, None, translations)
+    return inverse_rotations, inverse_translations
+
+
+def _hat(vectors):
+    """
+        (Nx3) vectors to (Nx3x3) skew-symmetric matrices
+    """
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    zeros = np.zeros_like(x)
+    return np.stack([zeros, -z, y, z, zeros, -x, -y, x, zeros], axis=1).reshape(-1, 3, 3)
+
+
+def _rodrigues_coefficients(theta):
+    """
+        sin(theta)/theta, (1-cos(theta))/theta^2, (theta-sin(theta))/theta^3, with their Taylor expansion at 0
+    """
+    small = theta < 1e-4
+    safe_theta = np.where(small, 1.0, theta)
+    theta2 = theta * theta
+
+    A = np.where(small, 1 - theta2 / 6, np.sin(safe_theta) / safe_theta)
+    B = np.where(small, 0.5 - theta2 / 24, (1 - np.cos(safe_theta)) / safe_theta**2)
+    C = np.where(small, 1.0 / 6 - theta2 / 120, (safe_theta - np.sin(safe_theta)) / safe_theta**3)
+    return A, B, C
+
+
+def exp(twists):
+    """
+        Exponential map
+
+        @params:
+            twists: (Nx6) np.ndarray: (rho, omega), translational and rotational (axis-angle) part
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray
+    """
+    rho, omega = twists[:, :3], twists[:, 3:]
+    theta = np.linalg.norm(omega, axis=1)
+    A, B, C = _rodrigues_coefficients(theta)
+
+    W = _hat(omega)
+    W2 = np.einsum('nij,njk->nik', W, W)
+    I = np.eye(3)[None]
+
+    rotations = I + A[:, None, None] * W + B[:, None, None] * W2
+    V = I + B[:, None, None] * W + C[:, None, None] * W2
+    translations = apply(V, None, rho)
+
+    return rotations, translations
+
+
+def log(rotations, translations):
+    """
+        Logarithm map, inverse of exp
+
+        @returns:
+            twists: (Nx6) np.ndarray: (rho, omega) with |omega| <= pi
+    """
+    # Axis-angle from the quaternion is stable for all angles (including close to 0 and pi)
+    quaternions = dual_quaternion.rotation_to_quaternion(rotations)
+    w, v = quaternions[:, 0], quaternions[:, 1:]
+    sin_half_theta = np.linalg.norm(v, axis=1)
+    theta = 2 * np.arctan2(sin_half_theta, w)
+    scale = np.where(sin_half_theta < 1e-8, 2.0 / np.maximum(w, 1e-8), theta / np.maximum(sin_half_theta, 1e-12))
+    omega = scale[:, None] * v
+
+    # rho = V^-1 t, V^-1 = I - W/2 + (1 - A/(2B))/theta^2 W^2
+    A, B, C = _rodrigues_coefficients(theta)
+    small = theta < 1e-4
+    safe_theta = np.where(small, 1.0, theta)
+    D = np.where(small, 1.0 / 12 + theta**2 / 720, (1 - A / (2 * np.where(small, 1.0, B))) / safe_theta**2)
+
+    W = _hat(omega)
+    W2 = np.einsum('nij,njk->nik', W, W)
+    V_inv = np.eye(3)[None] - 0.5 * W + D[:, None, None] * W2
+    rho = apply(V_inv, None, translations)
+
+    return np.concatenate([rho, omega], axis=1)
+
+
+def slerp(rotations_1, rotations_2, alpha):
+    """
+        Spherical linear interpolation of rotations, alpha=0 gives R1 and alpha=1 gives R2
+
+        @params:
+            rotations_1, rotations_2: (Nx3x3) np.ndarray
+            alpha: float or (N) np.ndarray
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray
+    """
+    q1 = dual_quaternion.rotation_to_quaternion(rotations_1)
+    q2 = dual_quaternion.rotation_to_quaternion(rotations_2)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), q1.shape[:1])[:, None]
+
+    # Shortest path
+    cos_angle = np.sum(q1 * q2, axis=1, keepdims=True)
+    q2 = np.where(cos_angle < 0, -q2, q2)
+    cos_angle = np.abs(cos_angle)
+
+    angle = np.arccos(np.clip(cos_angle, -1, 1))
+    sin_angle = np.sin(angle)
+    nearly_parallel = sin_angle < 1e-6  # Linear interpolation
+    safe_sin_angle = np.where(nearly_parallel, 1.0, sin_angle)
+    w1 = np.where(nearly_parallel, 1 - alpha, np.sin((1 - alpha) * angle) / safe_sin_angle)
+    w2 = np.where(nearly_parallel, alpha, np.sin(alpha * angle) / safe_sin_angle)
+
+    q = w1 * q1 + w2 * q2
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    return dual_quaternion.quaternion_to_rotation(q).astype(np.result_type(rotations_1, rotations_2))
+
+
+def interpolate(rotations_1, translations_1, rotations_2, translations_2, alpha):
+    """
+        Geodesic (screw motion) interpolation T1 * exp(alpha * log(T1^-1 T2))
+        alpha=0 gives T1 and alpha=1 gives T2
+
+        @params:
+            alpha: float or (N) np.ndarray
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray
+    """
+    relative_rotations, relative_translations = compose(*invert(rotations_1, translations_1), rotations_2, translations_2)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), relative_rotations.shape[:1])[:, None]
+
+    step_rotations, step_translations = exp(alpha * log(relative_rotations, relative_translations))
+    return compose(rotations_1, translations_1, step_rotations, step_translations)
+
+
+def to_node_frame(rotations, translations, nodes):
+    """
+        Transformations w.r.t origin, x -> Rx + t, to transformations w.r.t graph nodes, x -> R(x-g) + g + t_g
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray: t_g = t - g + Rg
+    """
+    return rotations, translations - nodes + apply(rotations, None, nodes)
+
+
+def from_node_frame(rotations, translations, nodes):
+    """
+        Inverse of to_node_frame
+
+        @returns:
+            rotations: (Nx3x3) np.ndarray
+            translations: (Nx3) np.ndarray: t = t_g + g - Rg
+    """
+    return rotations, translations + nodes - apply(rotations, None, nodes)
@@ -10,4 +10,5 @@ class TimeStatistics:
         self.forward_duration = 0.0
         self.loss_eval_duration = 0.0
         self.backward_duration = 0.0
+        self.num_train_steps = 0
     
\ No newline at end of file
@@ -323,6 +323,28 @@ def save_graph_clusters(filename, clusters):
         fout.write(struct.pack('={}i'.format(clusters.size), *clusters.flatten("C")))
 
 
+def load_graph_node_coverages(filename):
+    # Node coverages (adaptive node sampling) are stored in order [num_nodes].
+    assert os.path.isfile(filename), "File not found: {}".format(filename)
+
+    node_coverages = None
+    with open(filename, 'rb') as fin:
+        num_nodes = struct.unpack('I', fin.read(4))[0]
+
+        node_coverages = struct.unpack('f' * num_nodes, fin.read(num_nodes * 4))
+        node_coverages = np.asarray(node_coverages, dtype=np.float32).reshape([num_nodes])
+
+    return node_coverages
+
+def save_graph_node_coverages(filename, node_coverages):
+    # Node coverages (adaptive node sampling) are stored in order [num_nodes].
+    assert len(node_coverages.shape) == 1
+    
+    with open(filename, 'wb') as fout:
+        fout.write(struct.pack('I', node_coverages.shape[0]))
+        fout.write(struct.pack('={}f'.format(node_coverages.size), *node_coverages.flatten("C")))
+
+
 def load_float_image(filename):
     # Image is stored row-wise in order [xdim, ydim, zdim].
     assert os.path.isfile(filename), "File not found: {}".format(filename)